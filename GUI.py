@@ -1,33 +1,46 @@
 import os
 import json
-import threading
-import socket
 import queue
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, filedialog, ttk
+from tkinter import scrolledtext, messagebox
 import re
+import time
 from datetime import datetime
 from pathlib import Path
 import logging
 import uuid
+import itertools
+from collections import deque
+# network_core (с asyncio), message_store и transfer_manager, а также ttk и filedialog
+# импортируются при первом использовании: окно входа появляется раньше.
 
 # ------------------------------
 # Логирование
 # ------------------------------
 LOG_GUI_FILE = "gui_client.log"
-logging.basicConfig(
-    filename=LOG_GUI_FILE,
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s %(module)s:%(lineno)d %(funcName)s: %(message)s",
-    datefmt="%Y-%m-%dT%H:%M:%S",
-    filemode='w'
-)
-logging.info("=== GUI Клиент запускается ===")
+
+def setup_logging():
+    # Файл журнала открывается после первой отрисовки окна входа; повторный вызов ничего не делает.
+    if logging.getLogger().handlers: return
+    logging.basicConfig(
+        filename=LOG_GUI_FILE,
+        level=logging.DEBUG,
+        format="%(asctime)s %(levelname)s %(module)s:%(lineno)d %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        filemode='w'
+    )
+    logging.info("=== GUI Клиент запускается ===")
+    while PENDING_LOG_ERRORS:
+        logging.error(PENDING_LOG_ERRORS.pop(0))
 
 # ------------------------------
 # Настройки
 # ------------------------------
 SETTINGS_FILE = "user_settings.json"
+HISTORY_DB_FILE = "chat_history.db"
+# Ошибки до открытия журнала: logging.error раньше setup_logging настроил бы журнал на stderr,
+# и gui_client.log не появился бы вовсе.
+PENDING_LOG_ERRORS = []
 
 def load_settings():
     if os.path.exists(SETTINGS_FILE):
@@ -35,13 +48,24 @@ def load_settings():
             with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception as e:
-            logging.error(f"Ошибка загрузки настроек: {e}")
+            PENDING_LOG_ERRORS.append(f"Ошибка загрузки настроек: {e}")
     return {
         "last_username": "", "theme": "Современная тёмная", "auto_scroll": True,
         "font_size": 11, "window_geometry": "1200x800",
-        "default_download_path": str(Path.home() / "Downloads")
+        "default_download_path": str(Path.home() / "Downloads"),
+        "direct_transfers": True, "compress_transfers": True, "multiplex_connection": False,
+        "transport_profile": "tuned", "encrypt_connection": False
     }
 
+def load_transport_profiles(spec):
+    # Строка из настроек: имя набора профилей сокетов и, при желании, поправки (см. transport_profiles.py).
+    from transport_profiles import TransportProfiles
+    try:
+        return TransportProfiles.parse(spec)
+    except ValueError as e:
+        logging.error(f"Неверный профиль сети '{spec}': {e}")
+        return TransportProfiles()
+
 def save_settings(settings):
     try:
         with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
@@ -49,7 +73,28 @@ def save_settings(settings):
     except Exception as e:
         logging.error(f"Ошибка сохранения настроек: {e}")
 
-USER_SETTINGS = load_settings()
+# Настройки читаются при создании окна (init_settings), а не при импорте модуля.
+USER_SETTINGS = {}
+
+# ------------------------------
+# Отрисовка
+# ------------------------------
+FRAME_BUDGET = 0.012   # сколько секунд за кадр можно тратить на очередь событий
+FRAME_INTERVAL = 16    # мс до следующего кадра, если работа осталась
+IDLE_POLL_INTERVAL = 250
+CHAT_EVENT_TYPES = ("new_message", "system_message")
+SCROLLBACK_MAX_MESSAGES = 1000   # сообщений в виджете, пока пользователь внизу
+SCROLLBACK_TRIM_CHUNK = 250      # удаляем и подгружаем обратно такими порциями
+SCROLLBACK_HISTORY_LIMIT = 50000
+PM_HISTORY_LIMIT = 20000         # на собеседника
+PM_RENDER_WINDOW = 100           # сообщений, отрисовываемых при переключении диалога
+HISTORY_PRELOAD = 2000           # сообщений, поднимаемых из локальной истории на диалог
+TOAST_DURATION = 3000
+TOAST_SLOTS = 3                # окон уведомлений одновременно; окна создаются один раз и переиспользуются
+TOAST_REDRAW_INTERVAL = 250    # мс между перерисовками, всплеск событий укладывается в одну
+TOAST_QUEUE_LIMIT = 20         # ждущих уведомлений сверх занятых окон, старые отбрасываются
+TOAST_GAP = 8
+MESSAGES_KEY = ("messages",)
 
 # ------------------------------
 # Темы
@@ -58,36 +103,258 @@ THEMES = {
     "Современная тёмная": {"BG_COLOR": "#0d1117", "TEXT_COLOR": "#f0f6fc", "TEXT_SECONDARY": "#8b949e","ENTRY_BG": "#21262d", "ENTRY_FG": "#f0f6fc", "ENTRY_BORDER": "#30363d", "ENTRY_FOCUS": "#58a6ff","BTN_BG": "#21262d", "BTN_HOVER": "#30363d", "BTN_ACTIVE": "#58a6ff", "BTN_TEXT": "#f0f6fc","ACCENT": "#58a6ff", "SUCCESS": "#3fb950", "WARNING": "#d29922", "ERROR": "#f85149","SYSTEM": "#7c3aed", "PM": "#ec4899", "HEADER_BG": "#21262d", "SIDEBAR_BG": "#0d1117","HIGHLIGHT_BG": "#30363d", "HIGHLIGHT_FG": "#ffffff", "INFO_MSG": "#7c3aed"},
     "Современная светлая": {"BG_COLOR": "#ffffff", "TEXT_COLOR": "#24292f", "TEXT_SECONDARY": "#656d76","ENTRY_BG": "#f6f8fa", "ENTRY_FG": "#24292f", "ENTRY_BORDER": "#d0d7de", "ENTRY_FOCUS": "#0969da","BTN_BG": "#f6f8fa", "BTN_HOVER": "#f3f4f6", "BTN_ACTIVE": "#0969da", "BTN_TEXT": "#24292f","ACCENT": "#0969da", "SUCCESS": "#1a7f37", "WARNING": "#9a6700", "ERROR": "#cf222e","SYSTEM": "#8250df", "PM": "#bf8700", "HEADER_BG": "#f6f8fa", "SIDEBAR_BG": "#ffffff","HIGHLIGHT_BG": "#d0d7de", "HIGHLIGHT_FG": "#000000", "INFO_MSG": "#8250df"}
 }
-CURRENT_THEME = THEMES.get(USER_SETTINGS.get("theme", "Современная тёмная"), THEMES["Современная тёмная"]).copy()
+CURRENT_THEME = {}
+
+def init_settings():
+    if not USER_SETTINGS:
+        USER_SETTINGS.update(load_settings())
+    if not CURRENT_THEME:
+        CURRENT_THEME.update(THEMES.get(USER_SETTINGS.get("theme", "Современная тёмная"), THEMES["Современная тёмная"]))
 
 # ------------------------------
 # Вспомогательные классы
 # ------------------------------
-class NotificationHelper:
-    @staticmethod
-    def show_toast(parent, message, msg_type="info", duration=3000):
+def plural(n, one, few, many):
+    if n % 10 == 1 and n % 100 != 11: return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14: return few
+    return many
+
+class ToastManager:
+    """Всплывающие уведомления без Toplevel на каждое событие.
+
+    Окна (TOAST_SLOTS штук) создаются при первом показе и потом только
+    перекрашиваются и прячутся. Уведомления копятся и выводятся не чаще раза в
+    TOAST_REDRAW_INTERVAL: новые ЛС складываются в одну сводку («12 новых
+    сообщений от 3 человек»), одинаковые уведомления — в одно со счётчиком,
+    а то, для чего нет свободного окна, ждёт в очереди.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.slots = []
+        self.pending = deque(maxlen=TOAST_QUEUE_LIMIT)
+        self.pending_messages = {}    # отправитель -> новых ЛС с прошлой перерисовки
+        self.flush_job = None
+        self.last_flush = 0.0
+
+    def show(self, message, msg_type="info", duration=TOAST_DURATION):
+        key = (msg_type, message)
+        for item in self.pending:
+            if item["key"] == key:
+                item["count"] += 1
+                break
+        else:
+            self.pending.append({"key": key, "text": message, "type": msg_type, "count": 1, "duration": duration})
+        self._schedule()
+
+    def new_message(self, sender):
+        self.pending_messages[sender] = self.pending_messages.get(sender, 0) + 1
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush_job: return
+        delay = max(0, int((self.last_flush - time.monotonic()) * 1000) + TOAST_REDRAW_INTERVAL)
+        self.flush_job = self.root.after(delay, self._flush)
+
+    def _flush(self):
+        self.flush_job = None
+        self.last_flush = time.monotonic()
         try:
-            if not parent.winfo_exists(): return
-            toast = tk.Toplevel(parent)
-            toast.withdraw(); toast.overrideredirect(True)
-            colors = {"info": CURRENT_THEME["ACCENT"], "success": CURRENT_THEME["SUCCESS"], "warning": CURRENT_THEME["WARNING"], "error": CURRENT_THEME["ERROR"]}
-            bg_color = colors.get(msg_type, CURRENT_THEME["ACCENT"])
-            frame = tk.Frame(toast, bg=bg_color, padx=15, pady=10); frame.pack()
-            label = tk.Label(frame, text=message, bg=bg_color, fg="white", font=("Arial", 10, "bold")); label.pack()
-            toast.update_idletasks()
-            x = parent.winfo_rootx() + parent.winfo_width() - toast.winfo_width() - 20
-            y = parent.winfo_rooty() + 50
-            toast.geometry(f"+{x}+{y}")
-            toast.deiconify(); toast.lift(); toast.attributes("-topmost", True)
-            toast.after(duration, toast.destroy)
+            if not self.root.winfo_exists(): return
+            if self.pending_messages:
+                slot = self._slot_for(MESSAGES_KEY)
+                if slot:
+                    if slot["key"] != MESSAGES_KEY:
+                        slot.update(key=MESSAGES_KEY, senders={})
+                    for sender, count in self.pending_messages.items():
+                        slot["senders"][sender] = slot["senders"].get(sender, 0) + count
+                    self.pending_messages.clear()
+                    self._render(slot, self._messages_text(slot["senders"]), "info", TOAST_DURATION)
+            while self.pending:
+                item = self.pending[0]
+                slot = self._slot_for(item["key"])
+                if not slot: break
+                self.pending.popleft()
+                count = item["count"] + (slot["count"] if slot["key"] == item["key"] else 0)
+                slot.update(key=item["key"], count=count)
+                self._render(slot, item["text"] + (f" (×{count})" if count > 1 else ""), item["type"], item["duration"])
         except Exception as e: logging.error(f"Ошибка Toast: {e}")
 
+    @staticmethod
+    def _messages_text(senders):
+        total = sum(senders.values())
+        if len(senders) == 1:
+            sender = next(iter(senders))
+            return f"Новое ЛС от {sender}" if total == 1 else f"{total} новых ЛС от {sender}"
+        return (f"{total} {plural(total, 'новое сообщение', 'новых сообщения', 'новых сообщений')} "
+                f"от {len(senders)} {plural(len(senders), 'человека', 'человек', 'человек')}")
+
+    def _slot_for(self, key):
+        # Окно, уже показывающее то же уведомление, иначе свободное (новое, пока их меньше TOAST_SLOTS).
+        for slot in self.slots:
+            if slot["key"] == key: return slot
+        for slot in self.slots:
+            if slot["key"] is None: return slot
+        if len(self.slots) < TOAST_SLOTS:
+            window = tk.Toplevel(self.root)
+            window.withdraw(); window.overrideredirect(True)
+            frame = tk.Frame(window, padx=15, pady=10); frame.pack()
+            label = tk.Label(frame, fg="white", font=("Arial", 10, "bold")); label.pack()
+            slot = {"window": window, "frame": frame, "label": label, "key": None, "count": 0, "senders": {}, "hide_job": None}
+            self.slots.append(slot)
+            return slot
+        return None
+
+    def _render(self, slot, text, msg_type, duration):
+        colors = {"info": CURRENT_THEME["ACCENT"], "success": CURRENT_THEME["SUCCESS"], "warning": CURRENT_THEME["WARNING"], "error": CURRENT_THEME["ERROR"]}
+        bg_color = colors.get(msg_type, CURRENT_THEME["ACCENT"])
+        window = slot["window"]
+        slot["frame"].config(bg=bg_color)
+        slot["label"].config(text=text, bg=bg_color)
+        window.update_idletasks()
+        index = self.slots.index(slot)
+        x = self.root.winfo_rootx() + self.root.winfo_width() - window.winfo_reqwidth() - 20
+        y = self.root.winfo_rooty() + 50 + index * (window.winfo_reqheight() + TOAST_GAP)
+        window.geometry(f"+{x}+{y}")
+        if window.state() == "withdrawn":
+            window.deiconify(); window.attributes("-topmost", True)
+        window.lift()
+        if slot["hide_job"]:
+            window.after_cancel(slot["hide_job"])
+        slot["hide_job"] = window.after(duration, lambda: self._hide(slot))
+
+    def _hide(self, slot):
+        slot.update(key=None, count=0, senders={}, hide_job=None)
+        try:
+            if slot["window"].winfo_exists(): slot["window"].withdraw()
+        except tk.TclError: return
+        if self.pending or self.pending_messages:
+            self._schedule()
+
+def encode_message(segments):
+    # Сообщение храним одной строкой: "теги\x1fтекст" через \x1e — в разы компактнее списка кортежей.
+    return "\x1e".join(",".join(tags) + "\x1f" + text.replace("\x1e", " ").replace("\x1f", " ") for text, tags in segments)
+
+def decode_message(encoded):
+    segments = []
+    for part in encoded.split("\x1e"):
+        tags, text = part.split("\x1f", 1)
+        segments.append((text, tuple(tags.split(",")) if tags else ()))
+    return segments
+
+class ScrollbackView:
+    """Ограниченная прокрутка для Text-виджета.
+
+    В виджете живут только последние сообщения; старые удаляются порциями и
+    остаются в history в сжатом виде, откуда подгружаются, когда пользователь
+    прокручивает к началу.
+    """
+
+    def __init__(self, text_widget, history=None, tag_hook=None, max_messages=SCROLLBACK_MAX_MESSAGES, trim_chunk=SCROLLBACK_TRIM_CHUNK):
+        self.text = text_widget
+        self.history = history if history is not None else deque(maxlen=SCROLLBACK_HISTORY_LIMIT)
+        self.tag_hook = tag_hook
+        self.max_messages = max_messages
+        self.trim_chunk = trim_chunk
+        self.line_counts = deque()  # строк в каждом отрисованном сообщении, от старых к новым
+        self.load_scheduled = False
+        self.scrollbar_set = getattr(text_widget, "vbar", None) and text_widget.vbar.set
+        self.text.configure(yscrollcommand=self._on_yscroll)
+
+    def older_count(self):
+        return max(0, len(self.history) - len(self.line_counts))
+
+    def attach(self, history, window=PM_RENDER_WINDOW):
+        self.history = history
+        self.line_counts.clear()
+        count = min(len(history), window)
+        messages = [decode_message(history[i]) for i in range(len(history) - count, len(history))]
+        insert_args = []
+        for segments in messages:
+            self.line_counts.append(self._collect(insert_args, segments))
+        self.text.config(state=tk.NORMAL)
+        self.text.delete(1.0, tk.END)
+        if insert_args: self.text.insert(tk.END, *insert_args)
+        self.text.config(state=tk.DISABLED)
+        self.text.yview(tk.END)
+
+    def append(self, messages, autoscroll=True):
+        if not messages: return
+        at_bottom = self.text.yview()[1] >= 0.999
+        insert_args = []
+        for segments in messages:
+            self.history.append(encode_message(segments))
+            self.line_counts.append(self._collect(insert_args, segments))
+        self.text.config(state=tk.NORMAL)
+        self.text.insert(tk.END, *insert_args)
+        # Пока пользователь читает старое, не сдвигаем ему текст — разве что виджет совсем разросся.
+        if at_bottom or len(self.line_counts) > self.max_messages * 3:
+            self._trim()
+        self.text.config(state=tk.DISABLED)
+        if autoscroll: self.text.yview(tk.END)
+
+    def load_older(self):
+        self.load_scheduled = False
+        older = self.older_count()
+        if not older or not self.text.winfo_exists(): return
+        start = max(0, older - self.trim_chunk)
+        insert_args, counts = [], []
+        for i in range(start, older):
+            counts.append(self._collect(insert_args, decode_message(self.history[i])))
+        self.text.config(state=tk.NORMAL)
+        self.text.insert("1.0", *insert_args)
+        self.text.config(state=tk.DISABLED)
+        self.line_counts.extendleft(reversed(counts))
+        # Оставляем на месте то, что пользователь видел до подгрузки.
+        self.text.yview(f"{sum(counts) + 1}.0")
+
+    def reveal(self, needle, skip=0):
+        # Находим сообщение, содержащее needle (в сжатом виде), пропустив skip более новых
+        # таких же, дорисовываем при необходимости старые порции и подсвечиваем его.
+        matches = (len(self.history) - 1 - i for i, entry in enumerate(reversed(self.history)) if needle in entry)
+        index = next(itertools.islice(matches, skip, None), None)
+        if index is None: return False
+        while index < self.older_count():
+            self.load_older()
+        position = index - self.older_count()
+        first_line = sum(self.line_counts[i] for i in range(position)) + 1
+        last_line = first_line + self.line_counts[position]
+        self.text.tag_configure("search_hit", background=CURRENT_THEME["WARNING"])
+        self.text.tag_remove("search_hit", "1.0", tk.END)
+        self.text.tag_add("search_hit", f"{first_line}.0", f"{last_line}.0")
+        self.text.see(f"{last_line}.0")
+        self.text.see(f"{first_line}.0")
+        return True
+
+    def _collect(self, insert_args, segments):
+        lines = 0
+        for text, tags in segments:
+            if self.tag_hook: self.tag_hook(tags)
+            insert_args.extend((text, tags))
+            lines += text.count("\n")
+        return lines
+
+    def _trim(self):
+        excess = len(self.line_counts) - self.max_messages
+        if excess < self.trim_chunk: return
+        lines = sum(self.line_counts.popleft() for _ in range(excess))
+        self.text.delete("1.0", f"{lines + 1}.0")
+
+    def _on_yscroll(self, first, last):
+        if self.scrollbar_set: self.scrollbar_set(first, last)
+        if float(first) <= 0.0 and not self.load_scheduled and self.older_count():
+            self.load_scheduled = True
+            self.text.after_idle(self.load_older)
+
 class SettingsWindow(tk.Toplevel):
     def __init__(self, master, client_app):
+        from tkinter import ttk
+        from network_core import MAX_CONCURRENT_TRANSFERS
+        from transport_profiles import TRANSPORT_PRESETS
         super().__init__(master)
         self.client_app = client_app
         self.title("Настройки")
-        self.geometry("450x300")
+        self.geometry("450x500")
         self.resizable(False, False)
         self.configure(bg=CURRENT_THEME["BG_COLOR"], padx=20, pady=20)
         self.transient(master)
@@ -95,7 +362,13 @@ class SettingsWindow(tk.Toplevel):
 
         self.theme_var = tk.StringVar(value=USER_SETTINGS.get("theme"))
         self.autoscroll_var = tk.BooleanVar(value=USER_SETTINGS.get("auto_scroll"))
+        self.direct_var = tk.BooleanVar(value=USER_SETTINGS.get("direct_transfers", True))
+        self.compress_var = tk.BooleanVar(value=USER_SETTINGS.get("compress_transfers", True))
+        self.multiplex_var = tk.BooleanVar(value=USER_SETTINGS.get("multiplex_connection", False))
+        self.tls_var = tk.BooleanVar(value=USER_SETTINGS.get("encrypt_connection", False))
         self.fontsize_var = tk.IntVar(value=USER_SETTINGS.get("font_size"))
+        self.transfers_var = tk.IntVar(value=USER_SETTINGS.get("max_concurrent_transfers", MAX_CONCURRENT_TRANSFERS))
+        self.transport_var = tk.StringVar(value=USER_SETTINGS.get("transport_profile", "tuned"))
         
         style = ttk.Style(self)
         style.configure("TCheckbutton", background=CURRENT_THEME["BG_COLOR"], foreground=CURRENT_THEME["TEXT_COLOR"])
@@ -109,11 +382,31 @@ class SettingsWindow(tk.Toplevel):
         font_spinbox = ttk.Spinbox(self, from_=8, to=20, textvariable=self.fontsize_var, width=5)
         font_spinbox.grid(row=1, column=1, sticky="w", padx=10)
 
+        tk.Label(self, text="Одновременных передач:", bg=CURRENT_THEME["BG_COLOR"], fg=CURRENT_THEME["TEXT_COLOR"]).grid(row=2, column=0, sticky="w", pady=5)
+        transfers_spinbox = ttk.Spinbox(self, from_=1, to=10, textvariable=self.transfers_var, width=5)
+        transfers_spinbox.grid(row=2, column=1, sticky="w", padx=10)
+
+        tk.Label(self, text="Профиль сети:", bg=CURRENT_THEME["BG_COLOR"], fg=CURRENT_THEME["TEXT_COLOR"]).grid(row=3, column=0, sticky="w", pady=5)
+        transport_combo = ttk.Combobox(self, textvariable=self.transport_var, values=list(TRANSPORT_PRESETS), state="readonly")
+        transport_combo.grid(row=3, column=1, sticky="ew", padx=10)
+
         autoscroll_check = ttk.Checkbutton(self, text="Автопрокрутка чата", variable=self.autoscroll_var, style="TCheckbutton")
-        autoscroll_check.grid(row=2, column=0, columnspan=2, sticky="w", pady=10)
+        autoscroll_check.grid(row=4, column=0, columnspan=2, sticky="w", pady=(10, 0))
+
+        direct_check = ttk.Checkbutton(self, text="Прямая передача файлов в локальной сети", variable=self.direct_var, style="TCheckbutton")
+        direct_check.grid(row=5, column=0, columnspan=2, sticky="w")
+
+        compress_check = ttk.Checkbutton(self, text="Сжимать файлы при передаче", variable=self.compress_var, style="TCheckbutton")
+        compress_check.grid(row=6, column=0, columnspan=2, sticky="w")
+
+        multiplex_check = ttk.Checkbutton(self, text="Чат и файлы одним соединением с сервером", variable=self.multiplex_var, style="TCheckbutton")
+        multiplex_check.grid(row=7, column=0, columnspan=2, sticky="w")
+
+        tls_check = ttk.Checkbutton(self, text="Шифровать соединение (TLS, без прямых передач)", variable=self.tls_var, style="TCheckbutton")
+        tls_check.grid(row=8, column=0, columnspan=2, sticky="w", pady=(0, 10))
 
         btn_frame = tk.Frame(self, bg=CURRENT_THEME["BG_COLOR"])
-        btn_frame.grid(row=3, column=0, columnspan=2, pady=(20, 0))
+        btn_frame.grid(row=9, column=0, columnspan=2, pady=(20, 0))
 
         save_btn = tk.Button(btn_frame, text="Сохранить", command=self.save_and_close, bg=CURRENT_THEME["SUCCESS"], fg="white", relief=tk.FLAT, padx=10)
         save_btn.pack(side=tk.LEFT, padx=10)
@@ -127,12 +420,26 @@ class SettingsWindow(tk.Toplevel):
         USER_SETTINGS["theme"] = self.theme_var.get()
         USER_SETTINGS["auto_scroll"] = self.autoscroll_var.get()
         USER_SETTINGS["font_size"] = self.fontsize_var.get()
+        USER_SETTINGS["max_concurrent_transfers"] = self.transfers_var.get()
+        USER_SETTINGS["direct_transfers"] = self.direct_var.get()
+        USER_SETTINGS["compress_transfers"] = self.compress_var.get()
+        USER_SETTINGS["multiplex_connection"] = self.multiplex_var.get()
+        USER_SETTINGS["transport_profile"] = self.transport_var.get()
+        USER_SETTINGS["encrypt_connection"] = self.tls_var.get()
         
         self.client_app.auto_scroll_enabled = self.autoscroll_var.get()
+        # Прямая передача идёт мимо сервера и не шифруется, поэтому при TLS файлы идут через сервер.
+        self.client_app.transfers.direct = self.direct_var.get() and not self.tls_var.get()
+        self.client_app.transfers.compress = self.compress_var.get()
+        self.client_app.network.multiplex = self.multiplex_var.get()  # со следующего подключения
+        self.client_app.network.transport_profiles = load_transport_profiles(self.transport_var.get())  # с новых соединений
+        if self.tls_var.get() != bool(self.client_app.network.tls):
+            from tls_transport import TlsClientContext
+            self.client_app.network.tls = TlsClientContext(USER_SETTINGS.setdefault("tls_pins", {})) if self.tls_var.get() else None
         
         save_settings(USER_SETTINGS)
         
-        messagebox.showinfo("Сохранено", "Настройки сохранены.\nТема и размер шрифта вступят в силу после перезапуска приложения.", parent=self)
+        messagebox.showinfo("Сохранено", "Настройки сохранены.\nТема, размер шрифта и число одновременных передач вступят в силу после перезапуска приложения, одно соединение и шифрование — после переподключения.", parent=self)
         self.destroy()
 
 # ------------------------------
@@ -143,7 +450,7 @@ class PrivateMessageWindow(tk.Toplevel):
         super().__init__(master)
         self.client_app = client_app
         self.active_partner = None
-        self.chat_history = {}
+        self.chat_history = {}  # собеседник -> deque сжатых сообщений (encode_message)
 
         self.title("Личные сообщения")
         self.geometry("800x600")
@@ -181,13 +488,17 @@ class PrivateMessageWindow(tk.Toplevel):
         main_pane.add(right_frame, minsize=300)
 
         self.setup_tags()
+        self.chat_view = ScrollbackView(self.chat_area, history=deque(maxlen=PM_HISTORY_LIMIT))
+        for partner in self.client_app.message_store.partners(self.client_app.username):
+            self.partners_listbox.insert(tk.END, partner)
         self.withdraw()
 
     def send_file_to_active_partner(self):
         if not self.active_partner:
-            NotificationHelper.show_toast(self.client_app, "Сначала выберите диалог", "warning")
+            self.client_app.toasts.show("Сначала выберите диалог", "warning")
             return
 
+        from tkinter import filedialog
         filepath = filedialog.askopenfilename(title=f"Файл для {self.active_partner}", parent=self)
         if not filepath: return
         
@@ -208,17 +519,15 @@ class PrivateMessageWindow(tk.Toplevel):
         if partner: self.start_chat_with(partner)
 
     def start_chat_with(self, partner):
-        if partner not in self.chat_history:
-            self.chat_history[partner] = []
-            self.partners_listbox.insert(tk.END, partner)
-        
         all_items = list(self.partners_listbox.get(0, tk.END))
-        if partner in all_items:
-            idx = all_items.index(partner)
-            self.partners_listbox.selection_clear(0, tk.END)
-            self.partners_listbox.selection_set(idx)
-            self.partners_listbox.activate(idx)
-            self.on_partner_select()
+        if partner not in all_items:
+            self.partners_listbox.insert(tk.END, partner)
+            all_items.append(partner)
+        idx = all_items.index(partner)
+        self.partners_listbox.selection_clear(0, tk.END)
+        self.partners_listbox.selection_set(idx)
+        self.partners_listbox.activate(idx)
+        self.on_partner_select()
 
     def on_partner_select(self, event=None):
         if not self.partners_listbox.curselection(): return
@@ -229,13 +538,17 @@ class PrivateMessageWindow(tk.Toplevel):
         self.partners_listbox.itemconfig(idx, {'bg': CURRENT_THEME["ENTRY_BG"]})
 
     def load_chat_history(self):
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.delete(1.0, tk.END)
-        history = self.chat_history.get(self.active_partner, [])
-        for entry in history:
-            self.append_message_to_display(entry['sender'], entry['text'])
-        self.chat_area.config(state=tk.DISABLED)
-        self.chat_area.yview(tk.END)
+        # Отрисовываем только последнее окно диалога, остальное подгрузится при прокрутке вверх.
+        self.chat_view.attach(self.dialog_history(self.active_partner))
+
+    def dialog_history(self, partner):
+        # Диалог, которого ещё нет в памяти, поднимаем из локальной истории без запроса к серверу.
+        history = self.chat_history.get(partner)
+        if history is None:
+            rows = self.client_app.message_store.load_dialog(self.client_app.username, "pm", partner, HISTORY_PRELOAD)
+            history = deque((encode_message(self.format_pm(sender, body, ts)) for sender, body, ts in rows), maxlen=PM_HISTORY_LIMIT)
+            self.chat_history[partner] = history
+        return history
 
     def send_pm(self, event=None):
         text = self.msg_var.get().strip()
@@ -246,35 +559,166 @@ class PrivateMessageWindow(tk.Toplevel):
             # self.handle_incoming_pm(self.active_partner, text, from_me=True) # Убрано локальное эхо
             self.msg_var.set("")
     
-    def handle_incoming_pm(self, partner, text, from_me=False):
+    def handle_incoming_pm(self, partner, text, from_me=False, notify=True):
         sender = self.client_app.username if from_me else partner
-        if partner not in self.chat_history:
-            self.chat_history[partner] = []
+        history = self.dialog_history(partner)
+        all_items = list(self.partners_listbox.get(0, tk.END))
+        if partner not in all_items:
             self.partners_listbox.insert(0, partner)
-        self.chat_history[partner].append({"sender": sender, "text": text})
+            all_items.insert(0, partner)
         
         if partner == self.active_partner:
-            self.append_message_to_display(sender, text)
+            self.chat_view.append([self.format_pm(sender, text)])
         else:
-            all_items = list(self.partners_listbox.get(0, tk.END))
+            history.append(encode_message(self.format_pm(sender, text)))
             if partner in all_items:
                 idx = all_items.index(partner)
                 self.partners_listbox.itemconfig(idx, {'bg': CURRENT_THEME["WARNING"]})
         
-        if not from_me:
-             NotificationHelper.show_toast(self.client_app, f"Новое ЛС от {partner}", "info")
+        if not from_me and notify:
+             self.client_app.toasts.new_message(partner)
 
-    def append_message_to_display(self, sender, text):
-        self.chat_area.config(state=tk.NORMAL)
-        ts = datetime.now().strftime("%H:%M:%S")
+    def format_pm(self, sender, text, timestamp=None):
+        ts = (datetime.fromtimestamp(timestamp) if timestamp else datetime.now()).strftime("%H:%M:%S")
         if sender == self.client_app.username:
-            self.chat_area.insert(tk.END, f"Вы [{ts}]\n", ("me",))
-            self.chat_area.insert(tk.END, f"{text}\n\n", ("me_msg",))
+            return [(f"Вы [{ts}]\n", ("me",)), (f"{text}\n\n", ("me_msg",))]
+        return [(f"{sender} [{ts}]\n", ("partner",)), (f"{text}\n\n", ("partner_msg",))]
+
+# ------------------------------
+# ПАНЕЛЬ ПЕРЕДАЧ ФАЙЛОВ
+# ------------------------------
+class TransferPanel(tk.Frame):
+    STATE_TEXT = {"awaiting_accept": "Ждём согласия получателя", "queued": "В очереди", "requested": "Подключение...",
+                  "direct": "Ждём прямого подключения...", "awaiting_relay": "Переход на передачу через сервер...",
+                  "rejected": "Отклонено", "cancelled": "Отменено"}
+
+    def __init__(self, master, client_app):
+        super().__init__(master, bg=CURRENT_THEME["SIDEBAR_BG"])
+        self.client_app = client_app
+        self.rows = {}  # id записи TransferManager -> виджеты строки
+        self.packed_order = []
+        tk.Label(self, text="Передачи:", bg=CURRENT_THEME["SIDEBAR_BG"], fg=CURRENT_THEME["TEXT_COLOR"], font=("Arial", 12, "bold")).pack(anchor=tk.W, padx=10, pady=(5, 0))
+        self.empty_label = tk.Label(self, text="Нет активных передач", bg=CURRENT_THEME["SIDEBAR_BG"], fg=CURRENT_THEME["TEXT_SECONDARY"], font=("Arial", 9))
+        self.empty_label.pack(anchor=tk.W, padx=10, pady=(0, 5))
+
+    def update_transfer(self, item):
+        row = self.rows.get(item["id"])
+        if row is None:
+            row = self.rows[item["id"]] = self._create_row(item)
+            self.empty_label.pack_forget()
+        self._repack()
+        fmt = self.client_app._format_filesize
+        state = item["state"]
+        row["bar"]["value"] = item["done"] * 100 / item["size"] if item["size"] else 0
+        row["pause_btn"].config(text="▶" if item["paused"] else "⏸", state=tk.NORMAL if state in ("awaiting_accept", "queued") else tk.DISABLED)
+        speed = f"{item['rate'] / (1024 * 1024):.1f} МБ/с"
+        if state == "active":
+            eta = f" · {int(item['eta']) // 60}:{int(item['eta']) % 60:02d}" if item["eta"] is not None else ""
+            row["stats"].config(text=f"{fmt(item['done'])} из {fmt(item['size'])} · {speed}{eta}")
+        elif state == "done":
+            packed = f" · сжато до {fmt(item['wire'])}" if item["encoding"] != "raw" and item["wire"] else ""
+            row["stats"].config(text=f"Готово · {fmt(item['size'])}{packed} · {speed}", fg=CURRENT_THEME["SUCCESS"])
+        elif state == "error":
+            row["stats"].config(text=f"Ошибка: {item['error']}", fg=CURRENT_THEME["ERROR"])
         else:
-            self.chat_area.insert(tk.END, f"{sender} [{ts}]\n", ("partner",))
-            self.chat_area.insert(tk.END, f"{text}\n\n", ("partner_msg",))
-        self.chat_area.config(state=tk.DISABLED)
-        self.chat_area.yview(tk.END)
+            text = "Пауза" if item["paused"] else self.STATE_TEXT.get(state, state)
+            row["stats"].config(text=f"{text}: {item['error']}" if item["error"] else text, fg=CURRENT_THEME["ERROR"] if state in ("rejected", "cancelled") else CURRENT_THEME["TEXT_SECONDARY"])
+        if state in ("done", "error", "cancelled", "rejected"):
+            for btn in (row["up_btn"], row["pause_btn"], row["cancel_btn"]): btn.config(state=tk.DISABLED)
+            self.after(5000 if state == "done" else 10000, self.remove_transfer, item["id"])
+
+    def _create_row(self, item):
+        from tkinter import ttk
+        transfers = self.client_app.transfers
+        frame = tk.Frame(self, bg=CURRENT_THEME["SIDEBAR_BG"])
+        top = tk.Frame(frame, bg=CURRENT_THEME["SIDEBAR_BG"])
+        top.pack(fill=tk.X)
+        arrow = "⬆" if item["direction"] == "upload" else "⬇"
+        btn_opts = {"bg": CURRENT_THEME["BTN_BG"], "fg": CURRENT_THEME["BTN_TEXT"], "relief": tk.FLAT, "font": ("Arial", 8), "width": 2, "cursor": "hand2"}
+        cancel_btn = tk.Button(top, text="✕", command=lambda: transfers.cancel(item["id"]), **btn_opts)
+        cancel_btn.pack(side=tk.RIGHT)
+        pause_btn = tk.Button(top, text="⏸", command=lambda: transfers.toggle_pause(item["id"]), **btn_opts)
+        pause_btn.pack(side=tk.RIGHT)
+        up_btn = tk.Button(top, text="▲", command=lambda: transfers.move(item["id"], -1), **btn_opts)
+        up_btn.pack(side=tk.RIGHT)
+        tk.Label(top, text=f"{arrow} {item['filename']}", bg=CURRENT_THEME["SIDEBAR_BG"], fg=CURRENT_THEME["TEXT_COLOR"], font=("Arial", 9), anchor="w").pack(side=tk.LEFT, fill=tk.X, expand=True)
+        bar = ttk.Progressbar(frame, maximum=100, mode="determinate")
+        bar.pack(fill=tk.X)
+        stats = tk.Label(frame, bg=CURRENT_THEME["SIDEBAR_BG"], fg=CURRENT_THEME["TEXT_SECONDARY"], font=("Arial", 8), anchor="w")
+        stats.pack(fill=tk.X)
+        return {"frame": frame, "bar": bar, "stats": stats, "up_btn": up_btn, "pause_btn": pause_btn, "cancel_btn": cancel_btn}
+
+    def _repack(self):
+        # Порядок строк повторяет очередь TransferManager.
+        order = [item["id"] for item in self.client_app.transfers.transfers if item["id"] in self.rows]
+        if order == self.packed_order: return
+        for item_id in self.packed_order:
+            if item_id in self.rows: self.rows[item_id]["frame"].pack_forget()
+        for item_id in order:
+            self.rows[item_id]["frame"].pack(fill=tk.X, padx=10, pady=(0, 5))
+        self.packed_order = order
+
+    def remove_transfer(self, item_id):
+        self.client_app.transfers.forget(item_id)
+        row = self.rows.pop(item_id, None)
+        if row: row["frame"].destroy()
+        self.packed_order = [i for i in self.packed_order if i != item_id]
+        if not self.rows: self.empty_label.pack(anchor=tk.W, padx=10, pady=(0, 5))
+
+# ------------------------------
+# ОКНО ПОИСКА ПО ИСТОРИИ
+# ------------------------------
+class SearchWindow(tk.Toplevel):
+    def __init__(self, master, client_app):
+        super().__init__(master)
+        self.client_app = client_app
+        self.results = []
+        self.search_job = None
+        self.title("Поиск по истории")
+        self.geometry("700x450")
+        self.minsize(400, 250)
+        self.configure(bg=CURRENT_THEME["BG_COLOR"], padx=10, pady=10)
+        self.transient(master)
+
+        self.query_var = tk.StringVar()
+        query_entry = tk.Entry(self, textvariable=self.query_var, bg=CURRENT_THEME["ENTRY_BG"], fg=CURRENT_THEME["ENTRY_FG"], insertbackground=CURRENT_THEME["ENTRY_FG"], relief=tk.FLAT, font=("Arial", self.client_app.font_size))
+        query_entry.pack(fill=tk.X, ipady=5)
+        query_entry.focus()
+        query_entry.bind("<Return>", lambda e: self.open_result(0))
+        self.query_var.trace_add("write", self.schedule_search)
+
+        self.status_label = tk.Label(self, text="Введите слова для поиска", bg=CURRENT_THEME["BG_COLOR"], fg=CURRENT_THEME["TEXT_SECONDARY"], anchor="w")
+        self.status_label.pack(fill=tk.X, pady=5)
+
+        self.results_listbox = tk.Listbox(self, bg=CURRENT_THEME["ENTRY_BG"], fg=CURRENT_THEME["ENTRY_FG"], selectbackground=CURRENT_THEME["ACCENT"], selectforeground="white", font=("Arial", self.client_app.font_size), relief=tk.FLAT, bd=0, highlightthickness=0, activestyle=tk.NONE)
+        self.results_listbox.pack(fill=tk.BOTH, expand=True)
+        self.results_listbox.bind("<Double-1>", lambda e: self.open_result())
+        self.results_listbox.bind("<Return>", lambda e: self.open_result())
+
+    def schedule_search(self, *args):
+        # Ищем после паузы в наборе, а не на каждую букву.
+        if self.search_job: self.after_cancel(self.search_job)
+        self.search_job = self.after(150, self.run_search)
+
+    def run_search(self):
+        self.search_job = None
+        started = time.perf_counter()
+        self.results = self.client_app.message_store.search(self.client_app.username, self.query_var.get())
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.results_listbox.delete(0, tk.END)
+        for msg_id, channel, partner, sender, body, ts in self.results:
+            place = "Общий чат" if channel == "chat" else f"ЛС: {partner}"
+            line = f"{datetime.fromtimestamp(ts):%d.%m %H:%M}  [{place}]  {sender}: {body}"
+            self.results_listbox.insert(tk.END, line if len(line) <= 150 else line[:149] + "…")
+        self.status_label.config(text=f"Найдено: {len(self.results)} ({elapsed_ms:.1f} мс)" if self.query_var.get().strip() else "Введите слова для поиска")
+
+    def open_result(self, index=None):
+        if index is None:
+            if not self.results_listbox.curselection(): return
+            index = self.results_listbox.curselection()[0]
+        if index >= len(self.results): return
+        msg_id, channel, partner, sender, body, ts = self.results[index]
+        self.client_app.jump_to_message(msg_id, channel, partner, sender, body)
 
 # ------------------------------
 # Основной класс GUI-клиента
@@ -282,6 +726,7 @@ class PrivateMessageWindow(tk.Toplevel):
 class ChatClientGUI(tk.Tk):
     def __init__(self):
         super().__init__()
+        init_settings()
         self.title("Wi-Fi Chat Pro")
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.setup_window_properties()
@@ -290,7 +735,10 @@ class ChatClientGUI(tk.Tk):
         self.create_login_window()
         if USER_SETTINGS.get("last_username"):
             self.name_var.set(USER_SETTINGS["last_username"])
+        self.bind("<<GuiQueue>>", self.process_gui_queue)
         self.process_gui_queue()
+        # Перерисовка окна входа уже стоит в очереди idle, сеть запустится после неё.
+        self.after_idle(self.start_backend)
 
     def setup_window_properties(self):
         self.minsize(1000, 700)
@@ -304,18 +752,41 @@ class ChatClientGUI(tk.Tk):
         self.username = ""
         self.server_host = ""
         self.server_port = 0
-        self.command_socket = None
         self.gui_queue = queue.Queue()
-        self.stop_event = threading.Event()
-        self.network_thread = None
+        self.gui_wakeup_pending = False
+        self.gui_frame_job = None
+        self.gui_processing = False
+        self.closing = False
+        self.configured_tags = set()
+        self.network = self.transfers = self.message_store = None
         self.online_users = set()
         self.connection_status = "disconnected"
         self.auto_scroll_enabled = USER_SETTINGS.get("auto_scroll", True)
         self.font_size = USER_SETTINGS.get("font_size", 11)
         self.pm_window = None
-        # --- ИЗМЕНЕНО ---
-        self.pending_downloads = {} # Словарь для хранения информации о скачиваемых файлах
-        self.pending_upload_queue = []
+        self.toasts = ToastManager(self)
+        last_server = USER_SETTINGS.get("last_server")
+        if last_server:
+            # Последний сервер пробуем сразу, не дожидаясь автообнаружения.
+            self.server_host, self.server_port = last_server[0], last_server[1]
+
+    def start_backend(self):
+        # Импорт asyncio и сетевого ядра — самая долгая часть запуска, поэтому он идёт после окна входа.
+        setup_logging()
+        from network_core import ClientNetworkCore, MAX_CONCURRENT_TRANSFERS
+        from message_store import MessageStore
+        from transfer_manager import TransferManager
+        encrypt = USER_SETTINGS.get("encrypt_connection", False)
+        self.network = ClientNetworkCore(self.gui_queue, notify=self.wake_gui, multiplex=USER_SETTINGS.get("multiplex_connection", False),
+                                         transport_profiles=load_transport_profiles(USER_SETTINGS.get("transport_profile", "tuned")),
+                                         tls=encrypt, tls_pins=USER_SETTINGS.setdefault("tls_pins", {}))
+        self.network.start()
+        max_transfers = USER_SETTINGS.get("max_concurrent_transfers", MAX_CONCURRENT_TRANSFERS)
+        self.transfers = TransferManager(self.network, self.send_message_to_server, on_change=self.on_transfer_changed, max_uploads=max_transfers, max_downloads=max_transfers, direct=USER_SETTINGS.get("direct_transfers", True) and not encrypt,
+                                         compress=USER_SETTINGS.get("compress_transfers", True))
+        self.message_store = MessageStore(HISTORY_DB_FILE)
+        self.message_store.start()
+        self.network.discover()
 
     def create_login_window(self):
         self.login_window = tk.Toplevel(self)
@@ -337,37 +808,9 @@ class ChatClientGUI(tk.Tk):
         
         self.status_label_login = tk.Label(self.login_window, text="Ожидание подключения...", bg=CURRENT_THEME["BG_COLOR"], fg=CURRENT_THEME["TEXT_SECONDARY"])
         self.status_label_login.pack(pady=5)
-        
-        threading.Thread(target=self.find_server_udp, daemon=True).start()
 
-    def find_server_udp(self):
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            udp_socket.bind(("", 9999))
-            logging.info("Слушаю UDP порт 9999 для автообнаружения...")
-            while self.connection_status == "disconnected":
-                data, addr = udp_socket.recvfrom(1024)
-                try:
-                    server_info = json.loads(data.decode())
-                    if server_info.get("app_name") == "python_chat":
-                        self.server_host = server_info["host"]
-                        self.server_port = server_info["port"]
-                        logging.info(f"Сервер найден: {self.server_host}:{self.server_port}")
-                        if self.login_window.winfo_exists():
-                            self.status_label_login.config(text=f"Сервер найден: {self.server_host}", fg=CURRENT_THEME["SUCCESS"])
-                        break
-                except (json.JSONDecodeError, KeyError):
-                    continue
-        except Exception as e:
-            logging.error(f"Ошибка UDP сокета: {e}")
-            if self.login_window.winfo_exists():
-                 self.status_label_login.config(text=f"Ошибка поиска сервера", fg=CURRENT_THEME["ERROR"])
-        finally:
-            udp_socket.close()
-            
     def on_connect(self):
-        if not self.server_host:
+        if not self.server_host or self.network is None:
             self.status_label_login.config(text="Сервер не найден, подождите...", fg=CURRENT_THEME["WARNING"])
             return
         
@@ -382,7 +825,7 @@ class ChatClientGUI(tk.Tk):
         self.connect_btn.config(state=tk.DISABLED)
         self.status_label_login.config(text="Подключение...", fg=CURRENT_THEME["WARNING"])
         
-        threading.Thread(target=self.start_network_connection, daemon=True).start()
+        self.network.connect(self.server_host, self.server_port, self.username)
     
     def center_window(self, window, width, height):
         x = (self.winfo_screenwidth() // 2) - (width // 2)
@@ -392,228 +835,167 @@ class ChatClientGUI(tk.Tk):
     def quit_app_on_login_close(self):
         self.on_closing(from_login=True)
 
-    def start_network_connection(self):
+    def wake_gui(self):
+        # Вызывается из сетевого потока: одно виртуальное событие на пачку, а не на сообщение.
+        if self.gui_wakeup_pending or self.closing: return
+        self.gui_wakeup_pending = True
         try:
-            self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.command_socket.connect((self.server_host, self.server_port))
-            self.command_socket.sendall(b"CMD\n")
-            response = self.command_socket.recv(1024).decode().strip()
-            if response == "AUTH_REQUEST":
-                self.command_socket.sendall((self.username + "\n").encode())
-                auth_response_raw = self.command_socket.recv(1024).decode().strip()
-                if auth_response_raw.startswith("AUTH_SUCCESS"):
-                    self.connection_status = "connected"
-                    self.gui_queue.put({"type": "connection_success", "message": auth_response_raw.split(" ", 1)[1]})
-                else:
-                    error_msg = auth_response_raw.split(" ", 1)[1]
-                    self.gui_queue.put({"type": "connection_failed", "message": error_msg})
-                    self.command_socket.close()
-            else:
-                 self.gui_queue.put({"type": "connection_failed", "message": "Неверный ответ от сервера."})
-                 self.command_socket.close()
-        except Exception as e:
-            logging.error(f"Ошибка подключения: {e}")
-            self.gui_queue.put({"type": "connection_failed", "message": str(e)})
-
-    # --- ИЗМЕНЕНО: Удалена старая логика обработки потока файла ---
-    def receive_messages(self):
-        buffer = b""
-        logging.info("Поток receive_messages запущен.")
-        while not self.stop_event.is_set():
-            try:
-                data_chunk = self.command_socket.recv(4096)
-                if not data_chunk:
-                    self.gui_queue.put({"type": "connection_error", "message": "Сервер разорвал соединение."})
-                    break
-                buffer += data_chunk
-                while b'\n' in buffer:
-                    line_bytes, buffer = buffer.split(b'\n', 1)
-                    line = line_bytes.decode('utf-8', errors='ignore').strip()
-                    if line:
-                        parsed = self.parse_server_line(line)
-                        if parsed: self.gui_queue.put(parsed)
-            except (socket.error, ConnectionResetError, BrokenPipeError):
-                if not self.stop_event.is_set():
-                    self.gui_queue.put({"type": "connection_error", "message": "Потеряно соединение с сервером."})
-                break
-            except Exception as e:
-                if not self.stop_event.is_set():
-                     logging.critical(f"Критическая ошибка в receive_messages: {e}", exc_info=True)
-                break
-        logging.info("Поток receive_messages завершен.")
-
-    # --- УДАЛЕНО: Метод handle_file_download_stream больше не нужен ---
-
-    # --- ИЗМЕНЕНО: Добавлена обработка DOWNLOAD_PROCEED ---
-    def parse_server_line(self, line: str):
-        parts = line.split(" ", 4)
-        command = parts[0]
-        handlers = {
-            "USER_LIST": lambda p: {"type": "user_list_update", "users": p[1].split(',') if len(p) > 1 else []},
-            "FILE_INCOMING": lambda p: {"type": "file_incoming", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
-            "UPLOAD_PROCEED": lambda p: {"type": "upload_proceed", "transfer_id": p[1], "port": int(p[2])},
-            "UPLOAD_REJECTED": lambda p: {"type": "upload_rejected", "reason": " ".join(p[1:])},
-            "DOWNLOAD_READY": lambda p: {"type": "download_ready", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
-            "DOWNLOAD_PROCEED": lambda p: {"type": "download_proceed", "transfer_id": p[1], "port": int(p[2])}, # НОВАЯ КОМАНДА
-            "SERVER_MSG": lambda p: {"type": "system_message", "text": " ".join(p[1:]), "class_key": "info_msg"}
-        }
-        if command in handlers: return handlers[command](parts)
-        match_msg = re.match(r"^\[(.*?)\]\s(\(PM от (.*?)\):|\(PM для (.*?)\):|(.*?):)\s(.*)$", line)
-        if match_msg:
-            ts, _, from_user_pm, to_user_pm, from_user_public, text = match_msg.groups()
-            partner = from_user_pm if from_user_pm else to_user_pm
-            if partner:
-                return {"type": "pm_message", "partner": partner, "text": text, "from_me": bool(to_user_pm)}
-            else:
-                 return {"type": "new_message", "username": from_user_public, "text": text, "timestamp": ts}
-        match_sys = re.match(r"^\[(.*?)\]\s\*\*\*\s(.*)\s\*\*\*$", line)
-        if match_sys: return {"type": "system_message", "text": match_sys.group(2), "class_key": "system_msg", "timestamp": match_sys.group(1)}
-        return {"type": "system_message", "text": line, "class_key": "info_msg"}
-
-    def _thread_keepalive(self):
-        while not self.stop_event.is_set():
-            if self.stop_event.wait(60): break
-            if self.send_message_to_server("/ping"):
-                logging.info("Keep-alive ping sent.")
-            else:
-                logging.warning("Keep-alive ping failed, connection seems lost.")
-                break
-    
-    # --- ИЗМЕНЕНО: Обновлен цикл обработки очереди ---
-    def process_gui_queue(self):
-        try:
-            while not self.gui_queue.empty():
-                data = self.gui_queue.get_nowait()
-                msg_type = data.get("type")
-                if msg_type == "connection_success":
-                    self.login_window.destroy()
-                    self.deiconify()
-                    self.build_chat_interface()
-                    self.display_system_message(data['message'], "success_msg")
-                    self.stop_event.clear()
-                    self.network_thread = threading.Thread(target=self.receive_messages, daemon=True)
-                    self.network_thread.start()
-                    keepalive_thread = threading.Thread(target=self._thread_keepalive, daemon=True)
-                    keepalive_thread.start()
-                elif msg_type == "connection_failed":
-                    self.status_label_login.config(text=f"Ошибка: {data['message']}", fg=CURRENT_THEME["ERROR"])
-                    self.connect_btn.config(state=tk.NORMAL)
-                    self.server_host = ""
-                    threading.Thread(target=self.find_server_udp, daemon=True).start()
-                elif msg_type == "connection_error": self.handle_disconnection(data.get("message"))
-                elif msg_type == "new_message": self.append_formatted_message(data['timestamp'], data['username'], data['text'])
-                elif msg_type == "system_message": self.display_system_message(data['text'], data.get('class_key', 'system_msg'), timestamp=data.get('timestamp'))
-                elif msg_type == "pm_message":
-                    if not self.pm_window: self.pm_window = PrivateMessageWindow(self, self)
-                    self.pm_window.handle_incoming_pm(data['partner'], data['text'], from_me=data['from_me'])
-                elif msg_type == "user_list_update":
-                    self.online_users = set(u for u in data.get("users", []) if u != self.username)
-                    self.update_user_listbox()
-                elif msg_type == "file_incoming": self.handle_file_incoming(data)
-                elif msg_type == "upload_proceed": self.handle_upload_proceed(data)
-                elif msg_type == "upload_rejected": NotificationHelper.show_toast(self, data['reason'], "warning")
-                elif msg_type == "download_ready": self.handle_download_ready(data)
-                elif msg_type == "download_proceed": self.handle_download_proceed(data) # НОВЫЙ ОБРАБОТЧИК
-                elif msg_type == "file_download_complete": NotificationHelper.show_toast(self, f"Файл '{data['filename']}' скачан!", "success")
-                elif msg_type == "file_download_error": NotificationHelper.show_toast(self, f"Ошибка скачивания: {data['error']}", "error")
-        except queue.Empty:
+            self.event_generate("<<GuiQueue>>", when="tail")
+        except (tk.TclError, RuntimeError):
             pass
+
+    def process_gui_queue(self, event=None):
+        # Модальные диалоги крутят вложенный цикл Tk; повторно в очередь не входим,
+        # внешний вызов сам запланирует следующий кадр.
+        if self.gui_processing: return
+        self.gui_processing = True
+        self.gui_wakeup_pending = False
+        if self.gui_frame_job:
+            self.after_cancel(self.gui_frame_job)
+            self.gui_frame_job = None
+        deadline = time.perf_counter() + FRAME_BUDGET
+        chat_messages = []
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    data = self.gui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if data.get("type") in CHAT_EVENT_TYPES:
+                    # Сообщения чата копим и вставляем одной операцией в конце кадра.
+                    chat_messages.append(self.format_chat_event(data))
+                    self.record_message(data)
+                    continue
+                if chat_messages:
+                    self.render_chat_messages(chat_messages)
+                    chat_messages = []
+                self.dispatch_gui_event(data)
+                self.record_message(data)
         finally:
-            if not self.stop_event.is_set():
-                self.after(100, self.process_gui_queue)
+            if chat_messages:
+                self.render_chat_messages(chat_messages)
+            self.gui_processing = False
+            if not self.closing:
+                # Не уложились в бюджет — остаток в следующем кадре; иначе ждём пробуждения.
+                delay = FRAME_INTERVAL if not self.gui_queue.empty() else IDLE_POLL_INTERVAL
+                self.gui_frame_job = self.after(delay, self.process_gui_queue)
+
+    def dispatch_gui_event(self, data):
+        msg_type = data.get("type")
+        if msg_type == "server_found":
+            self.server_host, self.server_port = data['host'], data['port']
+            if self.login_window.winfo_exists():
+                self.status_label_login.config(text=f"Сервер найден: {self.server_host}", fg=CURRENT_THEME["SUCCESS"])
+        elif msg_type == "discovery_error":
+            if self.login_window.winfo_exists():
+                self.status_label_login.config(text=f"Ошибка поиска сервера", fg=CURRENT_THEME["ERROR"])
+        elif msg_type == "connection_success":
+            self.connection_status = "connected"
+            USER_SETTINGS["last_server"] = [data['host'], data['port']]
+            self.login_window.destroy()
+            self.deiconify()
+            self.build_chat_interface()
+            self.restore_chat_history()
+            self.display_system_message(data['message'], "success_msg")
+        elif msg_type == "connection_failed":
+            self.status_label_login.config(text=f"Ошибка: {data['message']}", fg=CURRENT_THEME["ERROR"])
+            self.connect_btn.config(state=tk.NORMAL)
+            self.server_host = ""
+            self.network.discover()
+        elif msg_type == "connection_lost": self.handle_disconnection(data.get("message"))
+        elif msg_type == "reconnected": self.handle_reconnected(data['message'])
+        elif msg_type == "reconnect_failed": self.handle_reconnect_failed(data['message'])
+        elif msg_type in CHAT_EVENT_TYPES: self.render_chat_messages([self.format_chat_event(data)])
+        elif msg_type == "pm_message":
+            self.get_pm_window().handle_incoming_pm(data['partner'], data['text'], from_me=data['from_me'])
+        elif msg_type == "user_list_update":
+            self.online_users = set(u for u in data.get("users", []) if u != self.username)
+            self.update_user_listbox()
+        elif msg_type == "file_incoming":
+            self.get_pm_window().handle_incoming_pm(data['from_user'], self.file_offer_text(data), notify=False)
+            self.handle_file_incoming(data)
+        elif msg_type == "upload_proceed": self.handle_upload_proceed(data)
+        elif msg_type == "upload_rejected":
+            self.transfers.on_upload_rejected(data)
+            self.toasts.show(data['reason'], "warning")
+        elif msg_type == "download_ready":
+            if not self.transfers.on_download_ready(data): self.handle_download_ready(data)
+        elif msg_type == "direct_ready": self.handle_download_ready(data, direct=(data['host'], data['port'], data['token']))
+        elif msg_type == "direct_prepare": self.transfers.on_direct_prepare(data)
+        elif msg_type == "direct_listening": self.transfers.on_direct_listening(data)
+        elif msg_type == "download_proceed": self.handle_download_proceed(data) # НОВЫЙ ОБРАБОТЧИК
+        elif msg_type == "transfer_progress": self.transfers.on_progress(data)
+        elif msg_type == "file_cancelled":
+            item = self.transfers.on_remote_cancel(data)
+            if item: self.toasts.show(f"{data['by_user']} отменил передачу '{item['filename']}'", "warning")
+        elif msg_type == "file_download_complete":
+            self.toasts.show(f"Файл '{data['filename']}' скачан!", "success")
+        elif msg_type == "file_download_error":
+            self.toasts.show(f"Ошибка скачивания: {data['error']}", "error")
 
     def send_message_to_server(self, message: str):
-        if self.command_socket and self.connection_status == "connected":
-            try:
-                self.command_socket.sendall((message + "\n").encode("utf-8"))
-                return True
-            except socket.error as e:
-                self.handle_disconnection(f"Ошибка сети: {e}")
-                return False
-        return False
+        return self.network.send(message)
+
+    def record_message(self, data):
+        # Запись после отрисовки: диалог, впервые поднятый из истории, не получит дубль.
+        msg_type = data.get("type")
+        if msg_type == "new_message":
+            self.message_store.add(self.username, "chat", data['username'], data['text'])
+        elif msg_type == "pm_message":
+            sender = self.username if data['from_me'] else data['partner']
+            self.message_store.add(self.username, "pm", sender, data['text'], partner=data['partner'])
+        elif msg_type == "file_incoming":
+            self.message_store.add(self.username, "pm", data['from_user'], self.file_offer_text(data), partner=data['from_user'])
+
+    def file_offer_text(self, data):
+        return f"📎 Файл: {data['filename']} ({self._format_filesize(data['filesize'])})"
+
+    def jump_to_message(self, msg_id, channel, partner, sender, body):
+        # Одинаковые сообщения различаем по id строки в истории: столько же более новых повторов пропускаем в окне.
+        skip = self.message_store.newer_copies(msg_id, self.username, channel, partner, sender, body)
+        if channel == "chat":
+            self.lift()
+            found = self.chat_view.reveal(encode_message([(f"{sender}: ", ("username",)), (body + "\n", ())]), skip)
+        else:
+            self.get_pm_window().show_window(partner=partner)
+            tag = "me_msg" if sender == self.username else "partner_msg"
+            found = self.pm_window.chat_view.reveal(encode_message([(f"{body}\n\n", (tag,))]), skip)
+        if not found:
+            self.toasts.show("Сообщение старше загруженной в окно истории", "warning")
+
+    def restore_chat_history(self):
+        rows = self.message_store.load_dialog(self.username, "chat", limit=HISTORY_PRELOAD)
+        if not rows: return
+        history = deque(maxlen=SCROLLBACK_HISTORY_LIMIT)
+        for sender, body, ts in rows:
+            history.append(encode_message(self.format_chat_event({"type": "new_message", "timestamp": datetime.fromtimestamp(ts).strftime("%H:%M:%S"), "username": sender, "text": body})))
+        self.chat_view.attach(history)
+        self.display_system_message(f"Загружено из локальной истории: {len(rows)} сообщ.", "info_msg")
 
     def handle_file_incoming(self, data):
         response = messagebox.askyesno("Входящий файл", f"Пользователь {data['from_user']} хочет отправить вам файл:\n{data['filename']} ({self._format_filesize(data['filesize'])})\n\nПринять?", parent=self)
-        self.send_message_to_server(f"/{'file_accept' if response else 'file_reject'} {data['transfer_id']}")
+        self.send_message_to_server(self.transfers.accept_command(data['transfer_id']) if response else f"/file_reject {data['transfer_id']}")
 
     def handle_upload_proceed(self, data):
-        transfer_id = data['transfer_id']
-        port = data['port']
-        if self.pending_upload_queue:
-            info = self.pending_upload_queue.pop(0)
-            threading.Thread(target=self._thread_upload_file, 
-                             args=(transfer_id, info['filepath'], self.server_host, port), 
-                             daemon=True).start()
-        else:
-            logging.warning("Получено UPLOAD_PROCEED, но очередь отправки пуста. Нечего отправлять.")
-
-    def _thread_upload_file(self, transfer_id, filepath, host, port):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as upload_socket:
-                upload_socket.connect((host, port))
-                upload_socket.sendall(f"UPLOAD {transfer_id}\n".encode())
-                with open(filepath, "rb") as f:
-                    while chunk := f.read(4096):
-                        upload_socket.sendall(chunk)
-            self.gui_queue.put({"type": "system_message", "text": f"Файл {os.path.basename(filepath)} успешно загружен на сервер.", "class_key": "success_msg"})
-        except Exception as e:
-            self.gui_queue.put({"type": "system_message", "text": f"Ошибка загрузки файла: {e}", "class_key": "error_msg"})
+        self.transfers.on_upload_proceed(data)
 
-    # --- ИЗМЕНЕНО: Логика стала проще ---
-    def handle_download_ready(self, data):
+    def handle_download_ready(self, data, direct=None):
+        transfer_id = data['transfer_id']
+        save_path = None
         if messagebox.askyesno("Файл готов", f"Файл '{data['filename']}' от {data['from_user']} готов к скачиванию.\nНачать?", parent=self):
+            from tkinter import filedialog
             save_path = filedialog.asksaveasfilename(initialdir=USER_SETTINGS.get("default_download_path"), initialfile=data['filename'], parent=self)
-            if save_path:
-                # Сохраняем информацию о скачивании, чтобы использовать ее в новом потоке
-                self.pending_downloads[data['transfer_id']] = {
-                    'filename': data['filename'], 
-                    'filesize': data['filesize'],
-                    'local_filepath': save_path
-                }
-                self.send_message_to_server(f"/download {data['transfer_id']}")
-
-    # --- НОВЫЙ МЕТОД: Обработчик разрешения на скачивание ---
-    def handle_download_proceed(self, data):
-        transfer_id = data['transfer_id']
-        port = data['port']
-        if transfer_id in self.pending_downloads:
-            info = self.pending_downloads[transfer_id]
-            threading.Thread(target=self._thread_download_file, 
-                             args=(transfer_id, info, self.server_host, port), 
-                             daemon=True).start()
+        if save_path:
+            self.transfers.add_download(transfer_id, data['from_user'], data['filename'], data['filesize'], save_path, direct=direct, encoding=data.get('encoding', 'raw'))
         else:
-            logging.warning(f"Получено DOWNLOAD_PROCEED для неизвестного transfer_id: {transfer_id}")
+            self.send_message_to_server(f"/file_cancel {transfer_id}")
 
-    # --- НОВЫЙ МЕТОД: Поток для скачивания файла ---
-    def _thread_download_file(self, transfer_id, info, host, port):
-        local_filepath = info['local_filepath']
-        filesize = info['filesize']
-        filename = info['filename']
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as download_socket:
-                download_socket.connect((host, port))
-                download_socket.sendall(f"DOWNLOAD {transfer_id}\n".encode())
-                
-                bytes_received = 0
-                with open(local_filepath, "wb") as f:
-                    while bytes_received < filesize:
-                        bytes_to_read = min(4096, filesize - bytes_received)
-                        chunk = download_socket.recv(bytes_to_read)
-                        if not chunk:
-                            raise ConnectionError("Соединение потеряно во время скачивания.")
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-
-            if bytes_received == filesize:
-                self.gui_queue.put({"type": "file_download_complete", "filename": filename})
-            else:
-                raise IOError("Скачанный файл имеет неверный размер.")
+    def handle_download_proceed(self, data):
+        self.transfers.on_download_proceed(data)
 
-        except Exception as e:
-            self.gui_queue.put({"type": "file_download_error", "filename": filename, "error": str(e)})
-            if os.path.exists(local_filepath): os.remove(local_filepath)
-        finally:
-            self.pending_downloads.pop(transfer_id, None)
+    def on_transfer_changed(self, item):
+        if hasattr(self, 'transfer_panel') and self.transfer_panel.winfo_exists():
+            self.transfer_panel.update_transfer(item)
 
     def initiate_file_send(self, target_user=None, filepath=None):
         if not target_user:
@@ -628,16 +1010,12 @@ class ChatClientGUI(tk.Tk):
             return
 
         if not filepath:
+            from tkinter import filedialog
             filepath = filedialog.askopenfilename(title=f"Выберите файл для {target_user}", parent=self)
         if not filepath: return
 
-        filesize = os.path.getsize(filepath)
-        filename = os.path.basename(filepath)
-        
-        self.pending_upload_queue.append({'filepath': filepath})
-        
-        self.send_message_to_server(f"/upload {target_user} {filename} {filesize}")
-        self.display_system_message(f"Запрос на отправку файла '{filename}' пользователю {target_user} отправлен.", "info_msg")
+        item = self.transfers.add_upload(target_user, filepath)
+        self.display_system_message(f"Запрос на отправку файла '{item['filename']}' пользователю {target_user} отправлен.", "info_msg")
 
     def build_chat_interface(self):
         self.configure(bg=CURRENT_THEME["BG_COLOR"])
@@ -648,16 +1026,21 @@ class ChatClientGUI(tk.Tk):
         self.create_status_bar()
         self.status_label.config(text=f"Подключено: {self.server_host}:{self.server_port} | Вы: {self.username}", fg=CURRENT_THEME["SUCCESS"])
         self.connection_indicator.config(fg=CURRENT_THEME["SUCCESS"])
-        self.pm_window = PrivateMessageWindow(self, self)
+
+    def get_pm_window(self):
+        # Окно ЛС строится при первом обращении: в большинстве сеансов его не открывают.
+        if self.pm_window is None: self.pm_window = PrivateMessageWindow(self, self)
+        return self.pm_window
 
     def create_header_buttons(self, parent):
         bf = tk.Frame(parent, bg=CURRENT_THEME["HEADER_BG"])
         bf.pack(side=tk.RIGHT, padx=15)
         tk.Button(bf, text="✉️", font=("Arial", 16), bg=CURRENT_THEME["BTN_BG"], fg=CURRENT_THEME["BTN_TEXT"], relief=tk.FLAT, width=2, cursor="hand2", command=self.toggle_pm_window).pack(side=tk.LEFT, padx=5)
+        tk.Button(bf, text="🔍", font=("Arial", 16), bg=CURRENT_THEME["BTN_BG"], fg=CURRENT_THEME["BTN_TEXT"], relief=tk.FLAT, width=2, cursor="hand2", command=self.open_search).pack(side=tk.LEFT, padx=5)
         tk.Button(bf, text="⚙", font=("Arial", 16), bg=CURRENT_THEME["BTN_BG"], fg=CURRENT_THEME["BTN_TEXT"], relief=tk.FLAT, width=2, cursor="hand2", command=self.open_settings).pack(side=tk.LEFT, padx=5)
 
     def toggle_pm_window(self):
-        if not self.pm_window.winfo_viewable():
+        if not self.get_pm_window().winfo_viewable():
             self.pm_window.show_window()
         else:
             self.pm_window.hide_window()
@@ -666,6 +1049,8 @@ class ChatClientGUI(tk.Tk):
         self.sidebar = tk.Frame(self.main_container, bg=CURRENT_THEME["SIDEBAR_BG"], width=200)
         self.sidebar.pack(side=tk.RIGHT, fill=tk.Y, padx=(2,0))
         self.sidebar.pack_propagate(False)
+        self.transfer_panel = TransferPanel(self.sidebar, self)
+        self.transfer_panel.pack(side=tk.BOTTOM, fill=tk.X)
         tk.Label(self.sidebar, text="Онлайн:", bg=CURRENT_THEME["SIDEBAR_BG"],fg=CURRENT_THEME["TEXT_COLOR"], font=("Arial", 12, "bold")).pack(anchor=tk.W, padx=10, pady=(10,5))
         self.users_listbox = tk.Listbox(self.sidebar, bg=CURRENT_THEME["ENTRY_BG"], fg=CURRENT_THEME["ENTRY_FG"],selectbackground=CURRENT_THEME["ACCENT"], selectforeground="white",font=("Arial", self.font_size), relief=tk.FLAT, bd=0, highlightthickness=0,activestyle=tk.NONE, exportselection=False )
         self.users_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0,10))
@@ -675,7 +1060,7 @@ class ChatClientGUI(tk.Tk):
         if not self.users_listbox.curselection(): return
         username = self.users_listbox.get(self.users_listbox.curselection()[0]).replace(" (Вы)", "").strip()
         if username != self.username:
-            self.pm_window.show_window(partner=username)
+            self.get_pm_window().show_window(partner=username)
 
     def send_message(self, event=None):
         msg_text = self.msg_var.get().strip()
@@ -684,24 +1069,35 @@ class ChatClientGUI(tk.Tk):
             self.msg_var.set("")
 
     def handle_disconnection(self, reason):
-        if self.connection_status == "disconnected": return
+        if self.connection_status != "connected": return
+        self.connection_status = "reconnecting"
+        self.display_system_message(f"{reason} Переподключение...", "error_msg")
+        self.connection_indicator.config(fg=CURRENT_THEME["WARNING"])
+        self.status_label.config(text="Переподключение...", fg=CURRENT_THEME["WARNING"])
+
+    def handle_reconnected(self, message):
+        self.connection_status = "connected"
+        self.display_system_message(message, "success_msg")
+        self.connection_indicator.config(fg=CURRENT_THEME["SUCCESS"])
+        self.status_label.config(text=f"Подключено: {self.server_host}:{self.server_port} | Вы: {self.username}", fg=CURRENT_THEME["SUCCESS"])
+
+    def handle_reconnect_failed(self, reason):
         self.connection_status = "disconnected"
-        self.display_system_message(reason, "error_msg")
+        self.display_system_message(f"Не удалось переподключиться: {reason}", "error_msg")
         self.connection_indicator.config(fg=CURRENT_THEME["ERROR"])
         self.status_label.config(text="Соединение потеряно", fg=CURRENT_THEME["ERROR"])
         self.online_users.clear()
         self.update_user_listbox()
-        self.stop_event.set()
-        NotificationHelper.show_toast(self, "Соединение разорвано", "error")
+        self.toasts.show("Соединение разорвано", "error")
 
     def on_closing(self, from_login=False):
         if hasattr(self, 'main_container') and self.main_container.winfo_exists():
             USER_SETTINGS["window_geometry"] = self.geometry()
         save_settings(USER_SETTINGS)
-        self.stop_event.set()
-        if self.command_socket:
-            try: self.command_socket.close()
-            except: pass
+        self.connection_status = "disconnected"
+        self.closing = True
+        if self.network: self.network.stop()
+        if self.message_store: self.message_store.close()
         self.destroy()
 
     def update_user_listbox(self):
@@ -722,23 +1118,27 @@ class ChatClientGUI(tk.Tk):
             idx = list(self.users_listbox.get(0, tk.END)).index(selected_user)
             self.users_listbox.selection_set(idx)
 
-    def append_formatted_message(self, timestamp_str, user_str, message_str):
-        if not hasattr(self, 'text_area') or not self.text_area.winfo_exists(): return
-        self.text_area.config(state=tk.NORMAL)
-        self.text_area.insert(tk.END, f"[{timestamp_str}] ", ("timestamp",))
-        self.text_area.insert(tk.END, f"{user_str}: ", ("username",))
-        self.text_area.insert(tk.END, message_str + "\n")
-        if self.auto_scroll_enabled: self.text_area.yview(tk.END)
-        self.text_area.config(state=tk.DISABLED)
+    def format_chat_event(self, data):
+        if data["type"] == "new_message":
+            return [(f"[{data['timestamp']}] ", ("timestamp",)), (f"{data['username']}: ", ("username",)), (data['text'] + "\n", ())]
+        class_key = data.get('class_key', 'system_msg')
+        ts = data.get('timestamp') or datetime.now().strftime("%H:%M:%S")
+        return [(f"[{ts}] {data['text']}\n", (class_key,))]
 
-    def display_system_message(self, message, class_key="system_msg", timestamp=None):
+    def render_chat_messages(self, messages):
         if not hasattr(self, 'text_area') or not self.text_area.winfo_exists(): return
-        self.text_area.config(state=tk.NORMAL)
-        ts = timestamp if timestamp else datetime.now().strftime("%H:%M:%S")
+        self.chat_view.append(messages, autoscroll=self.auto_scroll_enabled)
+
+    def ensure_message_tags(self, tags):
+        for tag in tags:
+            if tag not in self.configured_tags: self.configure_message_tag(tag)
+
+    def configure_message_tag(self, class_key):
         self.text_area.tag_config(class_key, foreground=CURRENT_THEME.get(class_key.upper().replace("_MSG", ""), CURRENT_THEME["SYSTEM"]), font=("Arial", self.font_size, "italic"))
-        self.text_area.insert(tk.END, f"[{ts}] {message}\n", (class_key,))
-        if self.auto_scroll_enabled: self.text_area.yview(tk.END)
-        self.text_area.config(state=tk.DISABLED)
+        self.configured_tags.add(class_key)
+
+    def display_system_message(self, message, class_key="system_msg", timestamp=None):
+        self.render_chat_messages([self.format_chat_event({"type": "system_message", "text": message, "class_key": class_key, "timestamp": timestamp})])
     
     def _format_filesize(self, num_bytes):
         if num_bytes is None: return "N/A"
@@ -757,6 +1157,8 @@ class ChatClientGUI(tk.Tk):
         self.text_area.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
         self.text_area.tag_config("timestamp", foreground=CURRENT_THEME["TEXT_SECONDARY"])
         self.text_area.tag_config("username", foreground=CURRENT_THEME["ACCENT"], font=("Arial", self.font_size, "bold"))
+        self.configured_tags.update(("timestamp", "username"))
+        self.chat_view = ScrollbackView(self.text_area, tag_hook=self.ensure_message_tags)
 
     def create_input_area(self):
         self.input_frame = tk.Frame(self, bg=CURRENT_THEME["BG_COLOR"])
@@ -789,12 +1191,16 @@ class ChatClientGUI(tk.Tk):
 
     def open_settings(self):
         SettingsWindow(self, self)
+
+    def open_search(self):
+        SearchWindow(self, self)
         
 if __name__ == "__main__":
     try:
         app = ChatClientGUI()
         app.mainloop()
     except Exception as e:
+        setup_logging()
         logging.critical(f"Критическая ошибка приложения: {e}", exc_info=True)
         try:
             messagebox.showerror("Критическая ошибка", f"Произошла непредвиденная ошибка: {e}")
@@ -0,0 +1,109 @@
+"""Сжатие командного канала: сколько байт экономится и во что это обходится по CPU.
+
+Два наблюдателя получают один и тот же трафик сервера (общий чат, ЛС, вход и
+выход пользователей со списками USER_LIST): один подключён как старый клиент
+(CMD), другой со сжатием (CMD zlib). Затем записанные строки сжимаются заново
+на разных уровнях zlib, по одному Z_SYNC_FLUSH на сообщение, как это делает
+сервер, и считается время сжатия и распаковки на сообщение.
+"""
+import argparse
+import asyncio
+import time
+import zlib
+
+from common import login, start_server, stop_server
+
+
+async def login_compressed(host, port, username, timeout=10.0):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"CMD zlib\n")
+    await writer.drain()
+    request = (await asyncio.wait_for(reader.readline(), timeout)).decode().split()
+    if request != ["AUTH_REQUEST", "zlib"]:
+        raise RuntimeError(f"Сервер не согласился на сжатие: {request}")
+    compressor = zlib.compressobj()
+    writer.write(compressor.compress(f"{username}\n".encode()) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    await writer.drain()
+    return reader, writer
+
+
+async def record_traffic(messages, users):
+    chat_server, tcp_server = await start_server()
+    host, port = "127.0.0.1", chat_server.port
+    plain_reader, plain_writer = await login(host, port, "plain")
+    packed_reader, packed_writer = await login_compressed(host, port, "packed")
+    _, sender_writer = await login(host, port, "sender")
+    crowd = [(await login(host, port, f"user{i:03d}"))[1] for i in range(users)]
+
+    plain, packed = bytearray(), bytearray()
+    decompressor = zlib.decompressobj()
+
+    async def capture(reader, sink, inflate=None):
+        while chunk := await reader.read(65536):
+            sink.extend(chunk)
+            tail = inflate.decompress(chunk) if inflate else chunk
+            if b"__end__" in tail:
+                return
+
+    captures = [asyncio.create_task(capture(plain_reader, plain)),
+                asyncio.create_task(capture(packed_reader, packed, decompressor))]
+    for i in range(messages):
+        if i % 200 == 0:
+            # Вход и выход рассылают всем USER_LIST с полным списком имён.
+            _, churn_writer = await login(host, port, f"churn{i}")
+            churn_writer.close()
+        elif i % 10 == 0:
+            sender_writer.write(f"/pm plain личное сообщение номер {i}\n".encode())
+            sender_writer.write(f"/pm packed личное сообщение номер {i}\n".encode())
+        else:
+            sender_writer.write(f"Сообщение {i}: {'обычная переписка в общем чате ' * (1 + i % 4)}\n".encode())
+        if i % 200 == 0:
+            await sender_writer.drain()
+    sender_writer.write(b"__end__\n")
+    await sender_writer.drain()
+    await asyncio.wait_for(asyncio.gather(*captures), 60)
+
+    for writer in [plain_writer, packed_writer, sender_writer] + crowd:
+        writer.close()
+    await stop_server(tcp_server)
+    return bytes(plain), bytes(packed)
+
+
+def measure_level(lines, level):
+    compressor = zlib.compressobj(level)
+    decompressor = zlib.decompressobj()
+    wire = 0
+    compress_time = decompress_time = 0.0
+    for line in lines:
+        started = time.perf_counter()
+        frame = compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed = time.perf_counter()
+        decompressor.decompress(frame)
+        decompress_time += time.perf_counter() - compressed
+        compress_time += compressed - started
+        wire += len(frame)
+    return wire, compress_time, decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000, help="сообщений в записи трафика")
+    parser.add_argument("--users", type=int, default=100, help="молчащих пользователей (длина USER_LIST)")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6, 9], help="уровни zlib для сравнения")
+    args = parser.parse_args()
+
+    plain, packed = asyncio.run(record_traffic(args.messages, args.users))
+    print(f"Живой сервер: без сжатия {len(plain) / 1024:.0f} КБ, со сжатием {len(packed) / 1024:.0f} КБ "
+          f"({len(packed) / len(plain):.1%}, экономия {(len(plain) - len(packed)) / 1024:.0f} КБ)")
+
+    lines = [line + b"\n" for line in plain.split(b"\n") if line]
+    raw = sum(len(line) for line in lines)
+    print(f"Повтор {len(lines)} сообщений ({raw / 1024:.0f} КБ), Z_SYNC_FLUSH на каждое:")
+    for level in args.levels:
+        wire, compress_time, decompress_time = measure_level(lines, level)
+        print(f"  уровень {level}: {wire / raw:.1%} объёма, сжатие {compress_time / len(lines) * 1e6:.1f} мкс/сообщ., "
+              f"распаковка {decompress_time / len(lines) * 1e6:.1f} мкс/сообщ.")
+
+
+if __name__ == "__main__":
+    main()
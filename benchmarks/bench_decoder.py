@@ -0,0 +1,132 @@
+"""Скорость разбора входящего потока клиентом, строк в секунду.
+
+Сначала записывается настоящий трафик сервера: наблюдатель получает общий
+чат, ЛС, списки пользователей и системные сообщения. Затем запись подаётся
+кусками прежнему разбору (bytes += и split, словарь обработчиков на каждую
+строку) и LineDecoder с parse_server_line из network_core.
+"""
+import argparse
+import asyncio
+import re
+import time
+
+from common import login, start_server, stop_server
+
+from network_core import LineDecoder, parse_server_line
+
+
+async def record_traffic(messages):
+    chat_server, tcp_server = await start_server()
+    host, port = "127.0.0.1", chat_server.port
+    observer_reader, observer_writer = await login(host, port, "observer")
+    _, sender_writer = await login(host, port, "sender")
+
+    recorded = bytearray()
+
+    async def capture():
+        while chunk := await observer_reader.read(65536):
+            recorded.extend(chunk)
+            if b"__end__" in recorded[-256:]:
+                return
+
+    capture_task = asyncio.create_task(capture())
+    for i in range(messages):
+        if i % 250 == 0:
+            # Вход и выход дают системные сообщения и USER_LIST.
+            _, churn_writer = await login(host, port, f"churn{i}")
+            churn_writer.close()
+        elif i % 10 == 0:
+            sender_writer.write(f"/pm observer личное сообщение номер {i}\n".encode())
+        else:
+            sender_writer.write(f"Сообщение {i}: {'текст переписки ' * (1 + i % 8)}\n".encode())
+        if i % 500 == 0:
+            await sender_writer.drain()
+    sender_writer.write(b"__end__\n")
+    await sender_writer.drain()
+    await asyncio.wait_for(capture_task, 60)
+
+    for writer in (observer_writer, sender_writer):
+        writer.close()
+    await stop_server(tcp_server)
+    return bytes(recorded)
+
+
+def legacy_parse_server_line(line):
+    parts = line.split(" ", 4)
+    command = parts[0]
+    handlers = {
+        "USER_LIST": lambda p: {"type": "user_list_update", "users": p[1].split(',') if len(p) > 1 else []},
+        "FILE_INCOMING": lambda p: {"type": "file_incoming", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
+        "UPLOAD_PROCEED": lambda p: {"type": "upload_proceed", "transfer_id": p[1], "port": int(p[2])},
+        "UPLOAD_REJECTED": lambda p: {"type": "upload_rejected", "reason": " ".join(p[1:])},
+        "DOWNLOAD_READY": lambda p: {"type": "download_ready", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
+        "DOWNLOAD_PROCEED": lambda p: {"type": "download_proceed", "transfer_id": p[1], "port": int(p[2])},
+        "SERVER_MSG": lambda p: {"type": "system_message", "text": " ".join(p[1:]), "class_key": "info_msg"}
+    }
+    if command in handlers: return handlers[command](parts)
+    match_msg = re.match(r"^\[(.*?)\]\s(\(PM от (.*?)\):|\(PM для (.*?)\):|(.*?):)\s(.*)$", line)
+    if match_msg:
+        ts, _, from_user_pm, to_user_pm, from_user_public, text = match_msg.groups()
+        partner = from_user_pm if from_user_pm else to_user_pm
+        if partner:
+            return {"type": "pm_message", "partner": partner, "text": text, "from_me": bool(to_user_pm)}
+        return {"type": "new_message", "username": from_user_public, "text": text, "timestamp": ts}
+    match_sys = re.match(r"^\[(.*?)\]\s\*\*\*\s(.*)\s\*\*\*$", line)
+    if match_sys: return {"type": "system_message", "text": match_sys.group(2), "class_key": "system_msg", "timestamp": match_sys.group(1)}
+    return {"type": "system_message", "text": line, "class_key": "info_msg"}
+
+
+def legacy_decode(chunks):
+    events = []
+    buffer = b""
+    for data_chunk in chunks:
+        buffer += data_chunk
+        while b'\n' in buffer:
+            line_bytes, buffer = buffer.split(b'\n', 1)
+            line = line_bytes.decode('utf-8', errors='ignore').strip()
+            if line:
+                events.append(legacy_parse_server_line(line))
+    return events
+
+
+def streaming_decode(chunks):
+    events = []
+    decoder = LineDecoder()
+    for data_chunk in chunks:
+        for line in decoder.feed(data_chunk):
+            if line:
+                events.append(parse_server_line(line))
+    return events
+
+
+def measure(title, decode, chunks, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        events = decode(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{title}: {len(events)} строк за {best * 1000:.1f} мс, {len(events) / best:,.0f} строк/с")
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="сообщений в записи трафика")
+    parser.add_argument("--chunk", type=int, nargs="+", default=[4096, 65536, 1 << 20], help="размеры кусков при подаче записи")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    traffic = asyncio.run(record_traffic(args.messages))
+    line_count = traffic.count(b"\n")
+    print(f"Записано {len(traffic) / 1024:.0f} КБ, {line_count} строк")
+    for size in args.chunk:
+        chunks = [traffic[i:i + size] for i in range(0, len(traffic), size)]
+        print(f"--- кусками по {size} байт")
+        legacy = measure("Прежний разбор", legacy_decode, chunks, args.repeat)
+        current = measure("LineDecoder   ", streaming_decode, chunks, args.repeat)
+        assert legacy == current, "Разборы разошлись"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Задержка входа и отключения, пока один клиент не читает свой сокет: прежний сервер против текущего.
+
+Медленный клиент отправляет файл, получатель его принимает, и сервер пишет
+UPLOAD_PROCEED в забитый сокет. Прежний сервер (одна блокировка на всё,
+запись в сокет с drain() под ней) при этом подвешивал все входы и отключения;
+у текущего задержка не должна зависеть от медленного клиента. Обе версии
+проходят одну и ту же нагрузку, в конце — задержки и их отношение.
+
+Прежний сервер — single_lock_server.py рядом (командный канал до разделения
+блокировок); с --current-only меряется только текущий.
+
+    python bench_lock_contention.py --clients 50 --timeout 5
+"""
+import argparse
+import asyncio
+import logging
+import socket
+import statistics
+
+import single_lock_server
+from common import Stopwatch, login, read_until, report, start_server, stop_server
+
+
+async def open_stalled_client(host, port, username):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    writer.write(f"CMD\n{username}\n".encode())
+    await writer.drain()
+    return reader, writer
+
+
+async def discard(reader):
+    while await reader.read(65536):
+        pass
+
+
+def is_online(chat_server, username):
+    return any(client.get("username") == username for client in list(chat_server.connected_clients.values()))
+
+
+async def run(args, module=None):
+    # Возвращает (входы, отключения, заблокирован ли сервер).
+    chat_server, tcp_server = await (start_server(module=module) if module else start_server())
+    host, port = "127.0.0.1", chat_server.port
+    writers = []
+
+    _, slow_writer = await open_stalled_client(host, port, "slowpoke")
+    receiver_reader, receiver_writer = await login(host, port, "receiver")
+    flood_reader, flood_writer = await login(host, port, "flooder")
+    writers += [slow_writer, receiver_writer, flood_writer]
+    await asyncio.sleep(0.2)
+
+    slow_writer.write(b"/upload receiver big.bin 1000000\n")
+    await slow_writer.drain()
+    incoming = await read_until(receiver_reader, "FILE_INCOMING")
+    transfer_id = incoming.split()[-1]
+
+    # Остальные клиенты читают всё, что приходит, чтобы не заблокироваться самим.
+    drain_tasks = [asyncio.create_task(discard(r)) for r in (receiver_reader, flood_reader)]
+
+    # Забиваем сокет медленного клиента широковещательными сообщениями,
+    # оставаясь ниже порога отключения SEND_BUFFER_LIMIT. Прежний сервер сам
+    # перестаёт читать рассылающего, поэтому долго не ждём.
+    payload = b"x" * 1000 + b"\n"
+    flood_writer.write(payload * args.flood_kb)
+    try:
+        await asyncio.wait_for(flood_writer.drain(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    await asyncio.sleep(0.5)
+
+    receiver_writer.write(f"/file_accept {transfer_id}\n".encode())
+    await receiver_writer.drain()
+    await asyncio.sleep(0.1)
+
+    login_times, logout_times, blocked = [], [], False
+    for i in range(args.clients):
+        name = f"user{i}"
+        try:
+            with Stopwatch() as sw:
+                _, writer = await login(host, port, name, timeout=args.timeout)
+        except asyncio.TimeoutError:
+            print(f"  {name}: вход не завершился за {args.timeout} с — сервер заблокирован")
+            blocked = True
+            break
+        login_times.append(sw.elapsed)
+        writers.append(writer)
+        with Stopwatch() as sw:
+            writer.close()
+            await writer.wait_closed()
+            deadline = asyncio.get_running_loop().time() + args.timeout
+            while is_online(chat_server, name) and asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(0.001)
+        if is_online(chat_server, name):
+            print(f"  {name}: отключение не обработано за {args.timeout} с — сервер заблокирован")
+            blocked = True
+            break
+        logout_times.append(sw.elapsed)
+
+    report("  Вход при заблокированном клиенте", login_times)
+    report("  Отключение при заблокированном клиенте", logout_times)
+
+    for task in drain_tasks:
+        task.cancel()
+    for writer in writers:
+        writer.transport.abort()
+    await stop_server(tcp_server)
+    return login_times, logout_times, blocked
+
+
+def compare(title, baseline, current, baseline_blocked, timeout):
+    if not current:
+        print(f"{title}: у текущего сервера нет данных")
+        return
+    now = statistics.median(current)
+    if baseline:
+        print(f"{title}: p50 {statistics.median(baseline) * 1000:.2f} мс -> {now * 1000:.2f} мс, "
+              f"в {statistics.median(baseline) / now:.1f} раза быстрее"
+              + (f" (прежний сервер заблокировался, замеров: {len(baseline)})" if baseline_blocked else ""))
+    elif baseline_blocked:
+        print(f"{title}: прежний сервер не ответил за {timeout} с, текущий — p50 {now * 1000:.2f} мс "
+              f"(не меньше чем в {timeout / now:.0f} раз быстрее)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--flood-kb", type=int, default=3000, help="объём рассылки для забивания сокета, КБ")
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--current-only", action="store_true", help="не запускать прежний сервер с единой блокировкой")
+    args = parser.parse_args()
+
+    baseline = not args.current_only
+    if baseline:
+        print("Прежний сервер, единая блокировка:")
+        # Зависшие обработчики прежнего сервера снимаются отменой и обрывом соединений;
+        # его журнал без настройки ушёл бы трассировками в консоль.
+        logging.disable(logging.CRITICAL)
+        old_logins, old_logouts, old_blocked = asyncio.run(run(args, single_lock_server))
+        logging.disable(logging.NOTSET)
+    print("Текущий сервер, раздельные блокировки:")
+    logins, logouts, _ = asyncio.run(run(args))
+
+    if baseline:
+        print("Сравнение:")
+        compare("  Вход", old_logins, logins, old_blocked, args.timeout)
+        compare("  Отключение", old_logouts, logouts, old_blocked, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
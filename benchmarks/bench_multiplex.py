@@ -0,0 +1,100 @@
+"""Отдельные соединения на каждую передачу против одного мультиплексированного (MUX).
+
+Два клиента как в GUI.py входят через прокси с ухудшением связи
+(impairment_proxy.py), сначала с отдельными соединениями, потом с MUX.
+Меряется время доставки пачки мелких файлов, которые идут параллельно, и
+задержка эха сообщений общего чата, пока тот же клиент отправляет крупные
+файлы. Число TCP-соединений считает прокси.
+
+    python bench_multiplex.py --profile wifi --files 40 --parallel 8
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from bench_wifi import chat_latency
+from common import Peer, report, start_impaired_server, stop_server
+
+
+async def deliver(alice, bob, paths, timeout):
+    started = time.perf_counter()
+    for path in paths:
+        alice.upload("bob", path)
+    targets = [os.path.join(bob.download_dir, os.path.basename(path)) for path in paths]
+    deadline = started + timeout
+    while not all(target in bob.finished for target in targets) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.02)
+    done = [bob.finished[target] for target in targets if target in bob.finished and bob.finished[target][0] == "done"]
+    return len(done), (max(finished for _, finished, _ in done) - started) if done else 0.0
+
+
+async def run_mode(multiplex, args, small, large):
+    chat_server, tcp_server, proxy = await start_impaired_server(args.profile, seed=args.seed)
+    alice = Peer("alice", multiplex=multiplex, max_transfers=args.parallel)
+    bob = Peer("bob", multiplex=multiplex, max_transfers=args.parallel)
+    for peer in (alice, bob):
+        peer.start(proxy.port)
+        if not await asyncio.to_thread(peer.connected.wait, 30):
+            raise RuntimeError(f"{peer.name} не подключился через прокси ({args.profile})")
+    connections = proxy.stats["connections"]
+
+    delivered, elapsed = await deliver(alice, bob, small, args.timeout)
+    small_connections = proxy.stats["connections"] - connections
+
+    idle = await chat_latency(alice, args.messages, args.interval, "idle")
+    bulk = asyncio.ensure_future(deliver(alice, bob, large, args.timeout))
+    await asyncio.sleep(0.5)  # передачи успевают разогнаться
+    busy = await chat_latency(alice, args.messages, args.interval, "busy")
+    large_delivered, large_elapsed = await bulk
+
+    for peer in (alice, bob):
+        await asyncio.to_thread(peer.stop)
+    await proxy.stop()
+    await stop_server(tcp_server)
+
+    print(f"\n[{'MUX' if multiplex else 'отдельные соединения'}] {proxy.impairment.describe() or 'без ухудшений'}")
+    print(f"  Мелкие файлы: доставлено {delivered}/{len(small)} по {args.small} КБ за {elapsed:.2f} с, "
+          f"новых TCP-соединений: {small_connections}")
+    report("  Эхо, канал свободен", idle)
+    report("  Эхо во время отправки крупных файлов", busy)
+    print(f"  Крупные файлы: доставлено {large_delivered}/{len(large)} по {args.large} МБ за {large_elapsed:.2f} с, "
+          f"всего TCP-соединений: {proxy.stats['connections']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="wifi", help="профиль или набор параметров прокси")
+    parser.add_argument("--files", type=int, default=40, help="число мелких файлов")
+    parser.add_argument("--small", type=int, default=64, help="размер мелкого файла, КБ")
+    parser.add_argument("--large", type=float, default=4.0, help="размер крупного файла, МБ")
+    parser.add_argument("--large-count", type=int, default=2, help="число крупных файлов, идущих во время замера чата")
+    parser.add_argument("--parallel", type=int, default=8, help="одновременных передач на клиента")
+    parser.add_argument("--messages", type=int, default=40, help="сообщений в каждом замере задержки")
+    parser.add_argument("--interval", type=float, default=0.05, help="пауза между сообщениями, с")
+    parser.add_argument("--timeout", type=float, default=120.0, help="сколько ждать доставки, с")
+    parser.add_argument("--seed", type=int, default=1, help="зерно случайностей прокси")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-mux-")
+    try:
+        small = []
+        for i in range(args.files):
+            small.append(os.path.join(workdir, f"small{i}.bin"))
+            with open(small[-1], "wb") as f:
+                f.write(os.urandom(args.small * 1024))
+        large = []
+        for i in range(args.large_count):
+            large.append(os.path.join(workdir, f"large{i}.bin"))
+            with open(large[-1], "wb") as f:
+                f.write(os.urandom(int(args.large * 1024 * 1024)))
+        for multiplex in (False, True):
+            asyncio.run(run_mode(multiplex, args, small, large))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
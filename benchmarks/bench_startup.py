@@ -0,0 +1,98 @@
+"""Время запуска GUI-клиента: до первой отрисовки окна входа и до подключения.
+
+Каждый прогон — новый процесс Python с GUI.py в пустой временной папке (без
+настроек и истории). Отметки считаются от запуска процесса: импорт GUI,
+первая отрисовка окна входа (Expose), запуск сетевого ядра и появление окна
+чата после входа. Вход нажимается сразу после первой отрисовки, к локальному
+серверу бенчмарка, без автообнаружения. Нужен дисплей (или Xvfb).
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from common import report, start_server, stop_server
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+HARNESS = r"""
+import json, sys, time
+started, port, username = float(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+sys.path.insert(0, sys.argv[4])
+import GUI
+marks = {"import": time.time() - started}
+app = GUI.ChatClientGUI()
+
+def painted(event):
+    if "first_paint" in marks: return
+    marks["first_paint"] = time.time() - started
+    app.server_host, app.server_port = "127.0.0.1", port
+    app.name_var.set(username)
+    app.after_idle(connect)
+
+def connect():
+    if app.network is None:
+        app.after(1, connect)
+        return
+    marks.setdefault("backend", time.time() - started)
+    app.on_connect()
+    wait_connected()
+
+def wait_connected():
+    if app.connection_status != "connected":
+        app.after(1, wait_connected)
+        return
+    app.update_idletasks()
+    marks["connected"] = time.time() - started
+    print(json.dumps(marks), flush=True)
+    app.on_closing()
+
+app.login_window.bind("<Expose>", painted, add="+")
+app.after(30000, app.on_closing)
+app.mainloop()
+"""
+
+MARKS = (("import", "Импорт GUI"), ("first_paint", "Первая отрисовка окна входа"),
+         ("backend", "Сетевое ядро запущено"), ("connected", "Окно чата после входа"))
+
+
+async def run_once(port, username):
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", HARNESS, str(time.time()), str(port), username, str(REPO_ROOT),
+            cwd=workdir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+    lines = stdout.decode().strip().splitlines()
+    if process.returncode or not lines:
+        raise RuntimeError(f"Клиент не запустился (код {process.returncode}):\n{stderr.decode().strip()}")
+    return json.loads(lines[-1])
+
+
+async def run(args):
+    chat_server, tcp_server = await start_server()
+    samples = {name: [] for name, _ in MARKS}
+    try:
+        for i in range(args.runs):
+            marks = await run_once(chat_server.port, f"startup{i}")
+            for name, value in marks.items():
+                samples[name].append(value)
+    finally:
+        await stop_server(tcp_server)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="число запусков клиента")
+    args = parser.parse_args()
+
+    samples = asyncio.run(run(args))
+    for name, title in MARKS:
+        report(title, samples[name])
+
+
+if __name__ == "__main__":
+    main()
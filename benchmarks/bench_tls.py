@@ -0,0 +1,110 @@
+"""Цена шифрования: рукопожатия TLS и передача файлов с TLS и без.
+
+Поднимается сервер с TLS (самоподписанный сертификат во временной папке).
+Сначала меряется время от подключения до AUTH_REQUEST: без шифрования,
+с полным рукопожатием TLS и с возобновлением сессии по билету — так
+переподключаются клиенты и открываются короткие соединения UPLOAD/DOWNLOAD.
+Затем два клиента как в GUI.py передают файл через сервер без шифрования и
+с ним; разница пересчитывается в миллисекунды на мегабайт.
+
+    python bench_tls.py --handshakes 200 --size 64 --runs 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from common import Peer, report, start_server, stop_server
+
+from tls_transport import TlsClientContext, TlsServer, ensure_certificate
+
+
+async def connect_once(port, tls=None):
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=tls, server_hostname="127.0.0.1" if tls else None)
+    writer.write(b"CMD\n")
+    await reader.readline()
+    elapsed = time.perf_counter() - started
+    if tls:
+        tls.remember(writer.get_extra_info("ssl_object"), "127.0.0.1")
+    writer.close()
+    await writer.wait_closed()
+    return elapsed
+
+
+async def handshakes(args, certs):
+    chat_server, tcp_server = await start_server(tls=TlsServer(*certs))
+    shared = TlsClientContext()
+    await connect_once(chat_server.tls.port, shared)  # первое полное рукопожатие даёт билет
+    plain, full, resumed = [], [], []
+    for _ in range(args.handshakes):
+        plain.append(await connect_once(chat_server.port))
+        full.append(await connect_once(chat_server.tls.port, TlsClientContext()))
+        resumed.append(await connect_once(chat_server.tls.port, shared))
+    chat_server.tls_server.close()
+    await stop_server(tcp_server)
+
+    print(f"Подключение до AUTH_REQUEST, {args.handshakes} раз:")
+    report("  Без шифрования", plain)
+    report("  TLS, полное рукопожатие", full)
+    report("  TLS, возобновление сессии", resumed)
+    base = statistics.median(plain)
+    print(f"  Цена рукопожатия: полное +{(statistics.median(full) - base) * 1000:.2f} мс, "
+          f"возобновлённое +{(statistics.median(resumed) - base) * 1000:.2f} мс; "
+          f"возобновилось {chat_server.tls.resumed} из {args.handshakes + 1} сессий общего контекста")
+
+
+async def transfer_once(tls, args, certs, source):
+    chat_server, tcp_server = await start_server(tls=TlsServer(*certs))
+    alice = Peer("alice", multiplex=args.multiplex, tls=tls)
+    bob = Peer("bob", multiplex=args.multiplex, tls=tls)
+    try:
+        for peer in (alice, bob):
+            peer.start(chat_server.port)
+            if not await asyncio.to_thread(peer.connected.wait, 30):
+                raise RuntimeError(f"{peer.name} не подключился ({'TLS' if tls else 'без шифрования'})")
+        started = time.perf_counter()
+        alice.upload("bob", source)
+        target = os.path.join(bob.download_dir, os.path.basename(source))
+        while target not in bob.finished and time.perf_counter() < started + args.timeout:
+            await asyncio.sleep(0.01)
+        state, finished, _ = bob.finished.get(target, ("timeout", time.perf_counter(), 0))
+        if state != "done":
+            raise RuntimeError(f"Файл не доставлен: {state}")
+        return finished - started
+    finally:
+        for peer in (alice, bob):
+            await asyncio.to_thread(peer.stop)
+        chat_server.tls_server.close()
+        await stop_server(tcp_server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handshakes", type=int, default=200, help="подключений каждого вида")
+    parser.add_argument("--size", type=float, default=64.0, help="размер файла, МБ")
+    parser.add_argument("--runs", type=int, default=3, help="передач с шифрованием и без")
+    parser.add_argument("--multiplex", action="store_true", help="передачи потоками одного соединения (MUX)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="сколько ждать доставки, с")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-tls-") as workdir:
+        certs = ensure_certificate(workdir)
+        asyncio.run(handshakes(args, certs))
+
+        source = os.path.join(workdir, "payload.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+        size = os.path.getsize(source) / 1024 / 1024
+        times = {}
+        for tls in (False, True):
+            times[tls] = statistics.median(asyncio.run(transfer_once(tls, args, certs, source)) for _ in range(args.runs))
+            print(f"{'TLS' if tls else 'Без шифрования':<16} медиана {times[tls]:.2f} с, {size / times[tls]:.1f} МБ/с")
+        print(f"Шифрование добавляет {(times[True] - times[False]) * 1000 / size:.2f} мс на МБ "
+              f"(отправка на сервер и скачивание, x{times[True] / times[False]:.2f} ко времени без шифрования)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Скорость передачи файла через сервер с разными профилями транспорта.
+
+Для каждого набора профилей (transport_profiles.py) поднимается свежий
+сервер, и два клиента как в GUI.py с тем же набором передают файл через
+сервер: отправка на сервер и скачивание получателем. legacy — куски по 4 КБ
+без настройки сокетов, как было до профилей; с ним сравниваются остальные.
+С --impair всё идёт через прокси с ухудшением связи.
+
+    python bench_transport.py --presets legacy system tuned wifi --size 64 --runs 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from common import Peer, start_impaired_server, start_server, stop_server
+
+from transport_profiles import TransportProfiles
+
+
+async def run_once(spec, args, source):
+    profiles = TransportProfiles.parse(spec)
+    if args.impair:
+        chat_server, tcp_server, proxy = await start_impaired_server(args.impair, transport_profiles=profiles)
+        port = proxy.port
+    else:
+        chat_server, tcp_server = await start_server(transport_profiles=profiles)
+        proxy, port = None, chat_server.port
+    alice = Peer("alice", multiplex=args.multiplex, transport_profiles=TransportProfiles.parse(spec))
+    bob = Peer("bob", multiplex=args.multiplex, transport_profiles=TransportProfiles.parse(spec))
+    try:
+        for peer in (alice, bob):
+            peer.start(port)
+            if not await asyncio.to_thread(peer.connected.wait, 30):
+                raise RuntimeError(f"{peer.name} не подключился ({spec})")
+        started = time.perf_counter()
+        alice.upload("bob", source)
+        target = os.path.join(bob.download_dir, os.path.basename(source))
+        while target not in bob.finished and time.perf_counter() < started + args.timeout:
+            await asyncio.sleep(0.01)
+        state, finished, _ = bob.finished.get(target, ("timeout", time.perf_counter(), 0))
+        if state != "done":
+            raise RuntimeError(f"Файл не доставлен ({spec}): {state}")
+        return finished - started
+    finally:
+        for peer in (alice, bob):
+            await asyncio.to_thread(peer.stop)
+        if proxy:
+            await proxy.stop()
+        await stop_server(tcp_server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--presets", nargs="+", default=["legacy", "system", "tuned", "wifi"], help="наборы профилей, можно с поправками: tuned,bulk.cork=0")
+    parser.add_argument("--size", type=float, default=64.0, help="размер файла, МБ")
+    parser.add_argument("--runs", type=int, default=3, help="передач на каждый набор")
+    parser.add_argument("--impair", metavar="PROFILE", help="через прокси с ухудшением связи, например wifi")
+    parser.add_argument("--multiplex", action="store_true", help="передачи потоками одного соединения (MUX)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="сколько ждать доставки, с")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(prefix="bench-transport-", suffix=".bin", delete=False) as f:
+        f.write(os.urandom(int(args.size * 1024 * 1024)))
+    size = os.path.getsize(f.name)
+    baseline = None
+    try:
+        for spec in args.presets:
+            times = [asyncio.run(run_once(spec, args, f.name)) for _ in range(args.runs)]
+            rate = size / statistics.median(times) / 1024 / 1024
+            baseline = baseline or rate
+            print(f"{spec:<24} медиана {statistics.median(times):.2f} с, {rate:.1f} МБ/с "
+                  f"(x{rate / baseline:.2f} к {args.presets[0]}), лучший {min(times):.2f} с")
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Чат и передачи файлов через прокси с ухудшением связи (impairment_proxy.py).
+
+Для каждого профиля поднимается свежий сервер за прокси, и два клиента как в
+GUI.py (ClientNetworkCore + TransferManager) входят через прокси. Меряется
+задержка эха сообщений общего чата, пока канал свободен и пока по нему идёт
+файл, и время доставки файла от начала отправки до конца скачивания
+получателем. Передачи идут через сервер: прямая передача обошла бы прокси.
+
+    python bench_wifi.py --profiles lan wifi busy_wifi "latency=80,jitter=40,bandwidth=3"
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import Peer, report, start_impaired_server, stop_server
+
+
+async def chat_latency(sender, count, interval, tag):
+    # Задержка от отправки до эха самому себе; сообщения без эха за 30 с считаются потерянными.
+    sent = {}
+    for i in range(count):
+        text = f"{tag} {i} {'текст сообщения ' * 4}".strip()
+        sent[text] = time.perf_counter()
+        sender.core.send(text)
+        await asyncio.sleep(interval)
+    deadline = time.perf_counter() + 30
+    while len([text for text in sent if text in sender.echoes]) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    return [sender.echoes[text] - started for text, started in sent.items() if text in sender.echoes]
+
+
+async def run_profile(spec, args, source):
+    chat_server, tcp_server, proxy = await start_impaired_server(spec, seed=args.seed)
+    alice, bob = Peer("alice", args.compress, args.multiplex), Peer("bob", args.compress, args.multiplex)
+    for peer in (alice, bob):
+        peer.start(proxy.port)
+        if not await asyncio.to_thread(peer.connected.wait, 30):
+            raise RuntimeError(f"{peer.name} не подключился через прокси ({spec})")
+
+    idle = await chat_latency(alice, args.messages, args.interval, "idle")
+
+    started = time.perf_counter()
+    alice.upload("bob", source)
+    # Пока файл идёт, тот же клиент пишет в чат: видно, как передача задерживает сообщения.
+    busy = await chat_latency(alice, args.messages, args.interval, "busy")
+    target = os.path.join(bob.download_dir, os.path.basename(source))
+    deadline = started + args.timeout
+    while target not in bob.finished and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    state, finished, wire = bob.finished.get(target, ("timeout", time.perf_counter(), 0))
+
+    for peer in (alice, bob):
+        await asyncio.to_thread(peer.stop)
+    await proxy.stop()
+    await stop_server(tcp_server)
+
+    print(f"\n[{spec}] {proxy.impairment.describe() or 'без ухудшений'}")
+    report("  Эхо, канал свободен", idle)
+    report("  Эхо во время передачи", busy)
+    print(f"  Потеряно эх: {2 * args.messages - len(idle) - len(busy)}, переподключений: {alice.reconnects + bob.reconnects}, "
+          f"неудачных входов: {alice.failed_connects + bob.failed_connects}, "
+          f"обрывов прокси: {proxy.stats['resets']}, пауз на повтор: {proxy.stats['stalls']}")
+    size = os.path.getsize(source)
+    if state == "done":
+        elapsed = finished - started
+        print(f"  Файл {size / 1024 / 1024:.1f} МБ доставлен за {elapsed:.2f} с ({size / elapsed / 1024 / 1024:.2f} МБ/с, по сети {wire / 1024 / 1024:.1f} МБ)")
+    else:
+        print(f"  Файл {size / 1024 / 1024:.1f} МБ не доставлен: {state}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=["lan", "wifi", "busy_wifi", "bad_wifi"], help="профили или наборы параметров прокси")
+    parser.add_argument("--messages", type=int, default=50, help="сообщений в каждом замере задержки")
+    parser.add_argument("--interval", type=float, default=0.05, help="пауза между сообщениями, с")
+    parser.add_argument("--size", type=float, default=2.0, help="размер файла, МБ")
+    parser.add_argument("--compress", action="store_true", help="сжимать командный канал и файлы (файл — случайные байты, не сжимается)")
+    parser.add_argument("--multiplex", action="store_true", help="чат и файлы одним соединением (MUX)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="сколько ждать доставки файла, с")
+    parser.add_argument("--seed", type=int, default=1, help="зерно случайностей прокси")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(prefix="bench-wifi-", suffix=".bin", delete=False) as f:
+        f.write(os.urandom(int(args.size * 1024 * 1024)))
+    try:
+        for spec in args.profiles:
+            asyncio.run(run_profile(spec, args, f.name))
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
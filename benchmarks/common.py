@@ -0,0 +1,157 @@
+import asyncio
+import os
+import queue
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from impairment_proxy import Impairment, TcpImpairmentProxy  # noqa: E402
+from network_core import MAX_CONCURRENT_TRANSFERS, ClientNetworkCore  # noqa: E402
+from transfer_manager import TransferManager  # noqa: E402
+
+
+async def start_server(host="127.0.0.1", module=server, **options):
+    # module — другая версия server.py (например, из истории git) для сравнения с текущей.
+    chat_server = module.ChatServer(host, 0, **options)
+    tcp_server = await asyncio.start_server(chat_server._protocol_dispatcher, host, 0)
+    chat_server.port = tcp_server.sockets[0].getsockname()[1]
+    if getattr(chat_server, "tls", None):
+        # Шифрованный порт — тоже свободный; закрывает его вызывающий (chat_server.tls_server).
+        chat_server.tls_server = await asyncio.start_server(chat_server._protocol_dispatcher, host, 0, ssl=chat_server.tls.context)
+        chat_server.tls.port = chat_server.tls_server.sockets[0].getsockname()[1]
+    Path(module.TEMP_UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
+    return chat_server, tcp_server
+
+
+async def start_impaired_server(spec, host="127.0.0.1", seed=None, **options):
+    # Сервер за прокси с ухудшением связи. Порт сервера подменяется на порт прокси:
+    # его сервер называет клиентам в UPLOAD_PROCEED/DOWNLOAD_PROCEED, и передачи тоже идут через прокси.
+    chat_server, tcp_server = await start_server(host, **options)
+    proxy = await TcpImpairmentProxy(host, chat_server.port, Impairment.parse(spec, seed), host).start()
+    chat_server.port = proxy.port
+    return chat_server, tcp_server, proxy
+
+
+async def stop_server(tcp_server):
+    tcp_server.close()
+    current = asyncio.current_task()
+    handlers = [task for task in asyncio.all_tasks() if task is not current]
+    if handlers:
+        # Клиенты уже закрыты, обработчики сервера завершаются сами.
+        _, pending = await asyncio.wait(handlers, timeout=2.0)
+        for task in pending:
+            task.cancel()
+
+
+async def login(host, port, username, timeout=10.0):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"CMD\n")
+    await writer.drain()
+    await asyncio.wait_for(reader.readline(), timeout)
+    writer.write(f"{username}\n".encode())
+    await writer.drain()
+    response = (await asyncio.wait_for(reader.readline(), timeout)).decode().strip()
+    if not response.startswith("AUTH_SUCCESS"):
+        raise RuntimeError(f"Вход {username} не удался: {response}")
+    return reader, writer
+
+
+async def read_until(reader, prefix, timeout=10.0):
+    while True:
+        line = (await asyncio.wait_for(reader.readline(), timeout)).decode().strip()
+        if line.startswith(prefix):
+            return line
+
+
+def report(title, samples, unit="мс", scale=1000.0):
+    if not samples:
+        print(f"{title}: нет данных")
+        return
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{title}: n={len(ordered)} p50={statistics.median(ordered) * scale:.2f}{unit} "
+          f"p99={p99 * scale:.2f}{unit} max={ordered[-1] * scale:.2f}{unit}")
+
+
+class Stopwatch:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+class Peer:
+    """Клиент без окна: события ядра разбираются в своём потоке, как в цикле Tk."""
+
+    def __init__(self, name, compress=False, multiplex=False, max_transfers=MAX_CONCURRENT_TRANSFERS, transport_profiles=None, tls=False):
+        self.name = name
+        self.events = queue.Queue()
+        self.core = ClientNetworkCore(self.events, compress=compress, multiplex=multiplex, transport_profiles=transport_profiles, tls=tls)
+        self.transfers = TransferManager(self.core, self.core.send, on_change=self._changed, max_uploads=max_transfers,
+                                         max_downloads=max_transfers, compress=compress)
+        self.connected = threading.Event()
+        self.echoes = {}      # текст -> время эха
+        self.finished = {}    # путь файла -> (состояние, время, байт по сети)
+        self.reconnects = self.failed_connects = 0
+        self.port = None
+        self.download_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+
+    def start(self, port):
+        self.port = port
+        self.core.start()
+        threading.Thread(target=self._run, name=f"peer-{self.name}", daemon=True).start()
+        self.core.connect("127.0.0.1", port, self.name)
+
+    def upload(self, peer, filepath):
+        # TransferManager живёт в потоке событий, поэтому просьба идёт через ту же очередь.
+        self.events.put({"type": "bench_upload", "peer": peer, "filepath": filepath})
+
+    def stop(self):
+        self.core.stop()
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def _run(self):
+        while True:
+            event = self.events.get()
+            kind = event["type"]
+            if kind == "bench_upload":
+                self.transfers.add_upload(event["peer"], event["filepath"])
+            elif kind == "connection_success":
+                self.connected.set()
+            elif kind == "connection_failed" and self.failed_connects < 10:
+                # Обрыв во время входа: первое подключение ядро не повторяет само, а GUI предложил бы повторить.
+                self.failed_connects += 1
+                self.core.connect("127.0.0.1", self.port, self.name)
+            elif kind == "reconnected":
+                self.reconnects += 1
+            elif kind == "new_message" and event["username"] == self.name:
+                self.echoes[event["text"]] = time.perf_counter()
+            elif kind == "file_incoming":
+                self.core.send(self.transfers.accept_command(event["transfer_id"]))
+            elif kind == "download_ready":
+                if not self.transfers.on_download_ready(event):
+                    path = os.path.join(self.download_dir, event["filename"])
+                    self.transfers.add_download(event["transfer_id"], event["from_user"], event["filename"], event["filesize"], path)
+            elif kind == "upload_proceed":
+                self.transfers.on_upload_proceed(event)
+            elif kind == "upload_rejected":
+                self.transfers.on_upload_rejected(event)
+            elif kind == "download_proceed":
+                self.transfers.on_download_proceed(event)
+            elif kind == "transfer_progress":
+                self.transfers.on_progress(event)
+            elif kind == "file_cancelled":
+                self.transfers.on_remote_cancel(event)
+
+    def _changed(self, item):
+        if item["state"] in ("done", "error", "cancelled", "rejected"):
+            self.finished[item["filepath"]] = (item["state"], time.perf_counter(), item["wire"])
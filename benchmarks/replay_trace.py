@@ -0,0 +1,143 @@
+"""Воспроизведение записанного трафика (server.py --trace FILE) на свежем сервере.
+
+Каждое записанное соединение командного канала снова входит под своим
+псевдонимом и отправляет те же строки с исходными промежутками, делёнными на
+--speed (0 — без пауз, так быстро, как сервер принимает). Задержка
+меряется от отправки сообщения в общий чат или ЛС до его эха отправителю.
+
+Команды, ссылающиеся на id передач, выданные исходным сервером (/file_accept,
+/download и т.д.), и сами передачи файлов не воспроизводятся — они только
+подсчитываются. Обрыв соединения в записи воспроизводится как /quit, чтобы
+следующий вход под тем же именем не упёрся в ожидающую сессию.
+
+С --impair клиенты ходят к серверу через прокси с ухудшением связи
+(impairment_proxy.py): профиль вроде busy_wifi или параметры latency=40,jitter=20.
+"""
+import argparse
+import asyncio
+import re
+import time
+from collections import deque
+
+from common import login, report, start_impaired_server, start_server, stop_server
+
+from traffic_trace import AUTH, CLOSE, DATA, LINE, OPEN, read_trace
+
+REPLAYED_COMMANDS = ("/pm", "/w", "/ping", "/quit")
+ECHO_RE = re.compile(r"\[[^\]]*\] (?:\(PM для [^)]*\)|(\S+)): (.*)$")
+
+
+class ReplayClient:
+    def __init__(self, alias, stats):
+        self.alias = alias
+        self.stats = stats
+        self.pending = {}  # текст -> время отправок, ждущих эха
+        self.reader = self.writer = self.reader_task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await login(host, port, self.alias)
+        self.reader_task = asyncio.create_task(self._read())
+
+    def send(self, line):
+        command, _, rest = line.partition(" ")
+        if command.startswith("/"):
+            command = command.lower()
+            if command in ("/pm", "/w"):
+                # Эхо ЛС: «(PM для адресата): текст».
+                self._expect(rest.partition(" ")[2])
+        else:
+            self._expect(line)
+        self.writer.write(f"{line}\n".encode("utf-8"))
+        self.stats["sent"] += 1
+
+    def _expect(self, text):
+        if text: self.pending.setdefault(text, deque()).append(time.perf_counter())
+
+    async def _read(self):
+        while raw := await self.reader.readline():
+            self.stats["received"] += 1
+            match = ECHO_RE.match(raw.decode("utf-8", "replace").rstrip("\n"))
+            if not match or match.group(1) not in (None, self.alias): continue
+            sent = self.pending.get(match.group(2))
+            if sent:
+                self.stats["latency"].append(time.perf_counter() - sent.popleft())
+                if not sent: del self.pending[match.group(2)]
+
+    async def close(self, settle=0.0):
+        # Сначала ждём эха своих сообщений, иначе без пауз задержки не успеют замериться.
+        deadline = time.perf_counter() + settle
+        while self.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        if self.writer.is_closing(): return
+        self.writer.write(b"/quit\n")
+        self.writer.close()
+        self.reader_task.cancel()
+
+
+async def replay(path, speed, settle, impair=None):
+    proxy = None
+    if impair:
+        chat_server, tcp_server, proxy = await start_impaired_server(impair)
+    else:
+        chat_server, tcp_server = await start_server()
+    host, port = "127.0.0.1", chat_server.port
+    stats = {"sent": 0, "received": 0, "skipped": 0, "transfers": 0, "transfer_bytes": 0, "latency": []}
+    clients = {}  # номер соединения в записи -> ReplayClient
+    closed = []
+    started = time.perf_counter()
+    for kind, connection, elapsed, payload in read_trace(path):
+        if speed:
+            delay = started + elapsed / speed - time.perf_counter()
+            if delay > 0: await asyncio.sleep(delay)
+        if kind == OPEN and not payload.startswith("CMD"):
+            stats["transfers"] += payload.startswith("UPLOAD")
+        elif kind == AUTH:
+            client = clients[connection] = ReplayClient(payload, stats)
+            await client.connect(host, port)
+        elif kind == LINE and connection in clients:
+            command = payload.partition(" ")[0].lower()
+            if command.startswith("/") and command not in REPLAYED_COMMANDS:
+                stats["skipped"] += 1
+                continue
+            clients[connection].send(payload)
+            await clients[connection].writer.drain()
+        elif kind == DATA:
+            stats["transfer_bytes"] += payload
+        elif kind == CLOSE and connection in clients:
+            closed.append(clients.pop(connection))
+            await closed[-1].close(settle)
+    replayed_in = time.perf_counter() - started
+
+    # Дожидаемся эха последних сообщений.
+    deadline = time.perf_counter() + settle
+    while any(client.pending for client in clients.values()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    unanswered = sum(len(sent) for client in list(clients.values()) + closed for sent in client.pending.values())
+    elapsed = time.perf_counter() - started
+    for client in clients.values():
+        await client.close()
+    if proxy:
+        await proxy.stop()
+    await stop_server(tcp_server)
+    return stats, replayed_in, elapsed, unanswered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="файл записи трафика")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени: 1, 10, ...; 0 — без пауз")
+    parser.add_argument("--settle", type=float, default=5.0, help="сек. ожидания эха после конца записи")
+    parser.add_argument("--impair", help="ухудшение связи: профиль прокси или параметры, например busy_wifi")
+    args = parser.parse_args()
+
+    stats, replayed_in, elapsed, unanswered = asyncio.run(replay(args.trace, args.speed, args.settle, args.impair))
+    speed = f"{args.speed:g}x" if args.speed else "без пауз"
+    if args.impair: speed += f", связь {args.impair}"
+    print(f"Запись {args.trace} ({speed}): {stats['sent']} строк за {replayed_in:.2f} с, {stats['sent'] / max(replayed_in, 1e-9):,.0f} строк/с")
+    print(f"Доставлено клиентам {stats['received']} строк, {stats['received'] / max(elapsed, 1e-9):,.0f} строк/с; без эха: {unanswered}")
+    print(f"Пропущено команд передач: {stats['skipped']}, передач файлов: {stats['transfers']} ({stats['transfer_bytes'] / 1024:.0f} КБ)")
+    report("Задержка до эха", stats["latency"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""Сервер с единой блокировкой — командный канал server.py до разделения блокировок.
+
+База для bench_lock_contention.py: всё состояние под одной asyncio.Lock, запись
+в сокет с drain() выполняется под ней, а _cleanup_client повторно берёт её в
+_broadcast_user_list. Оставлены только вход, команды и рассылки; приём и
+отдача файлов, автообнаружение и запуск из командной строки убраны, код
+остальных методов не менялся.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import re
+import uuid
+from datetime import datetime
+
+TEMP_UPLOAD_DIR = "server_uploads"
+CLIENT_TIMEOUT = 300.0
+READ_CHUNK_SIZE = 65536
+MAX_LINE_LENGTH = 65536
+
+# Исходящие сообщения текущей пачки команд: {writer: [строки]}.
+# Пока пачка обрабатывается, _send_message складывает сюда, а не пишет в сокет.
+_batch_outbox = contextvars.ContextVar("batch_outbox", default=None)
+
+class ChatServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connected_clients = {}
+        self.active_transfers = {}
+        self.lock = asyncio.Lock()
+
+    async def _protocol_dispatcher(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        try:
+            initial_message_raw = await asyncio.wait_for(reader.readline(), timeout=10.0)
+            if not initial_message_raw:
+                return
+
+            initial_message = initial_message_raw.decode().strip()
+            logging.info(f"Получено приветствие от {addr}: '{initial_message}'")
+            parts = initial_message.split()
+            command = parts[0]
+
+            if command == "CMD":
+                await self._handle_command_connection(reader, writer)
+            else:
+                logging.warning(f"Неизвестный тип подключения от {addr}: '{initial_message}'")
+
+        except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError):
+            logging.info(f"Клиент {addr} не представился или отсоединился.")
+        except Exception as e:
+            logging.error(f"Ошибка в диспетчере для {addr}: {e}", exc_info=True)
+        finally:
+            if not writer.is_closing():
+                writer.close()
+                await writer.wait_closed()
+
+    async def _handle_command_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        try:
+            await self._send_message(writer, "AUTH_REQUEST")
+            username_raw = await asyncio.wait_for(reader.readline(), timeout=15.0)
+            username = username_raw.decode().strip()
+
+            async with self.lock:
+                if not re.match("^[a-zA-Z0-9_.-]{3,16}$", username):
+                    await self._send_message(writer, "AUTH_ERROR Неверный формат имени.")
+                    return
+                if self._get_writer_by_username(username):
+                    await self._send_message(writer, f"AUTH_ERROR Имя '{username}' уже занято.")
+                    return
+                self.connected_clients[writer] = {"username": username}
+            
+            logging.info(f"Клиент {addr} авторизован как '{username}'.")
+            await self._send_message(writer, f"AUTH_SUCCESS Добро пожаловать, {username}!")
+            await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вошёл в чат ***", exclude_writer=writer)
+            await self._broadcast_user_list()
+        
+        except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError):
+            logging.warning(f"Ошибка аутентификации для {addr}.")
+            return
+        
+        buffer = bytearray()
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(READ_CHUNK_SIZE), timeout=CLIENT_TIMEOUT)
+                if not data: break
+
+                buffer += data
+                lines, consumed = self._split_lines(buffer)
+                if consumed:
+                    del buffer[:consumed]
+                if len(buffer) > MAX_LINE_LENGTH:
+                    logging.warning(f"Клиент {addr} прислал слишком длинную строку ({len(buffer)} байт), отключение.")
+                    break
+                if lines:
+                    await self._process_batch(writer, lines)
+        except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError) as e:
+            logging.info(f"Клиент '{self.connected_clients.get(writer, {}).get('username', addr)}' отсоединен (таймаут или разрыв): {type(e).__name__}")
+        except Exception as e:
+            logging.error(f"Ошибка в _handle_command_connection: {e}", exc_info=True)
+        finally:
+            await self._cleanup_client(writer)
+
+    @staticmethod
+    def _split_lines(buffer):
+        lines = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1: break
+            line = buffer[start:end].decode("utf-8", errors="replace").strip()
+            if line:
+                lines.append(line)
+            start = end + 1
+        return lines, start
+
+    async def _process_batch(self, writer, lines):
+        outbox = {}
+        token = _batch_outbox.set(outbox)
+        try:
+            for line in lines:
+                await self._process_line(writer, line)
+        finally:
+            _batch_outbox.reset(token)
+            await self._flush_outbox(outbox)
+
+    async def _flush_outbox(self, outbox):
+        writers = []
+        for target, messages in outbox.items():
+            if self._write_lines(target, messages):
+                writers.append(target)
+        if writers:
+            await asyncio.gather(*(self._drain(w) for w in writers))
+
+    async def _process_line(self, writer, line):
+        parts = line.split(" ", 3)
+        command_str = parts[0].lower()
+        
+        handler = self.command_handlers.get(command_str)
+        
+        if handler:
+            await handler(self, writer, parts)
+        else:
+            username = self.connected_clients[writer]["username"]
+            formatted_msg = f"[{self._now()}] {username}: {line}"
+            await self._broadcast_message(formatted_msg)
+    
+    async def _handle_pm(self, writer, parts):
+        if len(parts) < 3:
+            await self._send_message(writer, "SERVER_MSG Формат: /pm <user> <message>")
+            return
+        
+        target_user, msg = parts[1], " ".join(parts[2:])
+        sender_user = self.connected_clients[writer]["username"]
+        
+        if target_user == sender_user:
+            await self._send_message(writer, "SERVER_MSG Нельзя отправить сообщение самому себе.")
+            return
+
+        target_writer = self._get_writer_by_username(target_user)
+        if target_writer:
+            pm = f"[{self._now()}] (PM от {sender_user}): {msg}"
+            await self._send_message(target_writer, pm)
+            await self._send_message(writer, f"[{self._now()}] (PM для {target_user}): {msg}")
+        else:
+            await self._send_message(writer, f"SERVER_MSG Пользователь '{target_user}' не найден.")
+    
+    async def _handle_upload(self, writer, parts):
+        if len(parts) < 4:
+            await self._send_message(writer, "SERVER_MSG Формат: /upload <user> <filename> <size>")
+            return
+        
+        target_user, filename, size_str = parts[1], parts[2], parts[3]
+        sender_user = self.connected_clients[writer]["username"]
+        try:
+            filesize = int(size_str)
+        except ValueError:
+            await self._send_message(writer, "SERVER_MSG Неверный размер файла."); return
+
+        target_writer = self._get_writer_by_username(target_user)
+        if not target_writer:
+            await self._send_message(writer, f"SERVER_MSG Пользователь '{target_user}' не в сети."); return
+
+        transfer_id = str(uuid.uuid4())
+        async with self.lock:
+            self.active_transfers[transfer_id] = {
+                "id": transfer_id, "filename": filename, "filesize": filesize,
+                "from_user": sender_user, "to_user": target_user,
+                "from_writer": writer, "to_writer": target_writer,
+                "status": "pending_target_accept"
+            }
+        
+        await self._send_message(target_writer, f"FILE_INCOMING {sender_user} {filename} {filesize} {transfer_id}")
+        await self._send_message(writer, f"SERVER_MSG Запрос на отправку файла '{filename}' пользователю {target_user} отправлен.")
+
+    async def _handle_file_action(self, writer, parts, action):
+        if len(parts) < 2: return
+        transfer_id = parts[1]
+        
+        async with self.lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or transfer["to_user"] != self.connected_clients[writer]["username"]:
+                return
+
+            if action == "accept":
+                if transfer["status"] != "pending_target_accept": return
+                transfer["status"] = "pending_upload"
+                await self._send_message(transfer["from_writer"], f"UPLOAD_PROCEED {transfer_id} {self.port}")
+                await self._send_message(writer, f"SERVER_MSG Вы приняли файл '{transfer['filename']}'. Ожидание загрузки.")
+            elif action == "reject":
+                await self._send_message(transfer["from_writer"], f"UPLOAD_REJECTED Пользователь {transfer['to_user']} отклонил передачу файла.")
+                self.active_transfers.pop(transfer_id, None)
+
+    async def _handle_download(self, writer, parts):
+        if len(parts) < 2: return
+        transfer_id = parts[1]
+        
+        async with self.lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or transfer["to_user"] != self.connected_clients[writer]["username"] or transfer["status"] != "pending_download":
+                await self._send_message(writer, "SERVER_MSG Ошибка: неверный ID или файл не готов к скачиванию.")
+                return
+            transfer["status"] = "downloading"
+            
+        await self._send_message(writer, f"DOWNLOAD_PROCEED {transfer_id} {self.port}")
+        logging.info(f"Дано разрешение на скачивание файла {transfer_id} клиенту {transfer['to_user']}.")
+    
+    async def _handle_ping(self, writer, parts):
+        username = self.connected_clients.get(writer, {}).get("username", "N/A")
+        logging.info(f"Получен ping от пользователя '{username}'. Соединение активно.")
+
+    command_handlers = {
+        "/pm": _handle_pm,
+        "/w": _handle_pm,
+        "/upload": _handle_upload,
+        "/file_accept": lambda self, w, p: self._handle_file_action(w, p, "accept"),
+        "/file_reject": lambda self, w, p: self._handle_file_action(w, p, "reject"),
+        "/download": _handle_download,
+        "/ping": _handle_ping,
+    }
+
+    @staticmethod
+    def _now(): return datetime.now().strftime("%H:%M:%S")
+
+    async def _send_message(self, writer, message):
+        outbox = _batch_outbox.get()
+        if outbox is not None:
+            if writer and not writer.is_closing():
+                outbox.setdefault(writer, []).append(message)
+                return True
+            return False
+        if self._write_lines(writer, [message]):
+            return await self._drain(writer)
+        return False
+
+    def _write_lines(self, writer, messages):
+        if writer and not writer.is_closing():
+            try:
+                writer.write(("\n".join(messages) + "\n").encode("utf-8"))
+                return True
+            except (ConnectionResetError, BrokenPipeError) as e:
+                logging.warning(f"Не удалось отправить сообщение клиенту {writer.get_extra_info('peername')}: {e}")
+        return False
+
+    async def _drain(self, writer):
+        try:
+            await writer.drain()
+            return True
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logging.warning(f"Не удалось отправить сообщение клиенту {writer.get_extra_info('peername')}: {e}")
+            return False
+    
+    async def _broadcast_message(self, message, exclude_writer=None):
+        all_writers = list(self.connected_clients.keys())
+        for writer in all_writers:
+            if writer != exclude_writer:
+                await self._send_message(writer, message)
+
+    async def _broadcast_user_list(self):
+        async with self.lock:
+            usernames = [cd["username"] for cd in self.connected_clients.values() if cd.get("username")]
+        msg = f"USER_LIST {','.join(sorted(usernames))}"
+        logging.info(f"Рассылка списка пользователей: {usernames}")
+        await self._broadcast_message(msg)
+
+    def _get_writer_by_username(self, username):
+        for writer, data in self.connected_clients.items():
+            if data.get("username") == username:
+                return writer
+        return None
+
+    async def _cleanup_client(self, writer):
+        username = None
+        async with self.lock:
+            if writer in self.connected_clients:
+                removed_user = self.connected_clients.pop(writer)
+                username = removed_user.get("username")
+                logging.info(f"Клиент '{username}' удален из списка подключенных.")
+                
+                related_transfers = []
+                for tid, t_info in self.active_transfers.items():
+                    if t_info.get("from_writer") == writer or t_info.get("to_writer") == writer:
+                        related_transfers.append(tid)
+                
+                for tid in related_transfers:
+                    t_info = self.active_transfers.pop(tid)
+                    logging.info(f"Отменен трансфер {tid} из-за отключения пользователя {username}.")
+                    
+                    other_writer = t_info.get("from_writer") if t_info.get("to_writer") == writer else t_info.get("to_writer")
+                    if other_writer:
+                        await self._send_message(other_writer, f"SERVER_MSG Передача файла '{t_info['filename']}' отменена, так как пользователь отключился.")
+                    
+                    if t_info.get("temp_filepath") and os.path.exists(t_info.get("temp_filepath")):
+                        try:
+                            os.remove(t_info.get("temp_filepath"))
+                        except OSError as e:
+                            logging.error(f"Не удалось удалить временный файл {t_info.get('temp_filepath')}: {e}")
+
+            if username:
+                await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вышел из чата ***")
+                await self._broadcast_user_list()
+        
+        if not writer.is_closing():
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
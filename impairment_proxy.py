@@ -0,0 +1,374 @@
+"""Прокси с ухудшением связи для проверки чата в условиях плохого Wi-Fi.
+
+Встаёт между клиентами и сервером (TCP — командный канал и передачи, UDP —
+автообнаружение) и добавляет задержку, разброс задержки, ограничение полосы,
+потери, перестановку датаграмм и обрывы соединений. Root и tc не нужны.
+Параметры можно менять на ходу, в том числе по сценарию из фаз:
+
+    python impairment_proxy.py --listen 9091 --target 127.0.0.1:9090 --profile busy_wifi \\
+        --phase 30:latency=150,jitter=80 --phase 60:reset --phase 90:profile=wifi
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import socket
+import struct
+
+# ------------------------------
+# Параметры прокси
+# ------------------------------
+TCP_CHUNK_SIZE = 16 * 1024
+TCP_QUEUE_CHUNKS = 32          # ~512 КБ в пути на направление, дальше — обратное давление
+TCP_RETRANSMIT_DELAY = 0.2     # потеря в TCP видна приложению как пауза до повторной передачи
+REORDER_DELAY = 0.03           # на столько задерживается переставляемая датаграмма
+UDP_SESSION_TIMEOUT = 60.0
+
+# Готовые наборы: задержка и разброс в мс, полоса в Мбит/с, доли потерь и перестановок.
+PROFILES = {
+    "lan": {"latency": 0.5},
+    "wifi": {"latency": 3, "jitter": 2, "bandwidth": 50, "loss": 0.001},
+    "busy_wifi": {"latency": 15, "jitter": 20, "bandwidth": 10, "loss": 0.01, "reorder": 0.02},
+    "bad_wifi": {"latency": 40, "jitter": 60, "bandwidth": 2, "loss": 0.03, "reorder": 0.05},
+    "flaky_wifi": {"latency": 20, "jitter": 30, "bandwidth": 5, "loss": 0.02, "reorder": 0.02, "reset_interval": 10},
+}
+
+class Impairment:
+    """Параметры ухудшения связи в единицах командной строки.
+
+    latency и jitter — мс, bandwidth — Мбит/с (0 — без ограничения), loss и
+    reorder — доли от 0 до 1, reset_interval — среднее число секунд между
+    обрывами каждого TCP-соединения (0 — без обрывов). Менять можно на ходу
+    через update(): новые значения действуют на следующие данные.
+    """
+    FIELDS = ("latency", "jitter", "bandwidth", "loss", "reorder", "reset_interval")
+
+    def __init__(self, seed=None, **params):
+        self.random = random.Random(seed)
+        self.latency = self.jitter = self.bandwidth = self.loss = self.reorder = self.reset_interval = 0.0
+        self.update(**params)
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        # "busy_wifi" или "latency=40,jitter=20,bandwidth=5" или "profile=wifi,loss=0.05".
+        impairment = cls(seed)
+        impairment.update(**parse_params(spec))
+        return impairment
+
+    def update(self, profile=None, **params):
+        if profile:
+            if profile not in PROFILES:
+                raise ValueError(f"Неизвестный профиль '{profile}', есть: {', '.join(PROFILES)}")
+            for name in self.FIELDS:
+                setattr(self, name, 0.0)
+            params = {**PROFILES[profile], **params}
+        for name, value in params.items():
+            if name not in self.FIELDS:
+                raise ValueError(f"Неизвестный параметр '{name}', есть: {', '.join(self.FIELDS)}")
+            setattr(self, name, float(value))
+
+    def delay(self):
+        # Секунды в пути для очередного куска или датаграммы.
+        return max(0.0, self.random.gauss(self.latency, self.jitter / 2) if self.jitter else self.latency) / 1000
+
+    def bytes_per_second(self):
+        return self.bandwidth * 1_000_000 / 8
+
+    def chance(self, probability):
+        return probability > 0 and self.random.random() < probability
+
+    def describe(self):
+        return ", ".join(f"{name}={getattr(self, name):g}" for name in self.FIELDS if getattr(self, name))
+
+def parse_params(spec):
+    params = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, value = item.partition("=")
+        if not sep:
+            name, value = "profile", name
+        params[name.strip()] = value.strip()
+    return params
+
+class Link:
+    """Одно направление канала: общая полоса для всех соединений через прокси."""
+
+    def __init__(self, impairment):
+        self.impairment = impairment
+        self.free_at = 0.0
+
+    def schedule(self, size, now):
+        # Время, когда кусок размером size окажется на другой стороне.
+        rate = self.impairment.bytes_per_second()
+        if rate:
+            self.free_at = max(now, self.free_at) + size / rate
+            now = self.free_at
+        return now + self.impairment.delay()
+
+class TcpImpairmentProxy:
+    """TCP-прокси: порядок байтов сохраняется, разброс задержки даёт паузы, как в настоящем TCP."""
+
+    def __init__(self, target_host, target_port, impairment, listen_host="127.0.0.1", listen_port=0):
+        self.target = (target_host, target_port)
+        self.listen = (listen_host, listen_port)
+        self.impairment = impairment
+        self.upstream = Link(impairment)
+        self.downstream = Link(impairment)
+        self.server = None
+        self.port = None
+        self.connections = set()
+        self.stats = {"connections": 0, "resets": 0, "bytes_up": 0, "bytes_down": 0, "stalls": 0}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, *self.listen)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"TCP прокси {self.listen[0]}:{self.port} -> {self.target[0]}:{self.target[1]}")
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+        for writers in list(self.connections):
+            for writer in writers: writer.transport.abort()
+        if self.server:
+            await self.server.wait_closed()
+
+    def reset_all(self):
+        for writers in list(self.connections):
+            self._reset(writers)
+
+    def _reset(self, writers):
+        # SO_LINGER 0: закрытие отправляет RST, как при обрыве связи, а не вежливый FIN.
+        if writers not in self.connections: return
+        self.connections.discard(writers)
+        self.stats["resets"] += 1
+        for writer in writers:
+            sock = writer.get_extra_info("socket")
+            try:
+                if sock is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            except OSError:
+                pass
+            writer.transport.abort()
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError as e:
+            logging.warning(f"Прокси: сервер {self.target} недоступен: {e}")
+            client_writer.transport.abort()
+            return
+        writers = (client_writer, server_writer)
+        self.connections.add(writers)
+        self.stats["connections"] += 1
+        resetter = asyncio.create_task(self._random_resets(writers))
+        try:
+            await asyncio.gather(self._pump(client_reader, server_writer, self.upstream, "bytes_up"),
+                                 self._pump(server_reader, client_writer, self.downstream, "bytes_down"),
+                                 return_exceptions=True)
+        finally:
+            resetter.cancel()
+            self.connections.discard(writers)
+            for writer in writers:
+                writer.close()
+
+    async def _pump(self, reader, writer, link, counter):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(TCP_QUEUE_CHUNKS)
+
+        async def deliver():
+            while True:
+                at, chunk = await queue.get()
+                delay = at - loop.time()
+                if delay > 0: await asyncio.sleep(delay)
+                if chunk is None:
+                    if writer.can_write_eof() and not writer.is_closing(): writer.write_eof()
+                    return
+                writer.write(chunk)
+                await writer.drain()
+
+        delivery = asyncio.create_task(deliver())
+        last_at = 0.0
+        try:
+            while chunk := await reader.read(TCP_CHUNK_SIZE):
+                self.stats[counter] += len(chunk)
+                at = link.schedule(len(chunk), loop.time())
+                if self.impairment.chance(self.impairment.loss):
+                    at += TCP_RETRANSMIT_DELAY
+                    self.stats["stalls"] += 1
+                # Байты TCP не обгоняют друг друга: опоздавший кусок задерживает следующие.
+                last_at = max(last_at, at)
+                await queue.put((last_at, chunk))
+            await queue.put((last_at, None))
+            await delivery
+        except OSError:
+            # Одна сторона оборвалась — обрываем и другую, как сделал бы настоящий канал.
+            writer.transport.abort()
+        finally:
+            delivery.cancel()
+
+    async def _random_resets(self, writers):
+        while True:
+            interval = self.impairment.reset_interval
+            await asyncio.sleep(self.impairment.random.expovariate(1 / interval) if interval else 1.0)
+            if interval and self.impairment.reset_interval:
+                logging.info("Прокси: обрыв соединения.")
+                self._reset(writers)
+                return
+
+class UdpImpairmentProxy:
+    """UDP-прокси: для каждого адреса клиента свой сокет к серверу, ответы идут обратно.
+
+    rewrite(data) применяется к ответам сервера — например, чтобы в ответе
+    автообнаружения клиенту подсовывался адрес TCP-прокси, а не сервера.
+    """
+
+    def __init__(self, target_host, target_port, impairment, listen_host="127.0.0.1", listen_port=0, rewrite=None):
+        self.target = (target_host, target_port)
+        self.listen = (listen_host, listen_port)
+        self.impairment = impairment
+        self.rewrite = rewrite
+        self.upstream = Link(impairment)
+        self.downstream = Link(impairment)
+        self.transport = None
+        self.port = None
+        self.sessions = {}  # адрес клиента -> транспорт к серверу
+        self.stats = {"datagrams": 0, "dropped": 0, "reordered": 0}
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        proxy = self
+
+        class ClientSide(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                loop.create_task(proxy._from_client(data, addr))
+
+        self.transport, _ = await loop.create_datagram_endpoint(ClientSide, local_addr=self.listen)
+        self.port = self.transport.get_extra_info("sockname")[1]
+        logging.info(f"UDP прокси {self.listen[0]}:{self.port} -> {self.target[0]}:{self.target[1]}")
+        return self
+
+    async def stop(self):
+        for transport, expiry in self.sessions.values():
+            expiry.cancel()
+            transport.close()
+        self.sessions.clear()
+        if self.transport:
+            self.transport.close()
+
+    async def _from_client(self, data, addr):
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(addr)
+        if session is None:
+            proxy = self
+
+            class ServerSide(asyncio.DatagramProtocol):
+                def datagram_received(self, reply, _):
+                    if proxy.rewrite: reply = proxy.rewrite(reply)
+                    proxy._forward(proxy.downstream, lambda: proxy.transport.sendto(reply, addr))
+
+            transport, _ = await loop.create_datagram_endpoint(ServerSide, remote_addr=self.target)
+            session = self.sessions[addr] = [transport, None]
+        else:
+            session[1].cancel()
+        session[1] = loop.call_later(UDP_SESSION_TIMEOUT, self._expire, addr)
+        self._forward(self.upstream, lambda: session[0].sendto(data))
+
+    def _forward(self, link, send):
+        loop = asyncio.get_running_loop()
+        self.stats["datagrams"] += 1
+        if self.impairment.chance(self.impairment.loss):
+            self.stats["dropped"] += 1
+            return
+        delay = link.schedule(0, loop.time()) - loop.time()
+        if self.impairment.chance(self.impairment.reorder):
+            # Задержанная датаграмма придёт позже следующих за ней.
+            delay += REORDER_DELAY
+            self.stats["reordered"] += 1
+        loop.call_later(delay, send)
+
+    def _expire(self, addr):
+        transport, _ = self.sessions.pop(addr, (None, None))
+        if transport: transport.close()
+
+def rewrite_discovery(host, port):
+    # Ответы сервера на зонды указывают на TCP-прокси, иначе клиент пойдёт к серверу напрямую.
+    def rewrite(data):
+        try:
+            info = json.loads(data.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return data
+        if not isinstance(info, dict) or info.get("app_name") != "python_chat": return data
+        info.update({"host": host, "port": port})
+        return json.dumps(info).encode("utf-8")
+    return rewrite
+
+async def run_script(phases, impairment, proxies):
+    # phases: [(секунда от старта, {параметры} или {"reset": True})].
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for at, params in sorted(phases, key=lambda phase: phase[0]):
+        await asyncio.sleep(max(0.0, started + at - loop.time()))
+        params = dict(params)
+        if params.pop("reset", None) is not None:
+            for proxy in proxies:
+                if isinstance(proxy, TcpImpairmentProxy): proxy.reset_all()
+            logging.info(f"Фаза {at:g} с: обрыв всех соединений")
+        if params:
+            impairment.update(**params)
+            logging.info(f"Фаза {at:g} с: {impairment.describe() or 'без ухудшений'}")
+
+def parse_phase(spec):
+    at, sep, params = spec.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Фаза задаётся как <секунда>:<параметры>, получено '{spec}'")
+    params = parse_params(params)
+    if params.get("profile") == "reset":
+        params["reset"] = params.pop("profile")
+    return float(at), params
+
+def parse_address(spec):
+    host, _, port = spec.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+async def main(args):
+    impairment = Impairment(args.seed, profile=args.profile)
+    impairment.update(**{name: getattr(args, name) for name in Impairment.FIELDS if getattr(args, name) is not None})
+    target_host, target_port = parse_address(args.target)
+    tcp_proxy = await TcpImpairmentProxy(target_host, target_port, impairment, args.host, args.listen).start()
+    proxies = [tcp_proxy]
+    if args.udp_listen is not None:
+        rewrite = rewrite_discovery(args.advertise or args.host, tcp_proxy.port)
+        udp_host, udp_port = parse_address(args.udp_target)
+        proxies.append(await UdpImpairmentProxy(udp_host, udp_port, impairment, args.host, args.udp_listen, rewrite).start())
+    print(f"Прокси готов: TCP {args.host}:{tcp_proxy.port} -> {args.target}; {impairment.describe() or 'без ухудшений'}")
+    try:
+        await run_script(args.phase, impairment, proxies)
+        await asyncio.Event().wait()
+    finally:
+        for proxy in proxies:
+            await proxy.stop()
+        print(f"Статистика TCP: {tcp_proxy.stats}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="адрес, на котором слушает прокси")
+    parser.add_argument("--listen", type=int, default=9091, help="TCP порт прокси")
+    parser.add_argument("--target", default="127.0.0.1:9090", help="адрес сервера чата")
+    parser.add_argument("--udp-listen", type=int, help="UDP порт прокси для зондов автообнаружения")
+    parser.add_argument("--udp-target", default="127.0.0.1:9998", help="UDP порт зондов сервера")
+    parser.add_argument("--advertise", help="адрес прокси в ответах автообнаружения (по умолчанию --host)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), help="готовый набор ухудшений")
+    parser.add_argument("--latency", type=float, help="задержка, мс")
+    parser.add_argument("--jitter", type=float, help="разброс задержки, мс")
+    parser.add_argument("--bandwidth", type=float, help="полоса, Мбит/с")
+    parser.add_argument("--loss", type=float, help="доля потерь (TCP — пауза на повтор, UDP — сброс)")
+    parser.add_argument("--reorder", type=float, help="доля переставленных датаграмм UDP")
+    parser.add_argument("--reset-interval", dest="reset_interval", type=float, help="среднее время между обрывами соединения, с")
+    parser.add_argument("--phase", type=parse_phase, action="append", default=[], help="смена параметров: <секунда>:<параметры> или <секунда>:reset")
+    parser.add_argument("--seed", type=int, help="зерно генератора случайностей для повторяемых прогонов")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%H:%M:%S")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
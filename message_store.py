@@ -0,0 +1,164 @@
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+# ------------------------------
+# Параметры локального хранилища
+# ------------------------------
+WRITE_BATCH_SIZE = 500      # строк за одну транзакцию
+WRITE_FLUSH_INTERVAL = 0.2  # сек. ожидания, пока копится пачка
+SCHEMA_VERSION = 1
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+# unicode61 снимает диакритику только с латиницы, «ё» приводим к «е» сами — и в индексе, и в запросе.
+YO_TABLE = str.maketrans("ёЁ", "еЕ")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    partner TEXT NOT NULL DEFAULT '',
+    sender TEXT NOT NULL,
+    body TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_dialog ON messages(account, channel, partner, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body, content='messages', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, body) VALUES (new.id, replace(replace(new.body, 'ё', 'е'), 'Ё', 'Е'));
+END;
+"""
+
+class MessageStore:
+    """Локальная история чата и ЛС в SQLite (WAL).
+
+    Запись идёт из отдельного потока пачками, чтение — из потока, создавшего
+    хранилище (GUI), по своему соединению: в режиме WAL читатели не ждут писателя.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.write_queue = queue.Queue()
+        self.writer_thread = None
+        self.reader = None
+        try:
+            self.reader = self._open()
+            self.reader.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            logging.error(f"Локальная история недоступна ({path}): {e}")
+            self.reader = None
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if not self.reader or self.writer_thread: return
+        self.writer_thread = threading.Thread(target=self._writer_loop, name="message-store", daemon=True)
+        self.writer_thread.start()
+
+    def close(self):
+        if self.writer_thread:
+            self.write_queue.put(None)
+            self.writer_thread.join(timeout=5.0)
+            self.writer_thread = None
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    # --- запись ---
+    def add(self, account, channel, sender, body, partner="", ts=None):
+        # Вызывается из GUI: только кладём в очередь, на диск пишет поток хранилища.
+        if self.writer_thread:
+            self.write_queue.put((account, channel, partner, sender, body, ts or time.time()))
+
+    def _writer_loop(self):
+        try:
+            conn = self._open()
+        except sqlite3.Error as e:
+            logging.error(f"Поток записи истории не запущен: {e}")
+            return
+        self._upgrade(conn)
+        stopping = False
+        while not stopping:
+            item = self.write_queue.get()
+            if item is None: break
+            batch = [item]
+            deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                try:
+                    item = self.write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO messages(account, channel, partner, sender, body, ts) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка записи истории ({len(batch)} сообщ.): {e}")
+        conn.close()
+        logging.info("Поток записи истории остановлен.")
+
+    def _upgrade(self, conn):
+        # База без полнотекстового индекса (старая версия клиента) индексируется один раз, в фоне.
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION: return
+            started = time.perf_counter()
+            with conn:
+                conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('delete-all')")
+                conn.execute("INSERT INTO messages_fts(rowid, body) SELECT id, replace(replace(body, 'ё', 'е'), 'Ё', 'Е') FROM messages")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logging.info(f"Поисковый индекс истории перестроен за {time.perf_counter() - started:.2f} с.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось перестроить поисковый индекс: {e}")
+
+    # --- чтение ---
+    def _query(self, sql, params):
+        if not self.reader: return []
+        try:
+            return self.reader.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка чтения истории: {e}")
+            return []
+
+    def load_dialog(self, account, channel, partner="", limit=1000):
+        # Последние limit сообщений диалога по возрастанию времени: (sender, body, ts).
+        rows = self._query("SELECT sender, body, ts FROM messages WHERE account = ? AND channel = ? AND partner = ? ORDER BY ts DESC LIMIT ?", (account, channel, partner, limit))
+        rows.reverse()
+        return rows
+
+    def newer_copies(self, msg_id, account, channel, partner, sender, body):
+        # Сколько таких же сообщений (отправитель и текст) в диалоге новее msg_id: по этому
+        # номеру окно чата находит именно найденное сообщение среди повторов вроде «ок».
+        rows = self._query("SELECT COUNT(*) FROM messages WHERE account = ? AND channel = ? AND partner = ? AND sender = ? AND body = ? AND id > ?",
+                           (account, channel, partner, sender, body, msg_id))
+        return rows[0][0] if rows else 0
+
+    def partners(self, account):
+        # Собеседники по ЛС, начиная с последнего активного.
+        rows = self._query("SELECT partner, MAX(ts) AS last_ts FROM messages WHERE account = ? AND channel = 'pm' GROUP BY partner ORDER BY last_ts DESC", (account,))
+        return [row[0] for row in rows]
+
+    def search(self, account, query, limit=200):
+        # Каждое слово запроса — префикс, все слова обязательны. Новые сообщения первыми:
+        # обход по rowid не требует ранжировать все совпадения.
+        tokens = SEARCH_TOKEN_RE.findall(query.translate(YO_TABLE))
+        if not tokens: return []
+        match = " ".join(f'"{token}"*' for token in tokens)
+        return self._query(
+            "SELECT m.id, m.channel, m.partner, m.sender, m.body, m.ts FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ? AND m.account = ? ORDER BY messages_fts.rowid DESC LIMIT ?", (match, account, limit))
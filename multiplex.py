@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import socket
+import struct
+from collections import deque
+
+# ------------------------------
+# Формат кадров
+# ------------------------------
+# После приветствия MUX соединение несёт кадры <тип, 1 байт><поток, 4 байта><длина, 4 байта><данные>.
+# Поток 0 — командный канал; остальные открывает клиент кадром OPEN с тем же приветствием,
+# что и у отдельного соединения («UPLOAD <id>», «DOWNLOAD <id>»).
+MUX_HEADER = struct.Struct(">BII")
+WINDOW_INCREMENT = struct.Struct(">I")
+DATA, OPEN, WINDOW, CLOSE, RESET = range(5)
+COMMAND_STREAM = 0
+STREAM_WINDOW = 512 * 1024         # столько байт поток шлёт без подтверждения получателя
+STREAM_BUFFER_LIMIT = 256 * 1024   # drain() потока ждёт, пока его очередь больше этого
+MUX_CHUNK = 16 * 1024              # кадр данных файла; между кадрами проходят сообщения чата
+MUX_BULK_WATERMARK = 64 * 1024     # данные файлов докладываются в сокет, только пока в нём меньше
+MAX_MUX_FRAME = 1024 * 1024
+
+class MuxStream:
+    """Поток внутри мультиплексированного соединения.
+
+    Обработчикам сервера он заменяет пару StreamReader/StreamWriter (read,
+    readline, readexactly, write, drain, close, transport.abort), клиенту —
+    сокет передачи (sendall, sendfile, recv_into). Прочитанное возвращается
+    отправителю кадрами WINDOW: медленный получатель сдерживает только свой
+    поток, а не всё соединение. Поток 0 окном не ограничен.
+    """
+
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.id = stream_id
+        self.inbox = asyncio.StreamReader()
+        self.outgoing = bytearray()
+        self.send_window = self.recv_window = STREAM_WINDOW
+        self.unacked = 0
+        self.closing = self.close_sent = self.eof_received = False
+        self.error = None
+        self.progress = asyncio.Event()  # очередь уменьшилась, CLOSE ушёл или поток сброшен
+        self.transport = self            # для writer.transport.abort() и get_write_buffer_size()
+
+    # --- Чтение ---
+    async def read(self, n=65536):
+        return self._consumed(await self.inbox.read(n))
+
+    async def readline(self):
+        return self._consumed(await self.inbox.readline())
+
+    async def readexactly(self, n):
+        return self._consumed(await self.inbox.readexactly(n))
+
+    async def recv_into(self, view):
+        data = await self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _consumed(self, data):
+        if self.id != COMMAND_STREAM and data:
+            self.unacked += len(data)
+            if self.unacked >= STREAM_WINDOW // 2:
+                self.recv_window += self.unacked
+                self.connection._send_frame(WINDOW, self.id, WINDOW_INCREMENT.pack(self.unacked))
+                self.unacked = 0
+        return data
+
+    # --- Запись ---
+    def write(self, data):
+        if self.error: raise self.error
+        if self.closing: raise BrokenPipeError("Поток уже закрыт.")
+        if self.id == COMMAND_STREAM:
+            for start in range(0, len(data), MAX_MUX_FRAME):
+                self.connection._send_frame(DATA, self.id, data[start:start + MAX_MUX_FRAME])
+            return
+        self.outgoing += data
+        self.connection._schedule(self)
+
+    async def drain(self):
+        if self.id == COMMAND_STREAM:
+            await self.connection.writer.drain()
+            return
+        while len(self.outgoing) > STREAM_BUFFER_LIMIT and not self.error:
+            self.progress.clear()
+            await self.progress.wait()
+        if self.error: raise self.error
+
+    async def sendall(self, data):
+        self.write(data)
+        await self.drain()
+
+    async def sendfile(self, f, offset, count):
+        # sendfile в кадры не попадает: файл читается кусками в пуле потоков.
+        loop = asyncio.get_running_loop()
+
+        def read_at(position, size):
+            f.seek(position)
+            return f.read(size)
+
+        end = offset + count
+        while offset < end:
+            data = await loop.run_in_executor(None, read_at, offset, min(STREAM_BUFFER_LIMIT, end - offset))
+            if not data:
+                raise ConnectionError("Файл укоротился во время отправки.")
+            await self.sendall(data)
+            offset += len(data)
+
+    def is_closing(self):
+        if self.id == COMMAND_STREAM:
+            return self.connection.closed or self.connection.writer.is_closing()
+        return self.closing or self.error is not None
+
+    def close(self):
+        # CLOSE уходит после всей очереди потока; закрытие потока 0 закрывает соединение.
+        if self.id == COMMAND_STREAM:
+            self.connection.close()
+            return
+        if self.closing or self.error: return
+        self.closing = True
+        self.connection._schedule(self)
+
+    async def wait_closed(self):
+        if self.id == COMMAND_STREAM:
+            await self.connection.wait_closed()
+            return
+        while not (self.close_sent or self.error):
+            self.progress.clear()
+            await self.progress.wait()
+
+    def abort(self):
+        if self.id == COMMAND_STREAM:
+            self.connection.abort()
+            return
+        if self.error: return
+        self.connection._send_frame(RESET, self.id)
+        self._fail(ConnectionResetError("Поток закрыт."))
+
+    def get_write_buffer_size(self):
+        return len(self.outgoing) + self.connection.writer.transport.get_write_buffer_size()
+
+    def get_extra_info(self, name, default=None):
+        # Сокет общий для всех потоков: настраивать его (TCP_CORK и т.п.) ради одного потока нельзя.
+        if name == "socket": return default
+        if name == "peername": return self.connection.peername
+        if self.connection.closed: return default
+        return self.connection.writer.get_extra_info(name, default)
+
+    # --- Кадры от собеседника ---
+    def _feed(self, data):
+        if self.id != COMMAND_STREAM:
+            self.recv_window -= len(data)
+            if self.recv_window < 0:
+                raise ConnectionError(f"Поток {self.id} превысил окно.")
+        self.inbox.feed_data(data)
+
+    def _feed_eof(self):
+        self.eof_received = True
+        self.inbox.feed_eof()
+        self.connection._forget_if_done(self)
+
+    def _fail(self, error):
+        if self.error: return
+        self.error = error
+        self.outgoing.clear()
+        if not self.inbox.at_eof():
+            self.inbox.set_exception(error)
+        self.progress.set()
+        self.connection.streams.pop(self.id, None)
+
+class MuxConnection:
+    """Одно TCP-соединение клиента, в котором идут командный канал и передачи файлов.
+
+    Кадры чата и служебные кадры пишутся в сокет сразу. Данные файлов пишет
+    отдельная задача: по кадру MUX_CHUNK от каждого потока по очереди и только
+    пока в буфере сокета меньше MUX_BULK_WATERMARK, поэтому сообщение чата
+    ждёт не дольше отправки одного такого буфера, сколько бы файлов ни шло.
+    on_open(поток, приветствие) — корутина сервера для потоков, открытых клиентом.
+    """
+
+    def __init__(self, reader, writer, on_open=None):
+        self.reader = reader
+        self.writer = writer
+        self.on_open = on_open
+        self.streams = {}
+        self.command = self.streams[COMMAND_STREAM] = MuxStream(self, COMMAND_STREAM)
+        self.next_id = 1
+        self.ready = deque()     # потоки, которым есть что отправить, по очереди
+        self.wakeup = asyncio.Event()
+        self.handlers = set()
+        self.closed = False
+        # Закрытый транспорт TLS не отвечает на get_extra_info, а адрес нужен и после закрытия, для журнала.
+        self.peername = writer.get_extra_info("peername")
+        writer.transport.set_write_buffer_limits(high=MUX_BULK_WATERMARK)
+        sock = writer.get_extra_info("socket")
+        if sock is not None and hasattr(socket, "TCP_NOTSENT_LOWAT"):
+            # Иначе ядро примет в буфер сокета мегабайты файла, и чат встанет за ними.
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, MUX_BULK_WATERMARK)
+            except OSError:
+                pass
+        self.reader_task = asyncio.create_task(self._read_frames())
+        self.sender_task = asyncio.create_task(self._send_bulk())
+
+    def open_stream(self, greeting):
+        if self.closed:
+            raise ConnectionError("Соединение с сервером закрыто.")
+        stream = self.streams[self.next_id] = MuxStream(self, self.next_id)
+        self.next_id += 1
+        self._send_frame(OPEN, stream.id, greeting.encode("utf-8"))
+        return stream
+
+    def close(self):
+        if self.closed: return
+        self._shutdown()
+        self.reader_task.cancel()
+
+    def abort(self):
+        self.writer.transport.abort()
+        self.close()
+
+    async def wait_closed(self):
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    def _send_frame(self, kind, stream_id, payload=b""):
+        if self.closed or self.writer.is_closing(): return
+        self.writer.write(MUX_HEADER.pack(kind, stream_id, len(payload)) + payload)
+
+    def _schedule(self, stream):
+        if stream not in self.ready:
+            self.ready.append(stream)
+        self.wakeup.set()
+
+    def _forget_if_done(self, stream):
+        if stream.id != COMMAND_STREAM and stream.close_sent and stream.eof_received:
+            self.streams.pop(stream.id, None)
+
+    async def _read_frames(self):
+        try:
+            while True:
+                kind, stream_id, length = MUX_HEADER.unpack(await self.reader.readexactly(MUX_HEADER.size))
+                if length > MAX_MUX_FRAME:
+                    raise ConnectionError(f"Слишком большой кадр: {length} байт.")
+                payload = await self.reader.readexactly(length) if length else b""
+                stream = self.streams.get(stream_id)
+                if kind == OPEN:
+                    if self.on_open is None or stream is not None or stream_id == COMMAND_STREAM:
+                        self._send_frame(RESET, stream_id)
+                        continue
+                    stream = self.streams[stream_id] = MuxStream(self, stream_id)
+                    handler = asyncio.create_task(self.on_open(stream, payload.decode("utf-8", "replace").strip()))
+                    self.handlers.add(handler)
+                    handler.add_done_callback(self.handlers.discard)
+                elif stream is None:
+                    continue  # поток здесь уже закрыт или сброшен, хвост его кадров не нужен
+                elif kind == DATA:
+                    stream._feed(payload)
+                elif kind == WINDOW:
+                    stream.send_window += WINDOW_INCREMENT.unpack(payload)[0]
+                    self._schedule(stream)
+                elif kind == CLOSE:
+                    stream._feed_eof()
+                elif kind == RESET:
+                    stream._fail(ConnectionResetError("Поток сброшен собеседником."))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, struct.error) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                logging.info(f"Мультиплексированное соединение {self.writer.get_extra_info('peername')} прервано: {e}")
+        finally:
+            self._shutdown()
+
+    async def _send_bulk(self):
+        try:
+            while True:
+                if not self.ready:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                stream = self.ready.popleft()
+                if stream.error: continue
+                if stream.outgoing and stream.send_window > 0:
+                    size = min(MUX_CHUNK, len(stream.outgoing), stream.send_window)
+                    self._send_frame(DATA, stream.id, bytes(stream.outgoing[:size]))
+                    del stream.outgoing[:size]
+                    stream.send_window -= size
+                    stream.progress.set()
+                elif not stream.outgoing and stream.closing and not stream.close_sent:
+                    self._send_frame(CLOSE, stream.id)
+                    stream.close_sent = True
+                    stream.progress.set()
+                    self._forget_if_done(stream)
+                    continue
+                else:
+                    continue  # окно исчерпано: поток вернётся в очередь с кадром WINDOW
+                if stream.outgoing or stream.closing:
+                    self.ready.append(stream)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+
+    def _shutdown(self):
+        if self.closed: return
+        self.closed = True
+        self.sender_task.cancel()
+        for stream in list(self.streams.values()):
+            if stream.id == COMMAND_STREAM:
+                stream._feed_eof()
+            else:
+                stream._fail(ConnectionResetError("Соединение потеряно."))
+        self.writer.close()
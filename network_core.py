@@ -0,0 +1,928 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+from multiplex import MuxConnection
+from tls_transport import TlsClientContext
+from transport_profiles import TransportProfiles
+
+# ------------------------------
+# Параметры сети
+# ------------------------------
+BROADCAST_PORT = 9999
+DISCOVERY_PORT = 9998
+DISCOVERY_WINDOW = 0.3
+PROBE_RETRY_INTERVAL = 1.0
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 15.0
+RECONNECT_ATTEMPTS = 30
+KEEPALIVE_INTERVAL = 60
+HANDSHAKE_TIMEOUT = 10.0
+MAX_CONCURRENT_TRANSFERS = 3
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024     # не меньше: в этот же буфер читаются кадры сжатого потока
+DIRECT_CONNECT_TIMEOUT = 3.0           # получатель быстро сдаётся и уходит на передачу через сервер
+DIRECT_ACCEPT_TIMEOUT = 30.0           # столько отправитель ждёт прямого подключения
+PROGRESS_INTERVAL = 0.25               # не чаще 4 обновлений прогресса в секунду на передачу
+RECEIVE_CHUNK_SIZE = 65536
+COMMAND_COMPRESSION_LEVEL = 6          # строки чата короткие, уровень почти не влияет на CPU
+
+# Сжатие файлов: поток кадров <длина, 4 байта><данные zlib>, кадр нулевой длины — конец.
+COMPRESSION_LEVEL = 1                  # в локальной сети важнее скорость сжатия, чем степень
+COMPRESSION_CHUNK = 256 * 1024         # столько байт файла сжимается за один заход в пул потоков
+COMPRESSION_SAMPLE = 64 * 1024
+COMPRESSION_MIN_SIZE = 16 * 1024       # мелкие файлы не стоят лишнего прохода
+COMPRESSION_MIN_RATIO = 0.9            # пробы сжались хуже — файл шлём как есть
+MAX_COMPRESSED_FRAME = 1024 * 1024
+FRAME_HEADER = struct.Struct(">I")
+# Форматы, которые уже сжаты: их не имеет смысла даже пробовать.
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".jar", ".apk",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".ogg", ".opus", ".flac", ".aac", ".m4a",
+    ".mp4", ".mkv", ".avi", ".mov", ".webm",
+    ".docx", ".xlsx", ".pptx", ".odt",
+}
+
+def reconnect_delay(attempt):
+    # Экспоненциальная задержка со случайным разбросом, чтобы после смены точки
+    # доступа клиенты не ломились на сервер одновременно.
+    return min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+def server_load_score(info):
+    # Старые серверы не присылают подсказок нагрузки и считаются свободными.
+    return info.get("users", 0) + 5 * info.get("transfers", 0) + 50 * info.get("cpu", 0.0)
+
+def parse_direct_ready(p):
+    # DIRECT_READY <transfer_id> <host> <port> <token> <size> <from_user> <filename> [zlib]
+    token, filesize, from_user, filename, *encoding = p[4].split(" ")
+    return {"type": "direct_ready", "transfer_id": p[1], "host": p[2], "port": int(p[3]), "token": token,
+            "filesize": int(filesize), "from_user": from_user, "filename": filename, "encoding": encoding[0] if encoding else "raw"}
+
+def choose_encoding(filepath):
+    # "zlib", если файл стоит сжимать: по расширению и по пробам из начала, середины и конца.
+    if os.path.splitext(filepath)[1].lower() in INCOMPRESSIBLE_EXTENSIONS: return "raw"
+    try:
+        with open(filepath, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < COMPRESSION_MIN_SIZE: return "raw"
+            raw = packed = 0
+            for offset in {0, max(0, size // 2 - COMPRESSION_SAMPLE // 2), max(0, size - COMPRESSION_SAMPLE)}:
+                f.seek(offset)
+                sample = f.read(COMPRESSION_SAMPLE)
+                raw += len(sample)
+                packed += len(zlib.compress(sample, COMPRESSION_LEVEL))
+    except OSError:
+        return "raw"
+    return "zlib" if raw and packed / raw < COMPRESSION_MIN_RATIO else "raw"
+
+# Таблица команд сервера и шаблоны строк чата строятся один раз при импорте.
+SERVER_COMMANDS = {
+    "USER_LIST": lambda p: {"type": "user_list_update", "users": p[1].split(',') if len(p) > 1 else []},
+    "FILE_INCOMING": lambda p: {"type": "file_incoming", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
+    "UPLOAD_PROCEED": lambda p: {"type": "upload_proceed", "transfer_id": p[1], "port": int(p[2]), "request_id": p[3] if len(p) > 3 else None,
+                                 "encoding": p[4] if len(p) > 4 else "raw"},
+    "UPLOAD_REJECTED": lambda p: {"type": "upload_rejected", "request_id": p[1][1:], "reason": " ".join(p[2:])} if len(p) > 1 and p[1].startswith("#")
+                                 else {"type": "upload_rejected", "request_id": None, "reason": " ".join(p[1:])},
+    "FILE_CANCELLED": lambda p: {"type": "file_cancelled", "transfer_id": p[1], "by_user": p[2]},
+    "DIRECT_PREPARE": lambda p: {"type": "direct_prepare", "transfer_id": p[1], "token": p[2], "request_id": p[3] if len(p) > 3 else None,
+                                 "encoding": p[4] if len(p) > 4 else "raw"},
+    "DIRECT_READY": lambda p: parse_direct_ready(p),
+    "DOWNLOAD_READY": lambda p: {"type": "download_ready", "from_user": p[1], "filename": p[2], "filesize": int(p[3]), "transfer_id": p[4]},
+    "DOWNLOAD_PROCEED": lambda p: {"type": "download_proceed", "transfer_id": p[1], "port": int(p[2]), "encoding": p[3] if len(p) > 3 else "raw"},
+    "SERVER_MSG": lambda p: {"type": "system_message", "text": " ".join(p[1:]), "class_key": "info_msg"}
+}
+CHAT_LINE_RE = re.compile(r"\[(.*?)\]\s(\(PM от (.*?)\):|\(PM для (.*?)\):|(.*?):)\s(.*)$")
+SYSTEM_LINE_RE = re.compile(r"\[(.*?)\]\s\*\*\*\s(.*)\s\*\*\*$")
+
+def parse_server_line(line: str):
+    handler = SERVER_COMMANDS.get(line.partition(" ")[0])
+    if handler: return handler(line.split(" ", 4))
+    if line.startswith("["):
+        match_msg = CHAT_LINE_RE.match(line)
+        if match_msg:
+            ts, _, from_user_pm, to_user_pm, from_user_public, text = match_msg.groups()
+            partner = from_user_pm if from_user_pm else to_user_pm
+            if partner:
+                return {"type": "pm_message", "partner": partner, "text": text, "from_me": bool(to_user_pm)}
+            else:
+                 return {"type": "new_message", "username": from_user_public, "text": text, "timestamp": ts}
+        match_sys = SYSTEM_LINE_RE.match(line)
+        if match_sys: return {"type": "system_message", "text": match_sys.group(2), "class_key": "system_msg", "timestamp": match_sys.group(1)}
+    return {"type": "system_message", "text": line, "class_key": "info_msg"}
+
+class LineDecoder:
+    """Потоковый разбор строк командного канала.
+
+    Данные дописываются в один bytearray, строки вырезаются по смещению через
+    memoryview без копирования хвоста; прочитанное начало буфера удаляется, только
+    когда его накопилось много или буфер опустел.
+    """
+    COMPACT_THRESHOLD = 65536
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        lines = []
+        start = self.offset
+        find = buffer.find
+        with memoryview(buffer) as view:
+            while (end := find(b"\n", start)) >= 0:
+                lines.append(str(view[start:end], "utf-8", "ignore").strip())
+                start = end + 1
+        if start == len(buffer):
+            buffer.clear()
+            start = 0
+        elif start >= self.COMPACT_THRESHOLD:
+            del buffer[:start]
+            start = 0
+        self.offset = start
+        return lines
+
+class CommandChannel:
+    """Командное соединение с сервером: строки в обе стороны.
+
+    Если сервер согласился на сжатие (CMD zlib -> AUTH_REQUEST zlib), каждое
+    направление — один поток zlib на всё соединение, и после каждой записи
+    делается Z_SYNC_FLUSH, как в permessage-deflate: собеседник сразу может
+    распаковать всё пришедшее, а словарь накапливается между сообщениями.
+    """
+
+    def __init__(self, reader, writer, mux=None):
+        self.reader = reader
+        self.writer = writer
+        self.mux = mux  # MuxConnection, если чат и передачи идут по одному соединению
+        self.decoder = LineDecoder()
+        self.lines = deque()
+        self.compressor = None
+        self.decompressor = None
+
+    def enable_compression(self):
+        self.compressor = zlib.compressobj(COMMAND_COMPRESSION_LEVEL)
+        self.decompressor = zlib.decompressobj()
+
+    def write_line(self, message):
+        data = (message + "\n").encode("utf-8")
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(data)
+
+    async def read_lines(self):
+        # Все строки, пришедшие к этому моменту; пустой список — соединение закрыто.
+        if self.lines:
+            lines = list(self.lines)
+            self.lines.clear()
+            return lines
+        while True:
+            data = await self.reader.read(RECEIVE_CHUNK_SIZE)
+            if not data: return []
+            if self.decompressor:
+                data = self.decompressor.decompress(data)
+            lines = self.decoder.feed(data)
+            if lines: return lines
+
+    async def readline(self):
+        if not self.lines:
+            self.lines.extend(await self.read_lines())
+        return self.lines.popleft() if self.lines else ""
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+class TransferProgress:
+    """Прогресс одной передачи для GUI: байты, скорость, оставшееся время.
+
+    done и total считаются в байтах файла, wire — сколько ушло по сети (меньше при сжатии).
+    """
+
+    def __init__(self, emit, transfer_id, direction, filename, total, mode="relay", encoding="raw"):
+        self.emit = emit
+        self.transfer_id = transfer_id
+        self.direction = direction
+        self.mode = mode
+        self.encoding = encoding
+        self.filename = filename
+        self.total = total
+        self.done = 0
+        self.wire = 0
+        self.rate = 0.0
+        self.started = self.last_time = time.monotonic()
+        self.last_done = 0
+
+    def update(self, done, wire=None):
+        self.done = done
+        self.wire = done if wire is None else wire
+        now = time.monotonic()
+        if now - self.last_time < PROGRESS_INTERVAL: return
+        # Скользящее среднее, чтобы скорость и ETA не прыгали от куска к куску.
+        instant = (done - self.last_done) / (now - self.last_time)
+        self.rate = instant if not self.rate else 0.3 * instant + 0.7 * self.rate
+        self.last_time, self.last_done = now, done
+        self._emit("active")
+
+    def finish(self, state, error=None):
+        elapsed = time.monotonic() - self.started
+        if elapsed > 0: self.rate = self.done / elapsed
+        self._emit(state, error)
+
+    def _emit(self, state, error=None):
+        eta = (self.total - self.done) / self.rate if self.rate and state == "active" else None
+        self.emit({"type": "transfer_progress", "transfer_id": self.transfer_id, "direction": self.direction, "mode": self.mode, "filename": self.filename,
+                   "done": self.done, "total": self.total, "encoding": self.encoding, "wire": self.wire, "rate": self.rate, "eta": eta, "state": state, "error": error})
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.servers = {}
+        self.found = asyncio.Event()
+
+    def datagram_received(self, data, addr):
+        try:
+            server_info = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        if isinstance(server_info, dict) and server_info.get("app_name") == "python_chat" and "host" in server_info and "port" in server_info:
+            self.servers[(server_info["host"], server_info["port"])] = server_info
+            self.found.set()
+
+
+# ------------------------------
+# Сетевое ядро клиента
+# ------------------------------
+class SocketConnection:
+    """Передача по отдельному «сырому» неблокирующему сокету.
+
+    Тот же набор методов, что у потока MuxStream: код передач не знает,
+    идёт ли файл своим соединением или потоком общего.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+
+    async def sendall(self, data):
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def sendfile(self, f, offset, count):
+        # Ядро копирует файл в сокет само (os.sendfile); где его нет,
+        # asyncio читает файл крупными блоками.
+        await self.loop.sock_sendfile(self.sock, f, offset, count, fallback=True)
+
+    async def recv_into(self, view):
+        return await self.loop.sock_recv_into(self.sock, view)
+
+    def close(self):
+        self.sock.close()
+
+    abort = close
+
+class StreamConnection:
+    """Передача по шифрованному соединению (TLS) с тем же набором методов.
+
+    Копировать файл в сокет ядром под TLS нельзя: кусок файла читается в пуле
+    потоков целиком (запасной sendfile asyncio ходит в пул за каждыми 16 КБ)
+    и шифруется asyncio. При закрытии запоминается сессия TLS — с её билетом
+    следующая передача обойдётся без полного рукопожатия.
+    """
+
+    def __init__(self, reader, writer, tls, host):
+        self.reader = reader
+        self.writer = writer
+        self.sock = None  # без TCP_CORK: под TLS пробка втрое замедляет передачу
+        self.tls = tls
+        self.host = host
+        self.loop = asyncio.get_running_loop()
+
+    async def sendall(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def sendfile(self, f, offset, count):
+        def read_at():
+            f.seek(offset)
+            return f.read(count)
+
+        self.writer.write(await self.loop.run_in_executor(None, read_at))
+        await self.writer.drain()
+
+    async def recv_into(self, view):
+        data = await self.reader.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.tls.remember(self.writer.get_extra_info("ssl_object"), self.host)
+        self.writer.close()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+class ClientNetworkCore:
+    """Один фоновый поток с циклом asyncio владеет всеми сокетами клиента.
+
+    Методы без подчёркивания вызываются из потока Tk и только планируют работу
+    в цикле; всё, что нужно показать пользователю, приходит событиями в очередь
+    events, после каждого события вызывается notify, чтобы разбудить GUI.
+    При multiplex чат и передачи через сервер идут одним соединением (MUX),
+    если сервер его не знает — отдельными, как раньше. transport_profiles —
+    настройки сокетов и размеров кусков передачи (transport_profiles.py).
+    С tls все соединения с сервером шифруются (tls_transport.py), tls_pins —
+    закреплённые отпечатки сертификатов серверов, словарь из настроек.
+    """
+
+    def __init__(self, events, notify=None, compress=True, multiplex=False, transport_profiles=None, tls=False, tls_pins=None):
+        self.events = events
+        self.notify = notify
+        self.compress = compress
+        self.multiplex = multiplex
+        self.transport_profiles = transport_profiles or TransportProfiles()
+        self.tls = TlsClientContext(tls_pins) if tls else None
+        self.tls_servers = {}  # (host, port) -> (порт TLS, отпечаток) из маяков и ответов TLS_PORT
+        self.loop = None
+        self.thread = None
+        self.status = "disconnected"
+        self.host = ""
+        self.port = 0
+        self.username = ""
+        self.channel = None
+        self.resume_token = None
+        self.session_seq = 0
+        self.reconnect_spread = 0.0  # подсказка сервера при тёплом перезапуске
+        self.outgoing_backlog = []
+        self._tasks = set()
+        self._discovery_task = None
+        self._transfer_tasks = {}  # transfer_id -> задача передачи, для отмены
+        self._ready = threading.Event()
+
+    # --- Вызовы из потока Tk ---
+    def start(self):
+        self.thread = threading.Thread(target=self._run_loop, name="network-core", daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if not self.loop or not self.loop.is_running(): return
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        try:
+            future.result(timeout=2.0)
+        except Exception as e:
+            logging.warning(f"Сетевое ядро остановлено некорректно: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2.0)
+
+    def discover(self):
+        self._call(self._start_discovery)
+
+    def connect(self, host, port, username):
+        self._call(self._spawn, self._connect(host, port, username))
+
+    def send(self, message):
+        if self.status not in ("connected", "reconnecting"):
+            return False
+        self._call(self._write_line, message)
+        return True
+
+    def upload(self, transfer_id, filepath, port, encoding="raw"):
+        self._call(self._start_transfer, transfer_id, self._upload(transfer_id, filepath, port, encoding))
+
+    def download(self, transfer_id, info, port, encoding="raw"):
+        self._call(self._start_transfer, transfer_id, self._download(transfer_id, info, port, encoding=encoding))
+
+    def serve_direct(self, transfer_id, filepath, token, encoding="raw"):
+        self._call(self._start_transfer, transfer_id, self._serve_direct(transfer_id, filepath, token, encoding))
+
+    def download_direct(self, transfer_id, info, host, port, token, encoding="raw"):
+        self._call(self._start_transfer, transfer_id, self._download(transfer_id, info, port, host=host, greeting=f"DIRECT {transfer_id} {token}", encoding=encoding))
+
+    def cancel_transfer(self, transfer_id):
+        self._call(self._cancel_transfer, transfer_id)
+
+    def _call(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def _emit(self, event):
+        self.events.put(event)
+        if self.notify:
+            self.notify()
+
+    # --- Цикл событий ---
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+            logging.info("Сетевое ядро остановлено.")
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _shutdown(self):
+        if self.status == "connected":
+            self._write_line("/quit")
+        self.status = "disconnected"
+        if self.channel:
+            self.channel.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+    # --- Автообнаружение ---
+    def _start_discovery(self):
+        if self._discovery_task and not self._discovery_task.done(): return
+        self._discovery_task = self._spawn(self._discover())
+
+    async def _discover(self):
+        loop = asyncio.get_running_loop()
+        protocol = DiscoveryProtocol()
+        transports = []
+        try:
+            probe_transport, _ = await loop.create_datagram_endpoint(
+                lambda: protocol, local_addr=("0.0.0.0", 0), allow_broadcast=True)
+            transports.append(probe_transport)
+            beacon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            beacon_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                beacon_socket.bind(("", BROADCAST_PORT))
+                beacon_transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=beacon_socket)
+                transports.append(beacon_transport)
+            except OSError as e:
+                beacon_socket.close()
+                logging.warning(f"Порт маяков {BROADCAST_PORT} недоступен, только зонды: {e}")
+
+            probe = json.dumps({"app_name": "python_chat", "type": "probe"}).encode()
+            logging.info(f"Поиск сервера: зонды на UDP порт {DISCOVERY_PORT}, маяки на UDP порту {BROADCAST_PORT}...")
+            while self.status == "disconnected":
+                for target in ("<broadcast>", "127.0.0.1"):
+                    try:
+                        probe_transport.sendto(probe, (target, DISCOVERY_PORT))
+                    except OSError as e:
+                        logging.debug(f"Не удалось отправить зонд на {target}: {e}")
+                try:
+                    await asyncio.wait_for(protocol.found.wait(), PROBE_RETRY_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                # После первого ответа ждём остальные серверы ещё короткое окно.
+                await asyncio.sleep(DISCOVERY_WINDOW)
+                servers = list(protocol.servers.values())
+                for info in servers:
+                    if "tls_port" in info:
+                        self.tls_servers[(info["host"], info["port"])] = (info["tls_port"], info.get("tls_fingerprint"))
+                server_info = min(servers, key=server_load_score)
+                logging.info(f"Сервер найден: {server_info['host']}:{server_info['port']} (из {len(servers)}, нагрузка {server_load_score(server_info):.1f})")
+                self._emit({"type": "server_found", "host": server_info["host"], "port": server_info["port"]})
+                return
+        except Exception as e:
+            logging.error(f"Ошибка UDP сокета: {e}")
+            self._emit({"type": "discovery_error", "message": str(e)})
+        finally:
+            for transport in transports:
+                transport.close()
+
+    # --- Командный канал ---
+    async def _tls_endpoint(self):
+        # Порт TLS и отпечаток: из маяка, а если адрес введён вручную — у самого сервера.
+        if (self.host, self.port) not in self.tls_servers:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), HANDSHAKE_TIMEOUT)
+            try:
+                writer.write(b"TLS\n")
+                reply = (await asyncio.wait_for(reader.readline(), HANDSHAKE_TIMEOUT)).decode("utf-8", "ignore").split()
+            finally:
+                writer.close()
+            if len(reply) < 3 or reply[0] != "TLS_PORT" or not reply[1].isdigit():
+                raise ConnectionError("Сервер не поддерживает шифрование (TLS).")
+            self.tls_servers[(self.host, self.port)] = int(reply[1]), reply[2]
+        return self.tls_servers[(self.host, self.port)]
+
+    async def _open_tls_stream(self, kind, port=None):
+        # Шифрованное соединение с сервером: командное (port=None) или передача на порт из *_PROCEED.
+        tls, advertised = self.tls, None
+        if port is None:
+            port, advertised = await self._tls_endpoint()
+        sock = await self._open_transfer_socket(port, kind=kind)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(sock=sock, ssl=tls, server_hostname=self.host), HANDSHAKE_TIMEOUT)
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            tls.verify(writer.get_extra_info("ssl_object"), self.host, advertised)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _open_command_connection(self, auth_line):
+        multiplex = self.multiplex
+        if self.tls:
+            reader, writer = await self._open_tls_stream("mux" if multiplex else "command")
+        else:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), HANDSHAKE_TIMEOUT)
+            self.transport_profiles.apply(writer.get_extra_info("socket"), "mux" if multiplex else "command")
+        # Старый сервер не знает про zlib и ответит просто AUTH_REQUEST — тогда без сжатия.
+        writer.write(f"{'MUX' if multiplex else 'CMD'}{' zlib' if self.compress else ''}\n".encode())
+        if multiplex:
+            mux = MuxConnection(reader, writer)
+            channel = CommandChannel(mux.command, mux.command, mux)
+        else:
+            channel = CommandChannel(reader, writer)
+        try:
+            request = (await asyncio.wait_for(channel.readline(), HANDSHAKE_TIMEOUT)).split()
+            if not request and multiplex:
+                # Сервер без MUX закрывает соединение с неизвестным приветствием.
+                logging.info("Сервер не поддерживает мультиплексирование, чат и файлы пойдут отдельными соединениями.")
+                self.multiplex = False
+                channel.close()
+                return await self._open_command_connection(auth_line)
+            if request and request[0] == "AUTH_ERROR":
+                raise ConnectionError(" ".join(request[1:]))
+            if not request or request[0] != "AUTH_REQUEST":
+                raise ConnectionError("Неверный ответ от сервера.")
+            if self.tls:
+                # Билеты TLS 1.3 приходят сразу после рукопожатия и к этому моменту уже прочитаны.
+                self.tls.remember(writer.get_extra_info("ssl_object"), self.host)
+            if "zlib" in request[1:]:
+                channel.enable_compression()
+            channel.write_line(auth_line)
+            response = await asyncio.wait_for(channel.readline(), HANDSHAKE_TIMEOUT)
+            if not response:
+                raise ConnectionError("Сервер закрыл соединение.")
+        except BaseException:
+            channel.close()
+            raise
+        return channel, response
+
+    async def _connect(self, host, port, username):
+        self.host, self.port, self.username = host, port, username
+        try:
+            channel, response = await self._open_command_connection(username)
+        except (OSError, asyncio.TimeoutError, zlib.error) as e:
+            logging.error(f"Ошибка подключения: {e}")
+            self._emit({"type": "connection_failed", "message": str(e) or type(e).__name__})
+            return
+        if not response.startswith("AUTH_SUCCESS"):
+            channel.close()
+            self._emit({"type": "connection_failed", "message": response.split(" ", 1)[-1]})
+            return
+        self._attach(channel)
+        self._emit({"type": "connection_success", "message": response.split(" ", 1)[-1], "host": host, "port": port})
+
+    def _attach(self, channel):
+        self.channel = channel
+        self.status = "connected"
+        self._spawn(self._receive_loop(channel))
+        self._spawn(self._keepalive_loop(channel))
+
+    def _write_line(self, message):
+        if self.status == "reconnecting":
+            # Отправим после переподключения.
+            self.outgoing_backlog.append(message)
+            return
+        if not self.channel or self.channel.is_closing(): return
+        self.channel.write_line(message)
+
+    async def _receive_loop(self, channel):
+        reason = "Сервер разорвал соединение."
+        logging.info("Приём сообщений запущен.")
+        try:
+            # Строки, пришедшие вместе с ответом на вход (SESSION, пропущенное), уже лежат в канале.
+            while lines := await channel.read_lines():
+                for line in lines:
+                    if line.startswith("SESSION "):
+                        # Сервер нумерует все строки после SESSION; номер нужен для RESUME.
+                        _, self.resume_token, seq = line.split(" ", 2)
+                        self.session_seq = int(seq)
+                        continue
+                    if line.startswith("RECONNECT "):
+                        # Сервер перезапускается: строка не нумеруется, в ней окно разброса переподключения, мс.
+                        hint = line[len("RECONNECT "):].strip()
+                        self.reconnect_spread = int(hint) / 1000 if hint.isdigit() else 0.0
+                        reason = "Сервер перезапускается."
+                        continue
+                    self.session_seq += 1
+                    if line:
+                        parsed = parse_server_line(line)
+                        if parsed: self._emit(parsed)
+        except (OSError, asyncio.IncompleteReadError, zlib.error):
+            reason = "Потеряно соединение с сервером."
+        except Exception as e:
+            logging.critical(f"Критическая ошибка приёма сообщений: {e}", exc_info=True)
+        logging.info("Приём сообщений завершен.")
+        if self.channel is channel:
+            self._connection_lost(reason)
+
+    async def _keepalive_loop(self, channel):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if channel is not self.channel or channel.is_closing(): return
+            self._write_line("/ping")
+            logging.info("Keep-alive ping sent.")
+
+    def _connection_lost(self, reason):
+        if self.status != "connected": return
+        self.status = "reconnecting"
+        if self.channel:
+            self.channel.close()
+        self._emit({"type": "connection_lost", "message": reason})
+        self._spawn(self._reconnect())
+
+    async def _reconnect(self):
+        spread, self.reconnect_spread = self.reconnect_spread, 0.0
+        for attempt in range(RECONNECT_ATTEMPTS):
+            # После перезапуска сервер уже слушает: первая попытка — сразу, вразброс в окне из подсказки.
+            await asyncio.sleep(random.uniform(0, spread) if spread and not attempt else reconnect_delay(attempt))
+            if self.status != "reconnecting": return
+            try:
+                if self.resume_token:
+                    channel, response = await self._open_command_connection(f"RESUME {self.resume_token} {self.session_seq}")
+                    if not response.startswith("AUTH_SUCCESS"):
+                        # Сессия истекла на сервере: входим заново под тем же именем.
+                        logging.info(f"Сессию восстановить не удалось: {response}")
+                        channel.close()
+                        self.resume_token = None
+                        channel, response = await self._open_command_connection(self.username)
+                else:
+                    channel, response = await self._open_command_connection(self.username)
+            except (OSError, asyncio.TimeoutError, zlib.error) as e:
+                logging.info(f"Попытка переподключения {attempt + 1} не удалась: {e}")
+                continue
+            if not response.startswith("AUTH_SUCCESS"):
+                channel.close()
+                self._reconnect_failed(response.split(" ", 1)[-1])
+                return
+            self._attach(channel)
+            backlog, self.outgoing_backlog = self.outgoing_backlog, []
+            for message in backlog:
+                self._write_line(message)
+            self._emit({"type": "reconnected", "message": response.split(" ", 1)[-1]})
+            return
+        self._reconnect_failed("Сервер недоступен.")
+
+    def _reconnect_failed(self, reason):
+        self.status = "disconnected"
+        self.channel = None
+        self.resume_token = None
+        self.outgoing_backlog.clear()
+        self._emit({"type": "reconnect_failed", "message": reason})
+
+    # --- Передача файлов ---
+    # Очередь и ограничение числа одновременных передач — в TransferManager на стороне GUI;
+    # ядро запускает передачу сразу и умеет её отменить.
+    def _start_transfer(self, transfer_id, coro):
+        task = self._spawn(coro)
+        self._transfer_tasks[transfer_id] = task
+        # Прямую передачу может сменить передача через сервер с тем же id — не удаляем чужую задачу.
+        task.add_done_callback(lambda t: self._transfer_tasks.pop(transfer_id) if self._transfer_tasks.get(transfer_id) is t else None)
+
+    def _cancel_transfer(self, transfer_id):
+        task = self._transfer_tasks.get(transfer_id)
+        if task: task.cancel()
+
+    async def _open_transfer_socket(self, port, host=None, timeout=HANDSHAKE_TIMEOUT, kind="bulk"):
+        # Передачи идут по «сырому» неблокирующему сокету: sendfile и recv_into
+        # недоступны через StreamReader/StreamWriter.
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        self.transport_profiles.apply(sock, kind)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (host or self.host, port)), timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def _open_transfer(self, greeting, port, host=None, timeout=HANDSHAKE_TIMEOUT, sending=False):
+        # Передача через сервер при мультиплексировании — новый поток в командном соединении.
+        mux = self.channel.mux if self.channel else None
+        if host is None and mux and not mux.closed:
+            return mux.open_stream(greeting)
+        if host is None and self.tls:
+            conn = StreamConnection(*await self._open_tls_stream("bulk", port), self.tls, self.host)
+        else:
+            conn = SocketConnection(await self._open_transfer_socket(port, host, timeout))
+        if sending:
+            # Приветствие уйдёт одним сегментом с началом файла; пробку снимет close().
+            self.transport_profiles.cork(conn.sock, "bulk", True)
+        try:
+            await conn.sendall(f"{greeting}\n".encode())
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def _upload(self, transfer_id, filepath, port, encoding="raw"):
+        filename = os.path.basename(filepath)
+        progress = TransferProgress(self._emit, transfer_id, "upload", filename, 0, encoding=encoding)
+        try:
+            conn = await self._open_transfer(f"UPLOAD {transfer_id}", port, sending=True)
+            try:
+                await self._send_file(conn, filepath, progress, encoding)
+            except BaseException:
+                conn.abort()
+                raise
+            conn.close()
+            progress.finish("done")
+            self._emit({"type": "system_message", "text": f"Файл {filename} успешно загружен на сервер.", "class_key": "success_msg"})
+        except asyncio.CancelledError:
+            progress.finish("cancelled")
+        except Exception as e:
+            progress.finish("error", str(e))
+            self._emit({"type": "system_message", "text": f"Ошибка загрузки файла: {e}", "class_key": "error_msg"})
+
+    async def _send_file(self, conn, filepath, progress, encoding="raw"):
+        with open(filepath, "rb") as f:
+            total = progress.total = os.fstat(f.fileno()).st_size
+            if encoding == "zlib":
+                await self._send_compressed(conn, f, progress)
+                return
+            sent = 0
+            chunk = self.transport_profiles.chunk()
+            while sent < total:
+                count = min(chunk.size, total - sent)
+                await conn.sendfile(f, sent, count)
+                sent += count
+                chunk.update(count)
+                progress.update(sent)
+
+    async def _send_compressed(self, conn, f, progress):
+        # Чтение и сжатие — в пуле потоков (zlib отпускает GIL): следующий кусок
+        # сжимается, пока предыдущий уходит в сеть.
+        loop = asyncio.get_running_loop()
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+
+        def next_frame():
+            data = f.read(COMPRESSION_CHUNK)
+            return len(data), compressor.compress(data) if data else compressor.flush()
+
+        done = wire = 0
+        pending = loop.run_in_executor(None, next_frame)
+        try:
+            while True:
+                consumed, payload = await pending
+                if consumed: pending = loop.run_in_executor(None, next_frame)
+                if payload:
+                    await conn.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+                    wire += FRAME_HEADER.size + len(payload)
+                done += consumed
+                progress.update(done, wire)
+                if not consumed: break
+            await conn.sendall(FRAME_HEADER.pack(0))
+            progress.update(done, wire + FRAME_HEADER.size)
+        finally:
+            pending.cancel()
+
+    async def _serve_direct(self, transfer_id, filepath, token, encoding="raw"):
+        # Отправитель слушает свободный порт; первый, кто предъявит токен, получает файл.
+        progress = TransferProgress(self._emit, transfer_id, "upload", os.path.basename(filepath), 0, mode="direct", encoding=encoding)
+        loop = asyncio.get_running_loop()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("0.0.0.0", 0))
+            listener.listen(4)
+            listener.setblocking(False)
+            self._emit({"type": "direct_listening", "transfer_id": transfer_id, "port": listener.getsockname()[1]})
+            deadline = loop.time() + DIRECT_ACCEPT_TIMEOUT
+            while True:
+                conn, addr = await asyncio.wait_for(loop.sock_accept(listener), max(0.0, deadline - loop.time()))
+                conn.setblocking(False)
+                self.transport_profiles.apply(conn, "bulk")
+                try:
+                    greeting = await asyncio.wait_for(self._read_greeting(conn), HANDSHAKE_TIMEOUT)
+                except (OSError, asyncio.TimeoutError, ConnectionError):
+                    greeting = None
+                if greeting == f"DIRECT {transfer_id} {token}": break
+                logging.warning(f"Отклонено прямое подключение от {addr} для {transfer_id}.")
+                conn.close()
+            listener.close()
+            self.transport_profiles.cork(conn, "bulk", True)
+            try:
+                await self._send_file(SocketConnection(conn), filepath, progress, encoding)
+            finally:
+                conn.close()
+            progress.finish("done")
+        except asyncio.CancelledError:
+            progress.finish("cancelled")
+        except asyncio.TimeoutError:
+            progress.finish("error", "получатель не подключился напрямую")
+        except Exception as e:
+            progress.finish("error", str(e))
+        finally:
+            listener.close()
+
+    async def _read_greeting(self, sock):
+        loop = asyncio.get_running_loop()
+        data = b""
+        while b"\n" not in data:
+            chunk = await loop.sock_recv(sock, 256)
+            if not chunk or len(data) > 512:
+                raise ConnectionError("Некорректное приветствие.")
+            data += chunk
+        return data.split(b"\n", 1)[0].decode("utf-8", "ignore").strip()
+
+    async def _download(self, transfer_id, info, port, host=None, greeting=None, encoding="raw"):
+        local_filepath = info['local_filepath']
+        filesize = info['filesize']
+        filename = info['filename']
+        mode = "direct" if greeting else "relay"
+        if host == "-": host = self.host
+        progress = TransferProgress(self._emit, transfer_id, "download", filename, filesize, mode=mode, encoding=encoding)
+        try:
+            if greeting:
+                conn = await self._open_transfer(greeting, port, host or self.host, DIRECT_CONNECT_TIMEOUT)
+            else:
+                conn = await self._open_transfer(f"DOWNLOAD {transfer_id}", port)
+            try:
+                chunk = self.transport_profiles.chunk()
+                buffer = memoryview(bytearray(max(DOWNLOAD_BUFFER_SIZE, chunk.maximum)))
+                bytes_received = 0
+                with open(local_filepath, "wb") as f:
+                    if encoding == "zlib":
+                        await self._receive_compressed(conn, f, buffer, filesize, progress)
+                    else:
+                        while bytes_received < filesize:
+                            received = await conn.recv_into(buffer[:min(chunk.size, filesize - bytes_received)])
+                            if not received:
+                                raise ConnectionError("Соединение потеряно во время скачивания.")
+                            f.write(buffer[:received])
+                            bytes_received += received
+                            progress.update(bytes_received)
+                            chunk.update(received)
+            except BaseException:
+                conn.abort()
+                raise
+            conn.close()
+            progress.finish("done")
+            self._emit({"type": "file_download_complete", "transfer_id": transfer_id, "filename": filename})
+        except asyncio.CancelledError:
+            progress.finish("cancelled")
+            if os.path.exists(local_filepath): os.remove(local_filepath)
+        except Exception as e:
+            progress.finish("error", str(e))
+            if mode == "relay":
+                # Ошибку прямой передачи пользователь не видит: TransferManager переключится на сервер.
+                self._emit({"type": "file_download_error", "transfer_id": transfer_id, "filename": filename, "error": str(e)})
+            if os.path.exists(local_filepath): os.remove(local_filepath)
+
+    async def _receive_compressed(self, conn, f, buffer, filesize, progress):
+        loop = asyncio.get_running_loop()
+        decompressor = zlib.decompressobj()
+        header = memoryview(bytearray(FRAME_HEADER.size))
+        written = wire = 0
+
+        def inflate(data):
+            # Распаковка и запись — в пуле потоков. max_length не даёт кадру
+            # раздуться в памяти больше, чем на один кусок.
+            nonlocal written
+            while True:
+                out = decompressor.decompress(data, COMPRESSION_CHUNK)
+                written += len(out)
+                if written > filesize:
+                    raise ConnectionError("Распакованный файл больше заявленного размера.")
+                f.write(out)
+                data = decompressor.unconsumed_tail
+                if not data and len(out) < COMPRESSION_CHUNK: return
+
+        while True:
+            await self._recv_exactly(conn, header)
+            length, = FRAME_HEADER.unpack(header)
+            wire += FRAME_HEADER.size + length
+            if not length: break
+            if length > min(len(buffer), MAX_COMPRESSED_FRAME):
+                raise ConnectionError("Некорректный кадр сжатого потока.")
+            await self._recv_exactly(conn, buffer[:length])
+            await loop.run_in_executor(None, inflate, buffer[:length])
+            progress.update(written, wire)
+        if not decompressor.eof or written != filesize:
+            raise ConnectionError("Сжатый поток оборвался или повреждён.")
+        progress.update(written, wire)
+
+    async def _recv_exactly(self, conn, view):
+        received = 0
+        while received < len(view):
+            count = await conn.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Соединение потеряно во время скачивания.")
+            received += count
@@ -1,35 +1,125 @@
+import argparse
 import asyncio
 import json
 import os
 import logging
 import uuid
 import re
+import secrets
+import signal
 import socket
+import struct
+import contextvars
+import time
+import zlib
+from collections import deque
 from pathlib import Path
 from datetime import datetime
 
+from multiplex import MuxConnection
+from server_profiler import PROFILE_DEFAULT_SECONDS, ServerProfiler
+from traffic_trace import TraceRecorder
+from tls_transport import TLS_PORT, TlsServer
+from transport_profiles import TransportProfiles
+from warm_restart import WarmRestart, inherited_listeners
+
 HOST = "0.0.0.0"
 PORT = 9090
 LOG_FILE = "server.log"
 TEMP_UPLOAD_DIR = "server_uploads"
 BROADCAST_PORT = 9999
 BROADCAST_INTERVAL = 5
+DISCOVERY_PORT = 9998
 CLIENT_TIMEOUT = 300.0
+READ_CHUNK_SIZE = 65536
+MAX_LINE_LENGTH = 65536
+SEND_BUFFER_LIMIT = 4 * 1024 * 1024
+RESUME_GRACE = 120.0
+RESUME_BACKLOG = 2000
+# Сжатые передачи: кадры <длина, 4 байта><данные zlib>, кадр нулевой длины — конец потока.
+FRAME_HEADER = struct.Struct(">I")
+MAX_COMPRESSED_FRAME = 1024 * 1024
+# Сжатие командного канала (CMD zlib): поток zlib на соединение, Z_SYNC_FLUSH после каждой записи.
+COMMAND_COMPRESSION_LEVEL = 6
+
+# Исходящие сообщения текущей пачки команд: {writer: [строки]}.
+# Пока пачка обрабатывается, _send_message складывает сюда, а не пишет в сокет.
+_batch_outbox = contextvars.ContextVar("batch_outbox", default=None)
+
+class InflatingReader:
+    """Чтение сжатого командного канала с тем же интерфейсом, что у StreamReader.
+
+    Распаковка ограничена READ_CHUNK_SIZE за вызов: маленький кадр не может
+    раздуться в памяти сервера до гигабайт.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.decompressor = zlib.decompressobj()
+        self.pending = b""
+        self.more = False
+
+    async def read(self, n=READ_CHUNK_SIZE):
+        if self.pending:
+            data, self.pending = self.pending, b""
+            return data
+        while True:
+            data = self.decompressor.unconsumed_tail
+            if not data and not self.more:
+                data = await self.reader.read(n)
+                if not data: return b""
+            out = self.decompressor.decompress(data, READ_CHUNK_SIZE)
+            self.more = len(out) == READ_CHUNK_SIZE
+            if out: return out
+
+    async def readline(self):
+        data = b""
+        while b"\n" not in data and len(data) <= MAX_LINE_LENGTH:
+            chunk = await self.read()
+            if not chunk: break
+            data += chunk
+        line, sep, self.pending = data.partition(b"\n")
+        return line + sep
 
 class ChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, compression=True, trace_path=None, transport_profiles=None, tls=None):
         self.host = host
         self.port = port
+        self.compression = compression
+        # Шифрование включается явно (--tls): TlsServer, отдельный порт с тем же протоколом.
+        self.tls = tls
+        self.tls_server = None
+        # Настройки сокетов и размеров кусков по назначению соединения (--transport).
+        self.transport_profiles = transport_profiles or TransportProfiles()
+        # Запись входящего трафика включается явно (--trace) и нужна для replay_trace.py.
+        self.recorder = TraceRecorder(trace_path) if trace_path else None
+        # Профилирование на ходу: SIGUSR1 или /profile с машины сервера.
+        self.profiler = ServerProfiler(self)
+        # Тёплый перезапуск: SIGHUP или /restart с машины сервера (см. warm_restart.py).
+        self.restart = WarmRestart(self, TEMP_UPLOAD_DIR, RESUME_BACKLOG)
+        self.handed_off = False
+        self.tcp_server = None
         self.local_ip = self._get_local_ip()
         self.connected_clients = {}
+        self.clients_by_name = {}
+        # Сессии переживают обрыв соединения: token -> сессия, и отдельно
+        # отсоединённые сессии, ожидающие RESUME в течение RESUME_GRACE.
+        self.sessions = {}
+        self.detached_sessions = {}
         self.active_transfers = {}
-        self.lock = asyncio.Lock()
+        # Сессии и передачи защищены независимыми блокировками, список присутствия
+        # собирается из снимка без блокировки. Под блокировками нет сетевого I/O.
+        self.sessions_lock = asyncio.Lock()
+        self.transfers_lock = asyncio.Lock()
+        self.cpu_load = 0.0
+        # writer -> [zlib-компрессор, байт до сжатия, байт после] для клиентов с CMD zlib.
+        self.compressors = {}
 
     def _setup_logging(self):
         logging.basicConfig(
             filename=LOG_FILE, level=logging.DEBUG,
             format="%(asctime)s %(levelname)s %(funcName)s:%(lineno)d: %(message)s",
-            datefmt="%Y-%m-%dT%H:%M:%S", filemode='w'
+            datefmt="%Y-%m-%dT%H:%M:%S", filemode='a'
         )
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.DEBUG)
@@ -51,41 +141,82 @@ class ChatServer:
     async def start(self):
         self._setup_logging()
         Path(TEMP_UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
-        tcp_server = await asyncio.start_server(self._protocol_dispatcher, self.host, self.port)
-        logging.info(f"TCP сервер запущен на {self.host}:{self.port}")
+        listeners = inherited_listeners()
+        # Сессии из снимка восстанавливаются до приёма подключений: иначе RESUME первых клиентов отклонялся бы.
+        self.restart.restore()
+        if listeners:
+            # Сокеты от предыдущего процесса: подключения, пришедшие во время перезапуска, ждут в их очереди.
+            tcp_server = await asyncio.start_server(self._protocol_dispatcher, sock=listeners[0])
+            logging.info(f"TCP сервер продолжает работу на унаследованном сокете {self.host}:{self.port}")
+        else:
+            tcp_server = await asyncio.start_server(self._protocol_dispatcher, self.host, self.port)
+            logging.info(f"TCP сервер запущен на {self.host}:{self.port}")
+        self.tcp_server = tcp_server
+        if self.tls:
+            where = {"sock": listeners[1]} if len(listeners) > 1 else {"host": self.host, "port": self.tls.port}
+            self.tls_server = await asyncio.start_server(self._protocol_dispatcher, ssl=self.tls.context, **where)
+            logging.info(f"TLS на порту {self.tls.port}{', без шифрования не принимаются' if self.tls.required else ''}. "
+                         f"Отпечаток сертификата SHA-256: {self.tls.fingerprint}")
         print(f"[🚀] Сервер запущен. Адрес для клиентов в локальной сети: {self.local_ip}:{self.port}")
         broadcast_task = asyncio.create_task(self._run_broadcast_service())
+        if hasattr(signal, "SIGUSR1"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profiler.start)
+            logging.info(f"Профилирование: kill -USR1 {os.getpid()} (окно {PROFILE_DEFAULT_SECONDS} с).")
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.restart.start)
+            logging.info(f"Тёплый перезапуск: kill -HUP {os.getpid()}.")
         try:
             await tcp_server.serve_forever()
         except KeyboardInterrupt:
             print("\n[!] Сервер останавливается...")
+        except asyncio.CancelledError:
+            # serve_forever прерывается закрытием сервера при передаче работы новому процессу;
+            # клиентам ещё рассылается RECONNECT.
+            if not self.handed_off: raise
+            await self.restart.task
         finally:
             broadcast_task.cancel()
-            tcp_server.close()
-            await tcp_server.wait_closed()
-            logging.info("=== Сервер остановлен ===")
+            for server in filter(None, (tcp_server, self.tls_server)):
+                server.close()
+                await server.wait_closed()
+            if self.tls and self.tls.handshakes:
+                logging.info(f"TLS: рукопожатий {self.tls.handshakes}, из них возобновлённых сессий {self.tls.resumed}.")
+            if self.recorder:
+                self.recorder.stop()
+                logging.info(f"Запись трафика сохранена в {self.recorder.path} ({self.recorder.records} записей).")
+            if not self.handed_off:
+                logging.info("=== Сервер остановлен ===")
 
     async def _protocol_dispatcher(self, reader, writer):
         addr = writer.get_extra_info("peername")
+        secure = self.tls.note_handshake(writer) if self.tls else False
         try:
             initial_message_raw = await asyncio.wait_for(reader.readline(), timeout=10.0)
             if not initial_message_raw:
                 return
 
             initial_message = initial_message_raw.decode().strip()
-            logging.info(f"Получено приветствие от {addr}: '{initial_message}'")
+            logging.info(f"Получено приветствие от {addr}{' (TLS)' if secure else ''}: '{initial_message}'")
             parts = initial_message.split()
             command = parts[0]
+            if command == "TLS" and self.tls:
+                # Клиент без маяка (адрес введён вручную) узнаёт, где шифрованный порт и какой у него сертификат.
+                self._write_lines(writer, [f"TLS_PORT {self.tls.port} {self.tls.fingerprint}"], record=False)
+                return
+            if self.tls and self.tls.required and not secure:
+                logging.warning(f"Подключение {addr} без шифрования отклонено: '{initial_message}'")
+                if command == "CMD":
+                    self._write_lines(writer, ["AUTH_ERROR Сервер принимает только шифрованные подключения: включите шифрование в настройках."], record=False)
+                return
+            if self.recorder and command != "MUX":
+                self.recorder.open(writer, initial_message)
+            self.transport_profiles.apply(writer.get_extra_info("socket"), {"CMD": "command", "MUX": "mux"}.get(command, "bulk"))
 
             if command == "CMD":
-                await self._handle_command_connection(reader, writer)
-            elif command == "UPLOAD" and len(parts) > 1:
-                transfer_id = parts[1]
-                await self._handle_upload_connection(reader, writer, transfer_id)
-            elif command == "DOWNLOAD" and len(parts) > 1:
-                transfer_id = parts[1]
-                await self._handle_download_connection(reader, writer, transfer_id)
-            else:
+                await self._handle_command_connection(reader, writer, compress=self.compression and "zlib" in parts[1:])
+            elif command == "MUX":
+                await self._handle_mux_connection(reader, writer, initial_message, compress=self.compression and "zlib" in parts[1:])
+            elif not await self._dispatch_transfer(reader, writer, parts):
                 logging.warning(f"Неизвестный тип подключения от {addr}: '{initial_message}'")
 
         except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError):
@@ -93,52 +224,194 @@ class ChatServer:
         except Exception as e:
             logging.error(f"Ошибка в диспетчере для {addr}: {e}", exc_info=True)
         finally:
+            self._drop_compressor(writer)
+            if self.recorder:
+                self.recorder.close(writer)
             if not writer.is_closing():
                 writer.close()
                 await writer.wait_closed()
 
-    async def _handle_command_connection(self, reader, writer):
+    async def _dispatch_transfer(self, reader, writer, parts):
+        # Передача по отдельному соединению или по потоку мультиплексированного; False — не передача.
+        if parts[0] == "UPLOAD" and len(parts) > 1:
+            await self._handle_upload_connection(reader, writer, parts[1])
+        elif parts[0] == "DOWNLOAD" and len(parts) > 1:
+            await self._handle_download_connection(reader, writer, parts[1])
+        else:
+            return False
+        return True
+
+    async def _handle_mux_connection(self, reader, writer, greeting, compress=False):
+        # Одно соединение на клиента: поток 0 — обычный командный канал, остальные потоки
+        # открываются с приветствием UPLOAD/DOWNLOAD и обслуживаются теми же обработчиками.
+        mux = MuxConnection(reader, writer, on_open=self._handle_mux_stream)
+        command = mux.command
+        if self.recorder:
+            self.recorder.open(command, greeting)
+        try:
+            await self._handle_command_connection(command, command, compress)
+        finally:
+            self._drop_compressor(command)
+            if self.recorder:
+                self.recorder.close(command)
+            mux.close()
+
+    async def _handle_mux_stream(self, stream, greeting):
+        addr = stream.get_extra_info("peername")
+        if self.recorder:
+            self.recorder.open(stream, greeting)
+        try:
+            if not await self._dispatch_transfer(stream, stream, greeting.split() or [""]):
+                logging.warning(f"Неизвестный поток от {addr}: '{greeting}'")
+        except Exception as e:
+            logging.error(f"Ошибка в потоке '{greeting}' от {addr}: {e}", exc_info=True)
+        finally:
+            if self.recorder:
+                self.recorder.close(stream)
+            stream.close()
+
+    async def _handle_command_connection(self, reader, writer, compress=False):
         addr = writer.get_extra_info("peername")
         try:
-            await self._send_message(writer, "AUTH_REQUEST")
-            username_raw = await asyncio.wait_for(reader.readline(), timeout=15.0)
-            username = username_raw.decode().strip()
+            self._write_lines(writer, ["AUTH_REQUEST zlib" if compress else "AUTH_REQUEST"], record=False)
+            if compress:
+                # Всё после AUTH_REQUEST идёт сжатым в обе стороны.
+                self.compressors[writer] = [zlib.compressobj(COMMAND_COMPRESSION_LEVEL), 0, 0]
+                reader = InflatingReader(reader)
+            auth_raw = await asyncio.wait_for(reader.readline(), timeout=15.0)
+            auth_line = auth_raw.decode().strip()
 
-            async with self.lock:
-                if not re.match("^[a-zA-Z0-9_.-]{3,16}$", username):
-                    await self._send_message(writer, "AUTH_ERROR Неверный формат имени.")
+            if auth_line.startswith("RESUME "):
+                username = await self._resume_session(writer, auth_line)
+                if not username:
                     return
-                if self._get_writer_by_username(username):
-                    await self._send_message(writer, f"AUTH_ERROR Имя '{username}' уже занято.")
+                logging.info(f"Клиент {addr} восстановил сессию '{username}'.")
+                if self.recorder:
+                    self.recorder.auth(writer, username)
+                await self._send_message(writer, self._user_list_message())
+            else:
+                username = await self._open_session(writer, auth_line)
+                if not username:
                     return
-                self.connected_clients[writer] = {"username": username}
-            
-            logging.info(f"Клиент {addr} авторизован как '{username}'.")
-            await self._send_message(writer, f"AUTH_SUCCESS Добро пожаловать, {username}!")
-            await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вошёл в чат ***", exclude_writer=writer)
-            await self._broadcast_user_list()
+                logging.info(f"Клиент {addr} авторизован как '{username}'.")
+                if self.recorder:
+                    self.recorder.auth(writer, username)
+                await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вошёл в чат ***", exclude_writer=writer)
+                await self._broadcast_user_list()
         
         except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError):
             logging.warning(f"Ошибка аутентификации для {addr}.")
             return
         
+        buffer = bytearray()
         try:
             while True:
-                line_data = await asyncio.wait_for(reader.readline(), timeout=CLIENT_TIMEOUT)
-                if not line_data: break
-                
-                line = line_data.decode().strip()
-                if line:
-                    await self._process_line(writer, line)
-        except (asyncio.TimeoutError, ConnectionResetError, asyncio.IncompleteReadError) as e:
+                data = await asyncio.wait_for(reader.read(READ_CHUNK_SIZE), timeout=CLIENT_TIMEOUT)
+                if not data: break
+
+                buffer += data
+                lines, consumed = self._split_lines(buffer)
+                if consumed:
+                    del buffer[:consumed]
+                if len(buffer) > MAX_LINE_LENGTH:
+                    logging.warning(f"Клиент {addr} прислал слишком длинную строку ({len(buffer)} байт), отключение.")
+                    break
+                if lines:
+                    if self.recorder:
+                        self.recorder.lines(writer, lines)
+                    await self._process_batch(writer, lines)
+        except (asyncio.TimeoutError, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError, zlib.error) as e:
             logging.info(f"Клиент '{self.connected_clients.get(writer, {}).get('username', addr)}' отсоединен (таймаут или разрыв): {type(e).__name__}")
         except Exception as e:
             logging.error(f"Ошибка в _handle_command_connection: {e}", exc_info=True)
         finally:
             await self._cleanup_client(writer)
 
+    async def _open_session(self, writer, username):
+        auth_error = None
+        async with self.sessions_lock:
+            if not re.match("^[a-zA-Z0-9_.-]{3,16}$", username):
+                auth_error = "AUTH_ERROR Неверный формат имени."
+            elif username in self.clients_by_name or username in self.detached_sessions:
+                auth_error = f"AUTH_ERROR Имя '{username}' уже занято."
+            else:
+                session = {"username": username, "token": secrets.token_urlsafe(16), "seq": 0,
+                           "backlog": deque(maxlen=RESUME_BACKLOG), "writer": None, "expiry_task": None}
+                self.sessions[session["token"]] = session
+                self._attach_session(writer, session)
+        if auth_error:
+            self._write_lines(writer, [auth_error], record=False)
+            return None
+        # Всё, что идёт после строки SESSION, нумеруется и может быть повторено при RESUME.
+        self._write_lines(writer, [f"AUTH_SUCCESS Добро пожаловать, {username}!", f"SESSION {session['token']} 0"], record=False)
+        return username
+
+    async def _resume_session(self, writer, auth_line):
+        parts = auth_line.split()
+        token = parts[1] if len(parts) > 1 else ""
+        try:
+            last_seq = int(parts[2]) if len(parts) > 2 else 0
+        except ValueError:
+            last_seq = 0
+
+        old_writer = None
+        async with self.sessions_lock:
+            session = self.sessions.get(token)
+            if session:
+                old_writer = session["writer"]
+                if old_writer is not None:
+                    self.connected_clients.pop(old_writer, None)
+                self.detached_sessions.pop(session["username"], None)
+                if session["expiry_task"]:
+                    session["expiry_task"].cancel()
+                    session["expiry_task"] = None
+                self._attach_session(writer, session)
+        if not session:
+            self._write_lines(writer, ["AUTH_ERROR Сессия не найдена или истекла."], record=False)
+            return None
+
+        # Старое соединение после смены точки доступа часто ещё висит полуоткрытым.
+        if old_writer is not None and old_writer is not writer:
+            old_writer.transport.abort()
+
+        username = session["username"]
+        missed = [line for seq, line in session["backlog"] if seq > last_seq]
+        replay_from = session["seq"] - len(missed)
+        handshake = [f"AUTH_SUCCESS С возвращением, {username}!"]
+        if replay_from > last_seq:
+            handshake.append(f"SERVER_MSG Пропущено сообщений, которые уже не сохранились на сервере: {replay_from - last_seq}.")
+        handshake.append(f"SESSION {token} {replay_from}")
+        self._write_lines(writer, handshake + missed, record=False)
+        logging.info(f"Сессия '{username}': повторено {len(missed)} сообщений после seq={last_seq}.")
+        return username
+
+    def _attach_session(self, writer, session):
+        username = session["username"]
+        session["writer"] = writer
+        self.connected_clients[writer] = {"username": username, "session": session}
+        self.clients_by_name[username] = writer
+        # Передачи, пережившие перезапуск сервера, ждут, пока участники вернутся.
+        for transfer in self.active_transfers.values():
+            if transfer["from_user"] == username:
+                transfer["from_writer"] = writer
+            if transfer["to_user"] == username:
+                transfer["to_writer"] = writer
+
+    async def _expire_session_later(self, session):
+        await asyncio.sleep(RESUME_GRACE)
+        username = session["username"]
+        async with self.sessions_lock:
+            if self.detached_sessions.get(username) is not session:
+                return
+            del self.detached_sessions[username]
+            self.sessions.pop(session["token"], None)
+        logging.info(f"Сессия '{username}' истекла без переподключения.")
+        await self._cancel_user_transfers(username)
+        await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вышел из чата ***")
+        await self._broadcast_user_list()
+
     async def _handle_upload_connection(self, reader, writer, transfer_id):
-        async with self.lock:
+        async with self.transfers_lock:
             transfer = self.active_transfers.get(transfer_id)
             if not transfer or transfer["status"] != "pending_upload":
                 logging.warning(f"Неверная или устаревшая попытка загрузки для transfer_id={transfer_id}")
@@ -152,74 +425,150 @@ class ChatServer:
         bytes_received = 0
         try:
             with open(temp_filepath, "wb") as f_temp:
-                while bytes_received < transfer["filesize"]:
-                    chunk = await reader.read(4096)
-                    if not chunk:
-                        logging.error(f"Соединение потеряно при загрузке файла {transfer_id}.")
-                        transfer["status"] = "error"
-                        break
-                    f_temp.write(chunk)
-                    bytes_received += len(chunk)
+                if transfer["encoding"] == "zlib":
+                    bytes_received, received_all = await self._receive_frames(reader, f_temp, transfer)
+                else:
+                    chunk_size = self.transport_profiles.chunk()
+                    while bytes_received < transfer["filesize"]:
+                        chunk = await reader.read(chunk_size.size)
+                        if not chunk:
+                            break
+                        f_temp.write(chunk)
+                        bytes_received += len(chunk)
+                        chunk_size.update(len(chunk))
+                    received_all = bytes_received == transfer["filesize"]
             
-            async with self.lock:
+            if self.recorder:
+                self.recorder.data(writer, bytes_received)
+            upload_complete = False
+            async with self.transfers_lock:
                 if transfer["status"] == "uploading":
-                    if bytes_received == transfer["filesize"]:
+                    if received_all:
                         transfer["status"] = "pending_download"
-                        logging.info(f"Файл {transfer_id} успешно загружен на сервер.")
-                        await self._send_message(transfer["to_writer"], f"DOWNLOAD_READY {transfer['from_user']} {transfer['filename']} {transfer['filesize']} {transfer_id}")
+                        transfer["wire_size"] = bytes_received
+                        upload_complete = True
                     else:
                         transfer["status"] = "error"
                         logging.warning(f"Файл {transfer_id} загружен не полностью.")
+            if not upload_complete and os.path.exists(temp_filepath):
+                # Обрыв или отмена: недокачанный файл никому не нужен.
+                os.remove(temp_filepath)
+            if upload_complete:
+                logging.info(f"Файл {transfer_id} успешно загружен на сервер: {bytes_received} байт по сети, {transfer['filesize']} байт файла ({transfer['encoding']}).")
+                await self._send_message(transfer["to_writer"], f"DOWNLOAD_READY {transfer['from_user']} {transfer['filename']} {transfer['filesize']} {transfer_id}")
         
         except Exception as e:
             logging.error(f"Ошибка в _handle_upload_connection для {transfer_id}: {e}", exc_info=True)
-            async with self.lock:
+            async with self.transfers_lock:
                 if transfer_id in self.active_transfers:
                     self.active_transfers[transfer_id]["status"] = "error"
 
+    async def _receive_frames(self, reader, f_temp, transfer):
+        # Сервер не распаковывает: кадры хранятся как есть и тем же потоком уходят получателю.
+        # Сжатый поток не может быть заметно больше файла — иначе это не наш клиент.
+        limit = transfer["filesize"] + transfer["filesize"] // 100 + 65536
+        written = 0
+        try:
+            while written <= limit:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                length, = FRAME_HEADER.unpack(header)
+                f_temp.write(header)
+                written += len(header)
+                if not length: return written, True
+                if length > MAX_COMPRESSED_FRAME: break
+                f_temp.write(await reader.readexactly(length))
+                written += length
+        except asyncio.IncompleteReadError:
+            return written, False
+        logging.warning(f"Сжатый поток файла {transfer['id']} некорректен, прием прерван.")
+        return written, False
+
     async def _handle_download_connection(self, reader, writer, transfer_id):
         addr = writer.get_extra_info("peername")
         logging.info(f"Клиент {addr} подключился для скачивания файла {transfer_id}.")
         
-        async with self.lock:
+        async with self.transfers_lock:
             transfer = self.active_transfers.get(transfer_id)
             if not transfer or transfer.get("status") != "downloading":
                 logging.warning(f"Неверная или устаревшая попытка скачивания для transfer_id={transfer_id} от {addr}")
                 return
             
             filepath = transfer.get("temp_filepath")
-            if not filepath or not os.path.exists(filepath):
-                 logging.error(f"Файл для скачивания {transfer_id} не найден на диске по пути {filepath}.")
-                 await self._send_message(transfer["to_writer"], "SERVER_MSG Ошибка: Файл для скачивания не найден на сервере.")
-                 transfer["status"] = "error"
-                 return
+            file_missing = not filepath or not os.path.exists(filepath)
+            if file_missing:
+                transfer["status"] = "error"
+
+        if file_missing:
+            logging.error(f"Файл для скачивания {transfer_id} не найден на диске по пути {filepath}.")
+            await self._send_message(transfer["to_writer"], "SERVER_MSG Ошибка: Файл для скачивания не найден на сервере.")
+            return
         
+        # Под TLS пробка не нужна: записи шифруются кусками, и с TCP_CORK скачивание втрое медленнее.
+        sock = None if writer.get_extra_info("ssl_object") else writer.get_extra_info("socket")
         try:
             logging.info(f"Начало отправки файла {filepath} клиенту {transfer['to_user']}.")
+            chunk_size = self.transport_profiles.chunk()
+            self.transport_profiles.cork(sock, "bulk", True)
             with open(filepath, "rb") as f:
                 while True:
-                    chunk = f.read(4096)
+                    chunk = f.read(chunk_size.size)
                     if not chunk:
                         break
                     writer.write(chunk)
                     await writer.drain()
+                    chunk_size.update(len(chunk))
+            self.transport_profiles.cork(sock, "bulk", False)
             logging.info(f"Файл {transfer_id} успешно отправлен клиенту {transfer['to_user']}.")
         except (ConnectionResetError, BrokenPipeError):
              logging.warning(f"Соединение с клиентом {transfer['to_user']} разорвано во время скачивания файла {transfer_id}.")
         except Exception as e:
             logging.error(f"Ошибка при отправке файла {transfer_id} клиенту: {e}", exc_info=True)
         finally:
-            async with self.lock:
-                if os.path.exists(filepath):
-                    try:
-                        os.remove(filepath)
-                        logging.info(f"Временный файл {filepath} удален.")
-                    except OSError as e:
-                        logging.error(f"Не удалось удалить временный файл {filepath}: {e}")
+            if self.handed_off:
+                # Запись передачи и файл уже в снимке: получатель скачает файл у нового процесса.
+                return
+            async with self.transfers_lock:
                 self.active_transfers.pop(transfer_id, None)
-                logging.info(f"Трансфер {transfer_id} завершен и удален.")
+            if os.path.exists(filepath):
+                try:
+                    os.remove(filepath)
+                    logging.info(f"Временный файл {filepath} удален.")
+                except OSError as e:
+                    logging.error(f"Не удалось удалить временный файл {filepath}: {e}")
+            logging.info(f"Трансфер {transfer_id} завершен и удален.")
+
+    @staticmethod
+    def _split_lines(buffer):
+        lines = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1: break
+            line = buffer[start:end].decode("utf-8", errors="replace").strip()
+            if line:
+                lines.append(line)
+            start = end + 1
+        return lines, start
+
+    async def _process_batch(self, writer, lines):
+        outbox = {}
+        token = _batch_outbox.set(outbox)
+        try:
+            for line in lines:
+                if not await self._process_line(writer, line):
+                    break
+        finally:
+            _batch_outbox.reset(token)
+            self._flush_outbox(outbox)
+
+    def _flush_outbox(self, outbox):
+        for target, messages in outbox.items():
+            self._write_lines(target, messages, record=False)
 
     async def _process_line(self, writer, line):
+        # False, если сессию уже забрало новое соединение (RESUME): остаток пачки старого не выполняется.
+        client = self.connected_clients.get(writer)
+        if client is None: return False
         parts = line.split(" ", 3)
         command_str = parts[0].lower()
         
@@ -228,9 +577,9 @@ class ChatServer:
         if handler:
             await handler(self, writer, parts)
         else:
-            username = self.connected_clients[writer]["username"]
-            formatted_msg = f"[{self._now()}] {username}: {line}"
+            formatted_msg = f"[{self._now()}] {client['username']}: {line}"
             await self._broadcast_message(formatted_msg)
+        return True
     
     async def _handle_pm(self, writer, parts):
         if len(parts) < 3:
@@ -245,9 +594,13 @@ class ChatServer:
             return
 
         target_writer = self._get_writer_by_username(target_user)
-        if target_writer:
+        detached_session = self.detached_sessions.get(target_user)
+        if target_writer or detached_session:
             pm = f"[{self._now()}] (PM от {sender_user}): {msg}"
-            await self._send_message(target_writer, pm)
+            if target_writer:
+                await self._send_message(target_writer, pm)
+            else:
+                self._record_lines(detached_session, [pm])
             await self._send_message(writer, f"[{self._now()}] (PM для {target_user}): {msg}")
         else:
             await self._send_message(writer, f"SERVER_MSG Пользователь '{target_user}' не найден.")
@@ -257,65 +610,216 @@ class ChatServer:
             await self._send_message(writer, "SERVER_MSG Формат: /upload <user> <filename> <size>")
             return
         
-        target_user, filename, size_str = parts[1], parts[2], parts[3]
+        # Необязательные аргументы: id запроса клиента (возвращается в UPLOAD_PROCEED/UPLOAD_REJECTED)
+        # и флаг p2p — отправитель готов отдать файл получателю напрямую.
+        target_user, filename = parts[1], parts[2]
+        size_str, *extra = parts[3].split()
+        request_id = extra[0] if extra else ""
+        flags = extra[1:]
         sender_user = self.connected_clients[writer]["username"]
         try:
             filesize = int(size_str)
         except ValueError:
-            await self._send_message(writer, "SERVER_MSG Неверный размер файла."); return
+            await self._reject_upload(writer, request_id, "Неверный размер файла."); return
 
         target_writer = self._get_writer_by_username(target_user)
         if not target_writer:
-            await self._send_message(writer, f"SERVER_MSG Пользователь '{target_user}' не в сети."); return
+            await self._reject_upload(writer, request_id, f"Пользователь '{target_user}' не в сети."); return
 
         transfer_id = str(uuid.uuid4())
-        async with self.lock:
+        async with self.transfers_lock:
             self.active_transfers[transfer_id] = {
                 "id": transfer_id, "filename": filename, "filesize": filesize,
                 "from_user": sender_user, "to_user": target_user,
                 "from_writer": writer, "to_writer": target_writer,
+                "request_id": request_id, "direct": "p2p" in flags,
+                # Сжатие предлагает отправитель, включается оно, только если получатель тоже согласен.
+                "compress": "zlib" in flags, "encoding": "raw",
                 "status": "pending_target_accept"
             }
         
         await self._send_message(target_writer, f"FILE_INCOMING {sender_user} {filename} {filesize} {transfer_id}")
         await self._send_message(writer, f"SERVER_MSG Запрос на отправку файла '{filename}' пользователю {target_user} отправлен.")
 
+    async def _reject_upload(self, writer, request_id, reason):
+        if request_id:
+            await self._send_message(writer, f"UPLOAD_REJECTED #{request_id} {reason}")
+        else:
+            await self._send_message(writer, f"SERVER_MSG {reason}")
+
     async def _handle_file_action(self, writer, parts, action):
         if len(parts) < 2: return
         transfer_id = parts[1]
         
-        async with self.lock:
+        username = self.connected_clients[writer]["username"]
+        async with self.transfers_lock:
             transfer = self.active_transfers.get(transfer_id)
-            if not transfer or transfer["to_user"] != self.connected_clients[writer]["username"]:
+            if not transfer or transfer["to_user"] != username:
                 return
 
+            accept_flags = " ".join(parts[2:]).split()
+            direct = action == "accept" and transfer["direct"] and "p2p" in accept_flags
             if action == "accept":
                 if transfer["status"] != "pending_target_accept": return
-                transfer["status"] = "pending_upload"
-                await self._send_message(transfer["from_writer"], f"UPLOAD_PROCEED {transfer_id} {self.port}")
-                await self._send_message(writer, f"SERVER_MSG Вы приняли файл '{transfer['filename']}'. Ожидание загрузки.")
+                if transfer["compress"] and "zlib" in accept_flags:
+                    transfer["encoding"] = "zlib"
+                if direct:
+                    # Сервер только сводит стороны: одноразовый токен знают отправитель и получатель.
+                    transfer["status"] = "direct_pending"
+                    transfer["token"] = secrets.token_urlsafe(16)
+                else:
+                    transfer["status"] = "pending_upload"
             elif action == "reject":
-                await self._send_message(transfer["from_writer"], f"UPLOAD_REJECTED Пользователь {transfer['to_user']} отклонил передачу файла.")
                 self.active_transfers.pop(transfer_id, None)
 
+        if direct:
+            await self._send_message(transfer["from_writer"], f"DIRECT_PREPARE {transfer_id} {transfer['token']} {transfer['request_id']}{self._encoding_suffix(transfer)}")
+            await self._send_message(writer, f"SERVER_MSG Вы приняли файл '{transfer['filename']}'. Ожидание прямого соединения с отправителем.")
+        elif action == "accept":
+            request_suffix = f" {transfer['request_id']}" if transfer.get("request_id") else ""
+            await self._send_message(transfer["from_writer"], f"UPLOAD_PROCEED {transfer_id} {self._transfer_port(transfer['from_writer'])}{request_suffix}{self._encoding_suffix(transfer)}")
+            await self._send_message(writer, f"SERVER_MSG Вы приняли файл '{transfer['filename']}'. Ожидание загрузки.")
+        elif action == "reject":
+            request_prefix = f"#{transfer['request_id']} " if transfer.get("request_id") else ""
+            await self._send_message(transfer["from_writer"], f"UPLOAD_REJECTED {request_prefix}Пользователь {transfer['to_user']} отклонил передачу файла.")
+
+    def _transfer_port(self, writer):
+        # Передача идёт тем же транспортом, что и командный канал клиента.
+        return self.tls.port if self.tls and writer and writer.get_extra_info("ssl_object") else self.port
+
+    @staticmethod
+    def _encoding_suffix(transfer):
+        # Согласованное сжатие дописывается последним словом; id запроса при нём есть всегда.
+        return f" {transfer['encoding']}" if transfer.get("encoding", "raw") != "raw" else ""
+
+    async def _handle_direct_ready(self, writer, parts):
+        # /direct_ready <transfer_id> <port> — отправитель слушает порт для получателя.
+        if len(parts) < 3: return
+        transfer_id = parts[1]
+        username = self.connected_clients[writer]["username"]
+        async with self.transfers_lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or transfer["from_user"] != username or transfer["status"] != "direct_pending":
+                return
+            transfer["status"] = "direct_ready"
+        try:
+            port = int(parts[2])
+        except ValueError:
+            await self._fallback_to_relay(transfer_id); return
+        host = writer.get_extra_info("peername")[0]
+        if host.startswith("127.") or host == "::1":
+            # Отправитель на машине сервера: получатель достучится до него по адресу сервера.
+            host = "-"
+        await self._send_message(transfer["to_writer"], f"DIRECT_READY {transfer_id} {host} {port} {transfer['token']} {transfer['filesize']} {transfer['from_user']} {transfer['filename']}{self._encoding_suffix(transfer)}")
+
+    async def _handle_direct_result(self, writer, parts, result):
+        if len(parts) < 2: return
+        transfer_id = parts[1]
+        username = self.connected_clients[writer]["username"]
+        async with self.transfers_lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or username not in (transfer["from_user"], transfer["to_user"]):
+                return
+            if result == "done" and username == transfer["to_user"] and transfer["status"] == "direct_ready":
+                self.active_transfers.pop(transfer_id, None)
+                logging.info(f"Файл {transfer_id} передан напрямую от {transfer['from_user']} к {transfer['to_user']}.")
+                return
+        if result == "failed":
+            await self._fallback_to_relay(transfer_id)
+
+    async def _fallback_to_relay(self, transfer_id):
+        async with self.transfers_lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or transfer["status"] not in ("direct_pending", "direct_ready"):
+                return
+            transfer["status"] = "pending_upload"
+        logging.info(f"Прямая передача {transfer_id} не удалась, переключение на передачу через сервер.")
+        request_suffix = f" {transfer['request_id']}" if transfer.get("request_id") else ""
+        await self._send_message(transfer["from_writer"], f"UPLOAD_PROCEED {transfer_id} {self._transfer_port(transfer['from_writer'])}{request_suffix}{self._encoding_suffix(transfer)}")
+        await self._send_message(transfer["to_writer"], f"SERVER_MSG Прямое соединение не удалось, файл '{transfer['filename']}' пойдёт через сервер.")
+
+    async def _handle_file_cancel(self, writer, parts):
+        if len(parts) < 2: return
+        transfer_id = parts[1]
+
+        username = self.connected_clients[writer]["username"]
+        async with self.transfers_lock:
+            transfer = self.active_transfers.get(transfer_id)
+            if not transfer or username not in (transfer["from_user"], transfer["to_user"]):
+                return
+            previous_status = transfer["status"]
+            # Обработчики загрузки/скачивания увидят статус и не продолжат передачу.
+            transfer["status"] = "cancelled"
+            self.active_transfers.pop(transfer_id, None)
+
+        temp_filepath = transfer.get("temp_filepath")
+        if previous_status == "pending_download" and temp_filepath and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        logging.info(f"Передача {transfer_id} отменена пользователем {username} (статус: {previous_status}).")
+        other_user = transfer["to_user"] if username == transfer["from_user"] else transfer["from_user"]
+        other_writer = self._get_writer_by_username(other_user)
+        if other_writer:
+            await self._send_message(other_writer, f"FILE_CANCELLED {transfer_id} {username}")
+
     async def _handle_download(self, writer, parts):
         if len(parts) < 2: return
         transfer_id = parts[1]
         
-        async with self.lock:
+        username = self.connected_clients[writer]["username"]
+        async with self.transfers_lock:
             transfer = self.active_transfers.get(transfer_id)
-            if not transfer or transfer["to_user"] != self.connected_clients[writer]["username"] or transfer["status"] != "pending_download":
-                await self._send_message(writer, "SERVER_MSG Ошибка: неверный ID или файл не готов к скачиванию.")
-                return
-            transfer["status"] = "downloading"
+            ready = transfer and transfer["to_user"] == username and transfer["status"] == "pending_download"
+            if ready:
+                transfer["status"] = "downloading"
+
+        if not ready:
+            await self._send_message(writer, "SERVER_MSG Ошибка: неверный ID или файл не готов к скачиванию.")
+            return
             
-        await self._send_message(writer, f"DOWNLOAD_PROCEED {transfer_id} {self.port}")
+        await self._send_message(writer, f"DOWNLOAD_PROCEED {transfer_id} {self._transfer_port(writer)}{self._encoding_suffix(transfer)}")
         logging.info(f"Дано разрешение на скачивание файла {transfer_id} клиенту {transfer['to_user']}.")
     
     async def _handle_ping(self, writer, parts):
         username = self.connected_clients.get(writer, {}).get("username", "N/A")
         logging.info(f"Получен ping от пользователя '{username}'. Соединение активно.")
 
+    async def _require_local(self, writer):
+        host = writer.get_extra_info("peername")[0]
+        if host.startswith("127.") or host == "::1":
+            return True
+        await self._send_message(writer, "SERVER_MSG Команда доступна только на машине сервера.")
+        return False
+
+    async def _handle_profile(self, writer, parts):
+        # /profile [секунды] — только с машины сервера: отчёты пишутся на её диск.
+        if not await self._require_local(writer):
+            return
+        try:
+            seconds = int(parts[1]) if len(parts) > 1 else PROFILE_DEFAULT_SECONDS
+        except ValueError:
+            await self._send_message(writer, "SERVER_MSG Формат: /profile [секунды]")
+            return
+        prefix = self.profiler.start(seconds)
+        if prefix:
+            await self._send_message(writer, f"SERVER_MSG Профилирование запущено, отчёты будут в {prefix}.*")
+        else:
+            await self._send_message(writer, "SERVER_MSG Профилирование уже идёт.")
+
+    async def _handle_restart(self, writer, parts):
+        # /restart — только с машины сервера, то же, что kill -HUP.
+        if not await self._require_local(writer):
+            return
+        if self.restart.start():
+            await self._send_message(writer, "SERVER_MSG Сервер перезапускается, чат вернётся через несколько секунд.")
+        else:
+            await self._send_message(writer, "SERVER_MSG Перезапуск уже идёт.")
+
+    async def _handle_quit(self, writer, parts):
+        # Явный выход: сессию не сохраняем для RESUME.
+        client = self.connected_clients.get(writer)
+        if client:
+            client["quit"] = True
+
     command_handlers = {
         "/pm": _handle_pm,
         "/w": _handle_pm,
@@ -323,70 +827,124 @@ class ChatServer:
         "/file_accept": lambda self, w, p: self._handle_file_action(w, p, "accept"),
         "/file_reject": lambda self, w, p: self._handle_file_action(w, p, "reject"),
         "/download": _handle_download,
+        "/file_cancel": _handle_file_cancel,
+        "/direct_ready": _handle_direct_ready,
+        "/direct_done": lambda self, w, p: self._handle_direct_result(w, p, "done"),
+        "/direct_failed": lambda self, w, p: self._handle_direct_result(w, p, "failed"),
         "/ping": _handle_ping,
+        "/profile": _handle_profile,
+        "/restart": _handle_restart,
+        "/quit": _handle_quit,
     }
 
     @staticmethod
     def _now(): return datetime.now().strftime("%H:%M:%S")
 
     async def _send_message(self, writer, message):
-        if writer and not writer.is_closing():
-            try:
-                writer.write((message + "\n").encode("utf-8"))
-                await writer.drain()
+        outbox = _batch_outbox.get()
+        if outbox is not None:
+            # В журнал сессии строка попадает сразу, даже если клиент уже отключается:
+            # именно её повторит RESUME. В сокет пачка уходит в _flush_outbox.
+            self._record_for(writer, [message])
+            if writer and not writer.is_closing():
+                outbox.setdefault(writer, []).append(message)
                 return True
-            except (ConnectionResetError, BrokenPipeError) as e:
-                logging.warning(f"Не удалось отправить сообщение клиенту {writer.get_extra_info('peername')}: {e}")
-                return False
-        return False
+            return False
+        return self._write_lines(writer, [message])
+
+    def _record_for(self, writer, messages):
+        client = self.connected_clients.get(writer)
+        if client and client.get("session"):
+            self._record_lines(client["session"], messages)
+
+    def _write_lines(self, writer, messages, record=True):
+        # drain() не ждём: один медленный клиент не должен тормозить отправителя.
+        # Вместо этого ограничиваем его очередь и отключаем, если он не успевает читать.
+        if record:
+            self._record_for(writer, messages)
+        if not writer or writer.is_closing():
+            return False
+        data = ("\n".join(messages) + "\n").encode("utf-8")
+        compression = self.compressors.get(writer)
+        if compression:
+            compressor = compression[0]
+            compression[1] += len(data)
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            compression[2] += len(data)
+        try:
+            writer.write(data)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logging.warning(f"Не удалось отправить сообщение клиенту {writer.get_extra_info('peername')}: {e}")
+            return False
+        buffered = writer.transport.get_write_buffer_size()
+        if buffered > SEND_BUFFER_LIMIT:
+            logging.warning(f"Клиент {writer.get_extra_info('peername')} не успевает читать ({buffered} байт в очереди), отключение.")
+            writer.transport.abort()
+            return False
+        return True
     
+    def _drop_compressor(self, writer):
+        compression = self.compressors.pop(writer, None)
+        if compression and compression[1]:
+            _, raw, wire = compression
+            logging.info(f"Сжатие канала {writer.get_extra_info('peername')}: {raw} байт сообщений, {wire} байт по сети ({wire / raw:.0%}).")
+
+    @staticmethod
+    def _record_lines(session, messages):
+        backlog = session["backlog"]
+        for message in messages:
+            session["seq"] += 1
+            backlog.append((session["seq"], message))
+
     async def _broadcast_message(self, message, exclude_writer=None):
-        all_writers = list(self.connected_clients.keys())
-        for writer in all_writers:
-            if writer != exclude_writer:
+        targets = [w for w in list(self.connected_clients.keys()) if w != exclude_writer]
+        if _batch_outbox.get() is not None:
+            for writer in targets:
                 await self._send_message(writer, message)
+        else:
+            for writer in targets:
+                self._write_lines(writer, [message])
+        for session in list(self.detached_sessions.values()):
+            self._record_lines(session, [message])
+
+    def _user_list_message(self):
+        usernames = list(self.clients_by_name) + list(self.detached_sessions)
+        return f"USER_LIST {','.join(sorted(usernames))}"
 
     async def _broadcast_user_list(self):
-        async with self.lock:
-            usernames = [cd["username"] for cd in self.connected_clients.values() if cd.get("username")]
-        msg = f"USER_LIST {','.join(sorted(usernames))}"
-        logging.info(f"Рассылка списка пользователей: {usernames}")
+        msg = self._user_list_message()
+        logging.info(f"Рассылка списка пользователей: {msg[len('USER_LIST '):]}")
         await self._broadcast_message(msg)
 
     def _get_writer_by_username(self, username):
-        for writer, data in self.connected_clients.items():
-            if data.get("username") == username:
-                return writer
-        return None
+        return self.clients_by_name.get(username)
 
     async def _cleanup_client(self, writer):
         username = None
-        async with self.lock:
-            if writer in self.connected_clients:
-                removed_user = self.connected_clients.pop(writer)
+        resumable = False
+        async with self.sessions_lock:
+            removed_user = self.connected_clients.pop(writer, None)
+            if removed_user:
                 username = removed_user.get("username")
-                logging.info(f"Клиент '{username}' удален из списка подключенных.")
-                
-                related_transfers = []
-                for tid, t_info in self.active_transfers.items():
-                    if t_info.get("from_writer") == writer or t_info.get("to_writer") == writer:
-                        related_transfers.append(tid)
-                
-                for tid in related_transfers:
-                    t_info = self.active_transfers.pop(tid)
-                    logging.info(f"Отменен трансфер {tid} из-за отключения пользователя {username}.")
-                    
-                    other_writer = t_info.get("from_writer") if t_info.get("to_writer") == writer else t_info.get("to_writer")
-                    if other_writer:
-                        await self._send_message(other_writer, f"SERVER_MSG Передача файла '{t_info['filename']}' отменена, так как пользователь отключился.")
-                    
-                    if t_info.get("temp_filepath") and os.path.exists(t_info.get("temp_filepath")):
-                        try:
-                            os.remove(t_info.get("temp_filepath"))
-                        except OSError as e:
-                            logging.error(f"Не удалось удалить временный файл {t_info.get('temp_filepath')}: {e}")
-
-            if username:
+                if self.clients_by_name.get(username) is writer:
+                    del self.clients_by_name[username]
+                session = removed_user.get("session")
+                if session and session["writer"] is writer:
+                    session["writer"] = None
+                    resumable = not removed_user.get("quit")
+                    if resumable:
+                        self.detached_sessions[username] = session
+                        session["expiry_task"] = asyncio.create_task(self._expire_session_later(session))
+                    else:
+                        self.sessions.pop(session["token"], None)
+
+        if username and not self.handed_off:
+            logging.info(f"Клиент '{username}' удален из списка подключенных.")
+            await self._cancel_user_transfers(username)
+
+            if resumable:
+                logging.info(f"Сессия '{username}' ожидает переподключения {RESUME_GRACE:.0f} с.")
+            else:
                 await self._broadcast_message(f"[{self._now()}] *** Пользователь {username} вышел из чата ***")
                 await self._broadcast_user_list()
         
@@ -397,33 +955,79 @@ class ChatServer:
             except Exception:
                 pass
     
+    async def _cancel_user_transfers(self, username):
+        async with self.transfers_lock:
+            related_transfers = [tid for tid, t_info in self.active_transfers.items()
+                                 if username in (t_info["from_user"], t_info["to_user"])]
+            cancelled = [(tid, self.active_transfers.pop(tid)) for tid in related_transfers]
+
+        for tid, t_info in cancelled:
+            logging.info(f"Отменен трансфер {tid} из-за отключения пользователя {username}.")
+
+            other_writer = t_info.get("from_writer") if t_info["to_user"] == username else t_info.get("to_writer")
+            if other_writer:
+                await self._send_message(other_writer, f"SERVER_MSG Передача файла '{t_info['filename']}' отменена, так как пользователь отключился.")
+
+            if t_info.get("temp_filepath") and os.path.exists(t_info.get("temp_filepath")):
+                try:
+                    os.remove(t_info.get("temp_filepath"))
+                except OSError as e:
+                    logging.error(f"Не удалось удалить временный файл {t_info.get('temp_filepath')}: {e}")
+
+    def _discovery_message(self):
+        return json.dumps({
+            "app_name": "python_chat",
+            "host": self.local_ip,
+            "port": self.port,
+            # Отпечаток сертификата клиент закрепляет и сверяет при подключении к TLS порту.
+            **({"tls_port": self.tls.port, "tls_fingerprint": self.tls.fingerprint} if self.tls else {}),
+            "users": len(self.connected_clients),
+            "transfers": len(self.active_transfers),
+            "cpu": round(self.cpu_load, 3)
+        }).encode('utf-8')
+
     async def _run_broadcast_service(self):
-        class BroadcastProtocol(asyncio.DatagramProtocol):
-            def __init__(self, message):
-                self.message = message
+        server = self
+
+        class DiscoveryProtocol(asyncio.DatagramProtocol):
+            def __init__(self):
                 self.transport = None
             def connection_made(self, transport):
                 self.transport = transport
                 sock = self.transport.get_extra_info('socket')
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            def datagram_received(self, data, addr):
+                # Клиент не ждёт очередного маяка: на зонд отвечаем сразу.
+                try:
+                    request = json.loads(data.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    return
+                if isinstance(request, dict) and request.get("app_name") == "python_chat" and request.get("type") == "probe":
+                    self.transport.sendto(server._discovery_message(), addr)
             def send(self):
                 if self.transport:
-                    self.transport.sendto(self.message, ('<broadcast>', BROADCAST_PORT))
+                    self.transport.sendto(server._discovery_message(), ('<broadcast>', BROADCAST_PORT))
 
-        message = json.dumps({
-            "app_name": "python_chat",
-            "host": self.local_ip,
-            "port": self.port
-        }).encode('utf-8')
-        
         loop = asyncio.get_running_loop()
+        probe_transport = None
         try:
+            # Маяки уходят с временного порта, как раньше; зонды слушаются отдельно, и если порт
+            # DISCOVERY_PORT занят (второй сервер на машине), остаются одни маяки.
             transport, protocol = await loop.create_datagram_endpoint(
-                lambda: BroadcastProtocol(message), local_addr=('0.0.0.0', 0))
-            logging.info(f"Служба автообнаружения запущена на UDP порту {BROADCAST_PORT}.")
+                DiscoveryProtocol, local_addr=('0.0.0.0', 0))
+            try:
+                probe_transport, _ = await loop.create_datagram_endpoint(
+                    DiscoveryProtocol, local_addr=('0.0.0.0', DISCOVERY_PORT))
+                logging.info(f"Служба автообнаружения запущена: маяки на UDP порт {BROADCAST_PORT}, зонды на UDP порт {DISCOVERY_PORT}.")
+            except OSError as e:
+                logging.warning(f"Зонды автообнаружения не принимаются (UDP порт {DISCOVERY_PORT}: {e}), работают только маяки на порт {BROADCAST_PORT}.")
+            last_wall, last_cpu = time.monotonic(), time.process_time()
             while True:
                 protocol.send()
                 await asyncio.sleep(BROADCAST_INTERVAL)
+                wall, cpu = time.monotonic(), time.process_time()
+                self.cpu_load = (cpu - last_cpu) / max(wall - last_wall, 1e-6)
+                last_wall, last_cpu = wall, cpu
         except asyncio.CancelledError:
             logging.info("Служба автообнаружения остановлена.")
         except Exception as e:
@@ -431,10 +1035,35 @@ class ChatServer:
         finally:
             if 'transport' in locals() and transport:
                 transport.close()
+            if probe_transport:
+                probe_transport.close()
 
 if __name__ == "__main__":
-    server = ChatServer(HOST, PORT)
+    parser = argparse.ArgumentParser(description="Сервер чата для локальной сети.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--trace", metavar="FILE", help="записывать входящий трафик (имена заменяются псевдонимами) для replay_trace.py")
+    parser.add_argument("--transport", metavar="SPEC", default="",
+                        help="профили сокетов: tuned (по умолчанию), wifi, system, legacy и поправки, например wifi,bulk.sndbuf=2097152")
+    parser.add_argument("--tls", action="store_true", help="принимать шифрованные подключения (TLS) на --tls-port")
+    parser.add_argument("--tls-required", action="store_true", help="принимать только шифрованные подключения")
+    parser.add_argument("--tls-port", type=int, default=TLS_PORT)
+    parser.add_argument("--tls-cert", metavar="FILE", help="свой сертификат (PEM); без него создаётся самоподписанный в server_tls/")
+    parser.add_argument("--tls-key", metavar="FILE", help="закрытый ключ к --tls-cert")
+    args = parser.parse_args()
+    try:
+        transport_profiles = TransportProfiles.parse(args.transport)
+    except ValueError as e:
+        parser.error(str(e))
+    tls = None
+    if args.tls or args.tls_required:
+        try:
+            tls = TlsServer(args.tls_cert, args.tls_key, args.tls_port, required=args.tls_required)
+        except (RuntimeError, OSError) as e:
+            parser.error(f"TLS не включён: {e}")
+    server = ChatServer(HOST, args.port, trace_path=args.trace, transport_profiles=transport_profiles, tls=tls)
     try:
         asyncio.run(server.start())
     except Exception as e:
-        logging.critical(f"Не удалось запустить сервер: {e}", exc_info=True)
\ No newline at end of file
+        logging.critical(f"Не удалось запустить сервер: {e}", exc_info=True)
+    if server.handed_off:
+        server.restart.launch()
@@ -0,0 +1,157 @@
+import asyncio
+import cProfile
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+# ------------------------------
+# Параметры профилирования
+# ------------------------------
+PROFILE_DIR = "server_profiles"
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_SAMPLE_INTERVAL = 0.005   # период снятия стека цикла событий для .folded
+TRACEMALLOC_FRAMES = 10
+# Методы сервера, время которых считается отдельно по каждому вызову.
+PROFILED_HANDLERS = ("_process_batch", "_process_line", "_broadcast_message",
+                     "_handle_upload_connection", "_handle_download_connection")
+
+class ServerProfiler:
+    """Профилирование работающего сервера в течение ограниченного окна.
+
+    Пока окно открыто, в потоке цикла событий работает cProfile, отдельный
+    поток раз в PROFILE_SAMPLE_INTERVAL снимает стек этого потока (свёрнутые
+    стеки для flamegraph.pl/speedscope), tracemalloc отслеживает рост памяти, а
+    методы из PROFILED_HANDLERS подменяются на экземпляре обёртками с замером
+    времени. После окна обёртки снимаются — в обычной работе накладных
+    расходов нет. Снимки tracemalloc и отчёты делаются в отдельном потоке
+    профилировщика по очереди, цикл их не ждёт; время снимков (пока их
+    собирает C-код, GIL занят и цикл всё же стоит) пишется в отчёт о памяти.
+    """
+
+    def __init__(self, server, output_dir=PROFILE_DIR):
+        self.server = server
+        self.output_dir = Path(output_dir)
+        self.active = False
+        self.profile = None
+        self.sampler = None
+        self.samples = Counter()
+        self.timings = {}  # метка -> [вызовов, сумма, максимум]
+        self.baseline = None    # Future снимка памяти в начале окна
+        self.prefix = None
+        # Один поток: начальный снимок, конечный и отчёты выполняются строго по очереди.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiler")
+
+    def start(self, seconds=PROFILE_DEFAULT_SECONDS):
+        # Возвращает путь-префикс будущих отчётов или None, если окно уже открыто.
+        if self.active: return None
+        loop = asyncio.get_running_loop()
+        seconds = max(1, min(int(seconds), PROFILE_MAX_SECONDS))
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = self.output_dir / f"profile-{datetime.now():%Y%m%d-%H%M%S}"
+        self.active = True
+        self.samples = Counter()
+        self.timings = {}
+        self.baseline = self.executor.submit(self._begin_snapshot)
+        for name in PROFILED_HANDLERS:
+            setattr(self.server, name, self._timed(name, getattr(self.server, name)))
+        self.sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), name="profiler-sampler", daemon=True)
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        loop.call_later(seconds, self.stop)
+        logging.info(f"Профилирование запущено на {seconds} с, отчёты: {self.prefix}.*")
+        return self.prefix
+
+    def stop(self):
+        if not self.active: return
+        self.profile.disable()
+        self.active = False
+        for name in PROFILED_HANDLERS:
+            self.server.__dict__.pop(name, None)
+        self.sampler.join()
+        snapshot = self.executor.submit(self._end_snapshot, self.baseline)
+        profile, samples, timings, baseline, prefix = self.profile, self.samples, self.timings, self.baseline, self.prefix
+        self.profile = self.baseline = None
+        self.executor.submit(self._write_reports, profile, samples, timings, baseline, snapshot, prefix)
+
+    # Включение и выключение tracemalloc тоже идут в потоке профилировщика, иначе новое
+    # окно могло бы включиться раньше, чем предыдущее выключит слежение.
+    @staticmethod
+    def _begin_snapshot():
+        # (снимок, секунды на него, включили ли слежение сами).
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        started = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot, time.perf_counter() - started, started_tracing
+
+    @staticmethod
+    def _end_snapshot(baseline):
+        started = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot()
+        elapsed = time.perf_counter() - started
+        if baseline.result()[2]:
+            tracemalloc.stop()
+        return snapshot, elapsed
+
+    def _timed(self, name, method):
+        timings = self.timings
+
+        async def wrapper(*args, **kwargs):
+            label = name
+            if name == "_process_line":
+                # Команды считаем по отдельности, обычные сообщения — вместе.
+                command = args[1].partition(" ")[0].lower()
+                label = f"{name} {command if command.startswith('/') else 'сообщение'}"
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                entry = timings.setdefault(label, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+        return wrapper
+
+    def _sample(self, thread_id):
+        while self.active:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def _write_reports(self, profile, samples, timings, baseline, snapshot, prefix):
+        try:
+            (baseline, baseline_time, _), (snapshot, snapshot_time) = baseline.result(), snapshot.result()
+            profile.dump_stats(f"{prefix}.pstats")
+            with open(f"{prefix}.folded", "w", encoding="utf-8") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(f"{prefix}.handlers.txt", "w", encoding="utf-8") as f:
+                f.write(f"{'обработчик':<48}{'вызовов':>10}{'всего, мс':>12}{'среднее, мс':>13}{'макс, мс':>10}\n")
+                for label, (calls, total, peak) in sorted(timings.items(), key=lambda item: -item[1][1]):
+                    f.write(f"{label:<48}{calls:>10}{total * 1000:>12.1f}{total / calls * 1000:>13.3f}{peak * 1000:>10.1f}\n")
+            with open(f"{prefix}.memory.txt", "w", encoding="utf-8") as f:
+                f.write(f"Снимки tracemalloc: {baseline_time * 1000:.1f} мс в начале, {snapshot_time * 1000:.1f} мс в конце "
+                        f"(всё это время GIL занят, цикл событий стоит).\n")
+                f.write("Рост памяти за окно профилирования (tracemalloc):\n")
+                for stat in snapshot.compare_to(baseline, "lineno")[:50]:
+                    f.write(f"{stat}\n")
+            logging.info(f"Профилирование завершено: {prefix}.pstats, .folded, .handlers.txt, .memory.txt "
+                         f"(снимки памяти {baseline_time * 1000:.1f} и {snapshot_time * 1000:.1f} мс)")
+        except Exception as e:
+            logging.error(f"Не удалось сохранить результаты профилирования: {e}", exc_info=True)
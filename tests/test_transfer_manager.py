@@ -0,0 +1,59 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from transfer_manager import TransferManager  # noqa: E402
+
+
+class FakeNetwork:
+    def __init__(self):
+        self.calls = []
+
+    def download_direct(self, transfer_id, *args):
+        self.calls.append(("download_direct", transfer_id))
+
+    def download(self, transfer_id, *args):
+        self.calls.append(("download", transfer_id))
+
+    def cancel_transfer(self, transfer_id):
+        self.calls.append(("cancel_transfer", transfer_id))
+
+
+class RelayFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.network = FakeNetwork()
+        self.sent = []
+        self.manager = TransferManager(self.network, lambda command: self.sent.append(command) or True, direct=True)
+
+    def test_download_ready_after_direct_start_reuses_record(self):
+        # Получатель принял прямую передачу позже DIRECT_ACCEPT_TIMEOUT: прямое скачивание уже
+        # началось, когда приходит DOWNLOAD_READY от перехода отправителя на сервер.
+        item = self.manager.add_download("t1", "bob", "f.bin", 10, "/tmp/f.bin", direct=("127.0.0.1", 1, "token"))
+        self.assertEqual((item["state"], item["mode"]), ("active", "direct"))
+
+        self.assertTrue(self.manager.on_download_ready({"transfer_id": "t1", "from_user": "bob", "filename": "f.bin", "filesize": 10}))
+        self.assertEqual(len(self.manager.transfers), 1)
+        self.assertEqual((item["state"], item["mode"]), ("requested", "relay"))
+        self.assertIn(("cancel_transfer", "t1"), self.network.calls)
+        self.assertEqual(self.sent, ["/download t1"])
+
+        # Событие отменённой прямой попытки запись не трогает, слот скачивания один.
+        self.manager.on_progress({"transfer_id": "t1", "mode": "direct", "state": "error", "error": "cancelled",
+                                  "done": 0, "total": 10, "rate": 0.0, "eta": None})
+        self.assertEqual(item["state"], "requested")
+        self.manager.on_download_proceed({"transfer_id": "t1", "port": 9090})
+        self.assertEqual(item["state"], "active")
+        self.assertIn(("download", "t1"), self.network.calls)
+
+    def test_add_download_is_idempotent_per_transfer(self):
+        first = self.manager.add_download("t2", "bob", "f.bin", 10, "/tmp/f.bin")
+        second = self.manager.add_download("t2", "bob", "f.bin", 10, "/tmp/other.bin")
+        self.assertIs(first, second)
+        self.assertEqual(len(self.manager.transfers), 1)
+        self.assertEqual(self.sent, ["/download t2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
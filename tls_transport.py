@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+from pathlib import Path
+
+# ------------------------------
+# Шифрование (TLS)
+# ------------------------------
+TLS_PORT = 9443
+TLS_DIR = "server_tls"
+CERT_NAME = "cert.pem"
+KEY_NAME = "key.pem"
+CERT_DAYS = 3650
+# Билетов сессии на полное рукопожатие (TLS 1.3): переподключения и короткие
+# соединения UPLOAD/DOWNLOAD предъявляют билет и обходятся без проверки сертификата.
+SESSION_TICKETS = 4
+
+def certificate_fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+def ensure_certificate(directory=TLS_DIR):
+    # Самоподписанный сертификат создаётся один раз; в стандартной библиотеке генерации
+    # сертификатов нет, поэтому нужен openssl в PATH (или свои файлы через --tls-cert/--tls-key).
+    directory = Path(directory)
+    cert, key = directory / CERT_NAME, directory / KEY_NAME
+    if cert.exists() and key.exists():
+        return cert, key
+    openssl = shutil.which("openssl")
+    if not openssl:
+        raise RuntimeError("Для автоматического сертификата нужен openssl в PATH; укажите свой через --tls-cert и --tls-key.")
+    directory.mkdir(parents=True, exist_ok=True)
+    result = subprocess.run([openssl, "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                             "-days", str(CERT_DAYS), "-subj", "/CN=python_chat", "-keyout", str(key), "-out", str(cert)],
+                            capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"openssl не смог создать сертификат: {result.stderr.strip()}")
+    os.chmod(key, 0o600)
+    return cert, key
+
+class TlsServer:
+    """Настройки TLS сервера: контекст, отпечаток сертификата для маяка и счётчики рукопожатий.
+
+    Шифрованные подключения принимаются на отдельном порту, протокол поверх
+    TLS тот же. С required=True обычный порт отвечает только на запрос
+    TLS (где шифрованный порт и какой отпечаток), чат и файлы без шифрования
+    не принимаются.
+    """
+
+    def __init__(self, cert=None, key=None, port=TLS_PORT, required=False):
+        if not cert:
+            cert, key = ensure_certificate()
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.context.load_cert_chain(cert, key)
+        self.context.options &= ~ssl.OP_NO_TICKET
+        self.context.num_tickets = SESSION_TICKETS
+        with open(cert, encoding="ascii") as f:
+            self.fingerprint = certificate_fingerprint(ssl.PEM_cert_to_DER_cert(f.read()))
+        self.port = port
+        self.required = required
+        self.handshakes = 0
+        self.resumed = 0
+
+    def note_handshake(self, writer):
+        # True, если соединение шифрованное.
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is None: return False
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        return True
+
+class TlsClientContext(ssl.SSLContext):
+    """Клиентский контекст TLS: отпечаток вместо цепочки доверия и повторное использование сессий.
+
+    Сертификат сервера самоподписанный, поэтому проверяется SHA-256 отпечаток:
+    закреплённый в pins (host -> отпечаток, сохраняется в настройках) или,
+    при первом подключении, объявленный в маяке сервера. Последняя сессия
+    каждого сервера подставляется во все новые соединения с ним: asyncio
+    создаёт объект TLS через wrap_bio, и параметр session добавляется здесь.
+    """
+
+    def __new__(cls, pins=None):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, pins=None):
+        super().__init__()
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.pins = {} if pins is None else pins
+        self.sessions = {}
+        self.handshakes = 0
+        self.resumed = 0
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session or self.sessions.get(server_hostname))
+
+    def verify(self, ssl_object, host, advertised=None):
+        fingerprint = certificate_fingerprint(ssl_object.getpeercert(binary_form=True))
+        expected = self.pins.get(host) or advertised
+        if expected and expected != fingerprint:
+            raise ConnectionError(f"Отпечаток сертификата сервера {host} не совпадает с ожидаемым ({fingerprint[:16]}…). "
+                                  f"Если сервер переустановлен, удалите его из tls_pins в настройках.")
+        if host not in self.pins:
+            logging.info(f"Сертификат сервера {host} закреплён, SHA-256: {fingerprint}")
+            self.pins[host] = fingerprint
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        self.remember(ssl_object, host)
+
+    def remember(self, ssl_object, host):
+        # В TLS 1.3 билет приходит после рукопожатия, поэтому сессия запоминается ещё и при закрытии.
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[host] = ssl_object.session
@@ -0,0 +1,95 @@
+import gzip
+import re
+import struct
+import time
+
+# ------------------------------
+# Формат записи трафика
+# ------------------------------
+# Файл — gzip-поток: TRACE_MAGIC, затем записи <тип, соединение, мкс от начала, длина> + данные.
+TRACE_MAGIC = b"CHATTRACE1\n"
+RECORD = struct.Struct(">BIQI")
+OPEN, AUTH, LINE, DATA, CLOSE = range(1, 6)
+# Команды, первым аргументом которых идёт имя пользователя.
+USER_COMMANDS = ("/pm", "/w", "/upload")
+
+class TraceRecorder:
+    """Запись входящего трафика сервера для последующего воспроизведения.
+
+    Пишутся приветствия соединений, строки командного канала и объёмы
+    загрузок, время — от начала записи. Имена пользователей заменяются
+    псевдонимами user001, user002..., одинаковыми во всех соединениях записи,
+    в том числе когда имя упомянуто в тексте сообщения.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wb", compresslevel=6)
+        self.file.write(TRACE_MAGIC)
+        self.started = time.monotonic()
+        self.connections = {}  # writer -> номер соединения в записи
+        self.aliases = {}
+        self.names_re = None
+        self.records = 0
+
+    def alias(self, username):
+        if username not in self.aliases:
+            self.aliases[username] = f"user{len(self.aliases) + 1:03d}"
+            names = sorted(self.aliases, key=len, reverse=True)
+            self.names_re = re.compile(r"\b(?:" + "|".join(map(re.escape, names)) + r")\b")
+        return self.aliases[username]
+
+    def _write(self, kind, connection, payload=b""):
+        elapsed = int((time.monotonic() - self.started) * 1_000_000)
+        self.file.write(RECORD.pack(kind, connection, elapsed, len(payload)) + payload)
+        self.records += 1
+
+    def open(self, writer, greeting):
+        connection = self.connections[writer] = len(self.connections) + 1
+        self._write(OPEN, connection, greeting.encode("utf-8"))
+
+    def auth(self, writer, username):
+        connection = self.connections.get(writer)
+        if connection: self._write(AUTH, connection, self.alias(username).encode("utf-8"))
+
+    def lines(self, writer, lines):
+        connection = self.connections.get(writer)
+        if not connection: return
+        for line in lines:
+            self._write(LINE, connection, self._mask(line).encode("utf-8"))
+
+    def data(self, writer, count):
+        connection = self.connections.get(writer)
+        if connection: self._write(DATA, connection, struct.pack(">Q", count))
+
+    def close(self, writer):
+        connection = self.connections.pop(writer, None)
+        if connection: self._write(CLOSE, connection)
+
+    def stop(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _mask(self, line):
+        command, _, rest = line.partition(" ")
+        if command.lower() in USER_COMMANDS and rest:
+            target, _, tail = rest.partition(" ")
+            line = f"{command} {self.alias(target)} {tail}" if tail else f"{command} {self.alias(target)}"
+        return self.names_re.sub(lambda m: self.aliases[m.group(0)], line) if self.names_re else line
+
+def read_trace(path):
+    # Записи по порядку: (тип, соединение, секунды от начала, данные). DATA отдаёт число байт.
+    with gzip.open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path}: не запись трафика чата")
+        while header := f.read(RECORD.size):
+            if len(header) < RECORD.size:
+                raise ValueError(f"{path}: запись оборвана")
+            kind, connection, elapsed, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if kind == DATA:
+                payload = struct.unpack(">Q", payload)[0]
+            else:
+                payload = payload.decode("utf-8", "replace")
+            yield kind, connection, elapsed / 1_000_000, payload
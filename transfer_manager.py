@@ -0,0 +1,249 @@
+import logging
+import os
+import uuid
+
+from network_core import MAX_CONCURRENT_TRANSFERS, choose_encoding
+
+ACTIVE_STATES = ("requested", "active", "direct")
+FINAL_STATES = ("done", "error", "cancelled", "rejected")
+
+class TransferManager:
+    """Единое состояние передач файлов клиента.
+
+    Живёт в потоке Tk, им пользуются и главное окно, и окно ЛС. Каждая отправка
+    помечается id запроса, который сервер возвращает в UPLOAD_PROCEED, поэтому
+    ответы можно сопоставить с файлами в любом порядке. Очередь упорядочена
+    пользователем; одновременно идёт не больше max_uploads отправок и
+    max_downloads скачиваний, остальные ждут.
+
+    С direct=True файл по возможности идёт напрямую от отправителя к получателю
+    (сервер только передаёт адрес и одноразовый токен); при неудаче та же запись
+    переключается на передачу через сервер.
+
+    С compress=True отправитель предлагает сжатие zlib для файлов, которые по
+    пробам сжимаются; сервер включает его, если согласен и получатель. В записи
+    size — размер файла, wire — сколько байт прошло по сети.
+    """
+
+    def __init__(self, network, send_command, on_change=None, max_uploads=MAX_CONCURRENT_TRANSFERS, max_downloads=MAX_CONCURRENT_TRANSFERS, direct=False, compress=False):
+        self.network = network
+        self.send_command = send_command
+        self.on_change = on_change
+        self.direct = direct
+        self.compress = compress
+        self.limits = {"upload": max(1, int(max_uploads)), "download": max(1, int(max_downloads))}
+        self.transfers = []     # порядок очереди
+        self.by_id = {}         # id записи -> запись
+        self.by_transfer = {}   # transfer_id сервера -> запись
+
+    # --- Постановка в очередь ---
+    def add_upload(self, peer, filepath):
+        # Имя уходит в протокол одним словом.
+        filename = os.path.basename(filepath).replace(" ", "_")
+        request_id = uuid.uuid4().hex[:12]
+        item = self._add({"id": request_id, "direction": "upload", "peer": peer, "filename": filename, "filepath": filepath,
+                          "size": os.path.getsize(filepath), "transfer_id": None, "state": "awaiting_accept", "mode": "relay"})
+        flags = " p2p" if self.direct else ""
+        if self.compress and choose_encoding(filepath) == "zlib":
+            flags += " zlib"
+        if not self.send_command(f"/upload {peer} {filename} {item['size']} {request_id}{flags}"):
+            self._finish(item, "error", "нет соединения с сервером")
+        return item
+
+    def accept_command(self, transfer_id):
+        # Распаковать поток получатель может всегда, поэтому на сжатие соглашается сразу.
+        return f"/file_accept {transfer_id}{' p2p' if self.direct else ''} zlib"
+
+    def add_download(self, transfer_id, peer, filename, filesize, local_filepath, direct=None, encoding="raw"):
+        # direct — (host, port, token) из DIRECT_READY. Одна запись на transfer_id: повторное
+        # предложение той же передачи незавершённую запись не дублирует.
+        fields = {"id": transfer_id, "direction": "download", "peer": peer, "filename": filename, "filepath": local_filepath,
+                  "size": filesize, "transfer_id": transfer_id, "state": "queued", "mode": "direct" if direct else "relay", "direct": direct,
+                  "encoding": encoding}
+        item = self.by_transfer.get(transfer_id)
+        if item is not None and item["direction"] == "download":
+            if item["state"] not in FINAL_STATES: return item
+            # Сервер предложил файл снова (например, после перезапуска): та же запись встаёт в очередь.
+            item.update(fields)
+            self._reset(item)
+            self._changed(item)
+        else:
+            item = self._add(fields)
+        self.by_transfer[transfer_id] = item
+        self.pump()
+        return item
+
+    def _add(self, item):
+        item.setdefault("encoding", "raw")
+        self._reset(item)
+        self.transfers.append(item)
+        self.by_id[item["id"]] = item
+        self._changed(item)
+        return item
+
+    @staticmethod
+    def _reset(item):
+        item.update({"port": None, "paused": False, "done": 0, "wire": 0, "rate": 0.0, "eta": None, "error": None})
+
+    # --- Ответы сервера и сетевого ядра ---
+    def on_upload_proceed(self, data):
+        item = self.by_id.get(data.get("request_id"))
+        if item is None:
+            # Сервер без id запросов: сопоставить можно только по порядку.
+            waiting = [t for t in self.transfers if t["direction"] == "upload" and t["state"] == "awaiting_accept"]
+            if not waiting:
+                logging.warning(f"UPLOAD_PROCEED {data['transfer_id']} без ожидающей отправки.")
+                return
+            item = waiting[0]
+        if item["state"] in FINAL_STATES:
+            # Отменили, пока получатель думал: сообщаем серверу, теперь id передачи известен.
+            self.send_command(f"/file_cancel {data['transfer_id']}")
+            return
+        if item["mode"] == "direct":
+            # Прямая передача не состоялась — сервер просит загрузить файл к нему.
+            self.network.cancel_transfer(data["transfer_id"])
+        item.update({"transfer_id": data["transfer_id"], "port": data["port"], "state": "queued", "mode": "relay", "encoding": data.get("encoding", "raw")})
+        self.by_transfer[data["transfer_id"]] = item
+        self._changed(item)
+        self.pump()
+
+    def on_direct_prepare(self, data):
+        item = self.by_id.get(data.get("request_id"))
+        if item is None or item["state"] in FINAL_STATES:
+            self.send_command(f"/file_cancel {data['transfer_id']}")
+            return
+        item.update({"transfer_id": data["transfer_id"], "state": "direct", "mode": "direct", "encoding": data.get("encoding", "raw")})
+        self.by_transfer[data["transfer_id"]] = item
+        self.network.serve_direct(data["transfer_id"], item["filepath"], data["token"], item["encoding"])
+        self._changed(item)
+
+    def on_direct_listening(self, data):
+        item = self.by_transfer.get(data["transfer_id"])
+        if item is None or item["state"] != "direct": return
+        self.send_command(f"/direct_ready {data['transfer_id']} {data['port']}")
+
+    def on_download_ready(self, data):
+        # True, если у передачи уже есть незавершённая запись: файл скачивается через сервер,
+        # пользователя второй раз не спрашиваем.
+        item = self.by_transfer.get(data["transfer_id"])
+        if item is None or item["direction"] != "download" or item["state"] in FINAL_STATES: return False
+        if item["mode"] == "direct":
+            # Отправитель не дождался прямого подключения и перешёл на сервер.
+            if item["state"] == "active":
+                self.network.cancel_transfer(item["transfer_id"])
+            item.update({"state": "queued", "mode": "relay", "direct": None, "done": 0, "wire": 0, "rate": 0.0, "eta": None})
+        elif item["state"] == "awaiting_relay":
+            item["state"] = "queued"
+        else:
+            return True
+        self._changed(item)
+        self.pump()
+        return True
+
+    def on_upload_rejected(self, data):
+        item = self.by_id.get(data.get("request_id"))
+        if item is None:
+            waiting = [t for t in self.transfers if t["direction"] == "upload" and t["state"] == "awaiting_accept"]
+            if not waiting: return
+            item = waiting[0]
+        self._finish(item, "rejected", data["reason"])
+
+    def on_download_proceed(self, data):
+        item = self.by_transfer.get(data["transfer_id"])
+        if item is None or item["state"] != "requested":
+            logging.warning(f"Получено DOWNLOAD_PROCEED для неизвестного transfer_id: {data['transfer_id']}")
+            return
+        item.update({"port": data["port"], "state": "active", "encoding": data.get("encoding", "raw")})
+        self.network.download(item["transfer_id"], {"filename": item["filename"], "filesize": item["size"], "local_filepath": item["filepath"]}, data["port"], item["encoding"])
+        self._changed(item)
+
+    def on_progress(self, data):
+        item = self.by_transfer.get(data["transfer_id"])
+        # События отменённой прямой передачи после перехода на сервер не относятся к записи.
+        if item is None or item["state"] in FINAL_STATES or data.get("mode", "relay") != item["mode"]: return
+        item.update({"done": data["done"], "wire": data.get("wire", data["done"]), "rate": data["rate"], "eta": data["eta"]})
+        if data["total"]: item["size"] = data["total"]
+        if data["state"] == "active":
+            self._changed(item)
+        elif item["mode"] == "direct" and data["state"] == "error":
+            logging.info(f"Прямая передача {item['transfer_id']} не удалась ({data['error']}), переход на сервер.")
+            self.send_command(f"/direct_failed {item['transfer_id']}")
+            item.update({"state": "awaiting_relay", "mode": "relay", "done": 0, "wire": 0, "rate": 0.0, "eta": None})
+            self._changed(item)
+            self.pump()
+        else:
+            if item["mode"] == "direct" and data["state"] == "done" and item["direction"] == "download":
+                self.send_command(f"/direct_done {item['transfer_id']}")
+            self._finish(item, data["state"], data["error"])
+
+    def on_remote_cancel(self, data):
+        item = self.by_transfer.get(data["transfer_id"])
+        if item is None or item["state"] in FINAL_STATES: return None
+        if item["state"] in ("active", "direct"):
+            self.network.cancel_transfer(item["transfer_id"])
+        self._finish(item, "cancelled", f"отменено пользователем {data['by_user']}")
+        return item
+
+    # --- Управление пользователем ---
+    def move(self, item_id, delta):
+        item = self.by_id.get(item_id)
+        if item is None: return
+        index = self.transfers.index(item)
+        new_index = max(0, min(len(self.transfers) - 1, index + delta))
+        if new_index == index: return
+        self.transfers.insert(new_index, self.transfers.pop(index))
+        self._changed(item)
+        self.pump()
+
+    def toggle_pause(self, item_id):
+        # Пауза действует на ещё не начатые передачи: они не займут слот, пока их не продолжат.
+        item = self.by_id.get(item_id)
+        if item is None or item["state"] in ACTIVE_STATES or item["state"] in FINAL_STATES: return
+        item["paused"] = not item["paused"]
+        self._changed(item)
+        self.pump()
+
+    def cancel(self, item_id):
+        item = self.by_id.get(item_id)
+        if item is None or item["state"] in FINAL_STATES: return
+        if item["state"] in ("active", "direct"):
+            self.network.cancel_transfer(item["transfer_id"])
+        if item["transfer_id"]:
+            self.send_command(f"/file_cancel {item['transfer_id']}")
+        self._finish(item, "cancelled")
+
+    def forget(self, item_id):
+        item = self.by_id.pop(item_id, None)
+        if item is None: return
+        self.transfers.remove(item)
+        if item["transfer_id"]: self.by_transfer.pop(item["transfer_id"], None)
+
+    # --- Очередь ---
+    def pump(self):
+        running = {"upload": 0, "download": 0}
+        for item in self.transfers:
+            if item["state"] in ACTIVE_STATES: running[item["direction"]] += 1
+        for item in self.transfers:
+            direction = item["direction"]
+            if item["state"] != "queued" or item["paused"] or running[direction] >= self.limits[direction]: continue
+            running[direction] += 1
+            if direction == "upload":
+                item["state"] = "active"
+                self.network.upload(item["transfer_id"], item["filepath"], item["port"], item["encoding"])
+            elif item["mode"] == "direct":
+                item["state"] = "active"
+                host, port, token = item["direct"]
+                self.network.download_direct(item["transfer_id"], {"filename": item["filename"], "filesize": item["size"], "local_filepath": item["filepath"]}, host, port, token, item["encoding"])
+            else:
+                # Слот занимаем сразу: сервер начнёт отдавать файл после DOWNLOAD_PROCEED.
+                item["state"] = "requested"
+                self.send_command(f"/download {item['transfer_id']}")
+            self._changed(item)
+
+    def _finish(self, item, state, error=None):
+        item.update({"state": state, "error": error, "eta": None})
+        self._changed(item)
+        self.pump()
+
+    def _changed(self, item):
+        if self.on_change: self.on_change(item)
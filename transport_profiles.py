@@ -0,0 +1,130 @@
+import logging
+import socket
+import time
+
+# ------------------------------
+# Профили транспорта
+# ------------------------------
+# В каждом наборе три профиля по назначению соединения:
+#   command — командный канал: короткие строки, важна задержка, буферы небольшие;
+#   mux     — мультиплексированное соединение: чат и файлы вместе (см. multiplex.py);
+#   bulk    — отдельное соединение передачи файла: важна скорость.
+# Буферы — байты (0 — системные), keepalive — секунды простоя до первой пробы (0 — выключен),
+# chunk_min/chunk_max — пределы куска передачи, который подстраивается под измеренную скорость.
+OPTION_DEFAULTS = {"nodelay": 0, "keepalive": 0, "sndbuf": 0, "rcvbuf": 0, "cork": 0,
+                   "chunk_min": 64 * 1024, "chunk_max": 1024 * 1024}
+TRANSPORT_PRESETS = {
+    "tuned": {
+        "command": {"nodelay": 1, "keepalive": 30, "sndbuf": 64 * 1024, "rcvbuf": 64 * 1024},
+        "mux": {"nodelay": 1, "keepalive": 30, "sndbuf": 1024 * 1024, "rcvbuf": 1024 * 1024},
+        "bulk": {"keepalive": 30, "sndbuf": 4 * 1024 * 1024, "rcvbuf": 4 * 1024 * 1024, "cork": 1,
+                 "chunk_min": 64 * 1024, "chunk_max": 4 * 1024 * 1024},
+    },
+    # Буферы поменьше: в загруженном эфире лишние мегабайты в пути — это задержка чата.
+    "wifi": {
+        "command": {"nodelay": 1, "keepalive": 15, "sndbuf": 64 * 1024, "rcvbuf": 64 * 1024},
+        "mux": {"nodelay": 1, "keepalive": 15, "sndbuf": 256 * 1024, "rcvbuf": 256 * 1024},
+        "bulk": {"keepalive": 15, "sndbuf": 1024 * 1024, "rcvbuf": 1024 * 1024, "cork": 1,
+                 "chunk_min": 32 * 1024, "chunk_max": 1024 * 1024},
+    },
+    # Ничего не настраивается, размеры кусков — как до профилей.
+    "system": {"command": {}, "mux": {}, "bulk": {"chunk_min": 512 * 1024, "chunk_max": 512 * 1024}},
+    # Куски по 4 КБ и системные сокеты: исходная точка для bench_transport.py.
+    "legacy": {"command": {}, "mux": {}, "bulk": {"chunk_min": 4096, "chunk_max": 4096}},
+}
+DEFAULT_TRANSPORT = "tuned"
+CHUNK_TARGET_SECONDS = 0.05   # кусок передачи должен уходить примерно за столько
+
+class TransportProfiles:
+    """Набор профилей command/mux/bulk: настройки сокетов и пределы кусков передачи.
+
+    Задаётся строкой как у impairment_proxy: имя набора и поправки
+    «профиль.параметр=значение», например "wifi,bulk.sndbuf=2097152,bulk.cork=0".
+    Опции, которых нет на платформе (TCP_CORK вне Linux, тонкие настройки
+    keepalive), пропускаются.
+    """
+    KINDS = ("command", "mux", "bulk")
+
+    def __init__(self, preset=DEFAULT_TRANSPORT, **overrides):
+        if preset not in TRANSPORT_PRESETS:
+            raise ValueError(f"Неизвестный набор профилей '{preset}', есть: {', '.join(TRANSPORT_PRESETS)}")
+        self.preset = preset
+        self.profiles = {kind: {**OPTION_DEFAULTS, **TRANSPORT_PRESETS[preset][kind]} for kind in self.KINDS}
+        for key, value in overrides.items():
+            kind, _, name = key.partition(".")
+            if kind not in self.profiles or name not in OPTION_DEFAULTS:
+                raise ValueError(f"Неизвестный параметр профиля '{key}', нужен вид «профиль.параметр»: "
+                                 f"{', '.join(self.KINDS)} и {', '.join(OPTION_DEFAULTS)}")
+            self.profiles[kind][name] = int(value)
+
+    @classmethod
+    def parse(cls, spec):
+        preset, overrides = DEFAULT_TRANSPORT, {}
+        for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+            name, sep, value = item.partition("=")
+            if sep:
+                overrides[name.strip()] = value.strip()
+            else:
+                preset = name
+        return cls(preset, **overrides)
+
+    def apply(self, sock, kind):
+        # Буферы ставятся до connect(), чтобы окно TCP согласовалось под их размер.
+        if sock is None: return
+        profile = self.profiles[kind]
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, profile["nodelay"]) if profile["nodelay"] else None,
+                   (socket.SOL_SOCKET, socket.SO_SNDBUF, profile["sndbuf"]) if profile["sndbuf"] else None,
+                   (socket.SOL_SOCKET, socket.SO_RCVBUF, profile["rcvbuf"]) if profile["rcvbuf"] else None]
+        if profile["keepalive"]:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (("TCP_KEEPIDLE", profile["keepalive"]), ("TCP_KEEPINTVL", max(1, profile["keepalive"] // 3)), ("TCP_KEEPCNT", 3)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        for option in filter(None, options):
+            try:
+                sock.setsockopt(*option)
+            except OSError as e:
+                logging.debug(f"Опция сокета {option[1]} для профиля {kind} не применена: {e}")
+
+    def cork(self, sock, kind, enabled):
+        # TCP_CORK (Linux): ядро отправляет только полные сегменты, пока пробка не снята.
+        if sock is None or not self.profiles[kind]["cork"] or not hasattr(socket, "TCP_CORK"): return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+        except OSError as e:
+            logging.debug(f"TCP_CORK не применён: {e}")
+
+    def chunk(self, kind="bulk"):
+        profile = self.profiles[kind]
+        return AdaptiveChunk(profile["chunk_min"], profile["chunk_max"])
+
+    def describe(self):
+        changed = [f"{kind}.{name}={value}" for kind in self.KINDS for name, value in self.profiles[kind].items()
+                   if value != {**OPTION_DEFAULTS, **TRANSPORT_PRESETS[self.preset][kind]}[name]]
+        return ",".join([self.preset, *changed])
+
+class AdaptiveChunk:
+    """Размер куска передачи по измеренной скорости.
+
+    После каждого куска update() пересчитывает сглаженную скорость и выбирает
+    степень двойки, которая уйдёт примерно за CHUNK_TARGET_SECONDS: на быстром
+    канале куски крупные и вызовов мало, на медленном мелкие, и прогресс с
+    отменой остаются отзывчивыми.
+    """
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = self.minimum
+        self.rate = None
+        self.started = time.perf_counter()
+
+    def update(self, count):
+        now = time.perf_counter()
+        elapsed, self.started = now - self.started, now
+        if self.minimum == self.maximum or not count: return self.size
+        rate = count / max(elapsed, 1e-6)
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        wanted = max(self.minimum, min(self.maximum, int(self.rate * CHUNK_TARGET_SECONDS)))
+        self.size = min(self.maximum, 1 << (wanted.bit_length() - 1)) if wanted > self.minimum else self.minimum
+        return self.size
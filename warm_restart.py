@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+# ------------------------------
+# Параметры тёплого перезапуска
+# ------------------------------
+LISTEN_FD_ENV = "CHAT_SERVER_LISTEN_FD"        # POSIX: номера унаследованных слушающих сокетов через запятую
+LISTEN_SHARE_ENV = "CHAT_SERVER_LISTEN_SHARE"  # Windows: сокеты приходят через stdin (socket.share)
+SHARE_HEADER = struct.Struct(">I")
+SNAPSHOT_ENV = "CHAT_SERVER_SNAPSHOT"
+SNAPSHOT_NAME = "restart_snapshot.json"
+DRAIN_TIMEOUT = 15.0           # столько ждём окончания идущих передач
+DRAIN_POLL_INTERVAL = 0.1
+HINT_FLUSH_TIMEOUT = 1.0       # столько ждём, пока RECONNECT уйдёт клиентам
+RECONNECT_SPREAD_MS = 1000     # клиенты переподключаются вразброс в этом окне
+ACTIVE_STATUSES = ("uploading", "downloading")
+
+def inherited_listeners():
+    # Слушающие сокеты от предыдущего процесса (обычный, затем TLS) или [] при обычном запуске.
+    fds = os.environ.pop(LISTEN_FD_ENV, None)
+    if fds:
+        return [socket.socket(fileno=int(fd)) for fd in fds.split(",")]
+    if os.environ.pop(LISTEN_SHARE_ENV, None):
+        data, listeners = sys.stdin.buffer.read(), []
+        while data:
+            length, = SHARE_HEADER.unpack_from(data)
+            listeners.append(socket.fromshare(data[SHARE_HEADER.size:SHARE_HEADER.size + length]))
+            data = data[SHARE_HEADER.size + length:]
+        return listeners
+    return []
+
+class WarmRestart:
+    """Перезапуск сервера (обновление кода) без шторма переподключений и повторных отправок.
+
+    Старый процесс ждёт окончания идущих передач (не дольше DRAIN_TIMEOUT),
+    сохраняет сессии с их очередями сообщений и записи передач в снимок рядом
+    с принятыми файлами, рассылает клиентам RECONNECT и отдаёт слушающие сокеты
+    новому процессу: на POSIX — exec с тем же сокетом, на Windows — дочернему
+    процессу через socket.share. Подключения во время перезапуска ждут в
+    очереди сокета, клиенты восстанавливают сессии через RESUME, принятые
+    сервером файлы остаются на диске и скачиваются как обычно.
+    """
+
+    def __init__(self, server, upload_dir, backlog_limit):
+        self.server = server
+        self.snapshot_path = Path(upload_dir) / SNAPSHOT_NAME
+        self.backlog_limit = backlog_limit
+        self.task = None
+        self.listeners = []    # копии слушающих сокетов для нового процесса
+
+    def start(self):
+        # Возвращает False, если перезапуск уже идёт.
+        if self.task: return False
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    async def _run(self):
+        server = self.server
+        logging.info(f"Тёплый перезапуск: ожидание окончания передач (не дольше {DRAIN_TIMEOUT:.0f} с).")
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline and any(t["status"] in ACTIVE_STATUSES for t in server.active_transfers.values()):
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        async with server.sessions_lock, server.transfers_lock:
+            state = self._snapshot()
+            # С этого момента состояние принадлежит новому процессу: отключения клиентов
+            # не отменяют передач и не удаляют файлы.
+            server.handed_off = True
+        with open(self.snapshot_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        servers = [tcp_server for tcp_server in (server.tcp_server, server.tls_server) if tcp_server]
+        self.listeners = [tcp_server.sockets[0].dup() for tcp_server in servers]
+        # Старый процесс больше не принимает подключений: копии сокетов держат порт открытым,
+        # и переподключения ждут в очереди нового процесса, а не попадают в уже сохранённое состояние.
+        for tcp_server in servers:
+            tcp_server.close()  # serve_forever завершится, start() дождётся этой задачи
+
+        writers = list(server.connected_clients)
+        for writer in writers:
+            server._write_lines(writer, [f"RECONNECT {RECONNECT_SPREAD_MS}"], record=False)
+        flushes = [asyncio.ensure_future(writer.drain()) for writer in writers if not writer.is_closing()]
+        if flushes:
+            await asyncio.wait(flushes, timeout=HINT_FLUSH_TIMEOUT)
+        for writer in writers:
+            writer.close()
+        logging.info(f"Тёплый перезапуск: снимок {self.snapshot_path} ({len(state['sessions'])} сессий, "
+                     f"{len(state['transfers'])} передач), клиентов предупреждено: {len(writers)}.")
+
+    def _snapshot(self):
+        server = self.server
+        sessions = {session["username"]: session for session in server.sessions.values()}
+        transfers = []
+        for transfer in server.active_transfers.values():
+            record = {key: value for key, value in transfer.items() if key not in ("from_writer", "to_writer")}
+            if transfer.get("temp_filepath"):
+                record["temp_filepath"] = str(transfer["temp_filepath"])
+            if transfer["status"] == "uploading":
+                # Продолжать отправку с середины протокол не умеет: файл придётся отправить заново.
+                notice = f"SERVER_MSG Передача файла '{transfer['filename']}' прервана перезапуском сервера, отправьте файл заново."
+                for username in (transfer["from_user"], transfer["to_user"]):
+                    if username in sessions:
+                        server._record_lines(sessions[username], [notice])
+                if record.get("temp_filepath") and os.path.exists(record["temp_filepath"]):
+                    os.remove(record["temp_filepath"])
+                continue
+            if transfer["status"] == "downloading":
+                # Файл целиком на сервере: получатель скачает его заново, предложение придёт при RESUME.
+                record["status"] = "pending_download"
+                if transfer["to_user"] in sessions:
+                    server._record_lines(sessions[transfer["to_user"]], [
+                        f"DOWNLOAD_READY {transfer['from_user']} {transfer['filename']} {transfer['filesize']} {transfer['id']}"])
+            if record["status"] in ("error", "cancelled"):
+                continue
+            transfers.append(record)
+        return {"saved": time.time(), "transfers": transfers,
+                "sessions": [{"username": session["username"], "token": session["token"], "seq": session["seq"],
+                              "backlog": list(session["backlog"])} for session in sessions.values()]}
+
+    def restore(self):
+        # Вызывается новым процессом до приёма подключений.
+        path = os.environ.pop(SNAPSHOT_ENV, None)
+        if not path: return
+        server = self.server
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось прочитать снимок перезапуска {path}: {e}")
+            return
+        os.remove(path)
+        for saved in state["sessions"]:
+            session = {"username": saved["username"], "token": saved["token"], "seq": saved["seq"],
+                       "backlog": deque(map(tuple, saved["backlog"]), maxlen=self.backlog_limit),
+                       "writer": None, "expiry_task": None}
+            server.sessions[session["token"]] = session
+            server.detached_sessions[session["username"]] = session
+            session["expiry_task"] = asyncio.create_task(server._expire_session_later(session))
+        for record in state["transfers"]:
+            if record.get("temp_filepath"):
+                record["temp_filepath"] = Path(record["temp_filepath"])
+                if not record["temp_filepath"].exists():
+                    logging.warning(f"Файл передачи {record['id']} пропал за время перезапуска.")
+                    continue
+            # Соединения участников привяжутся, когда они восстановят сессии.
+            record.update(from_writer=None, to_writer=None)
+            server.active_transfers[record["id"]] = record
+        logging.info(f"Тёплый перезапуск: восстановлено {len(state['sessions'])} сессий и {len(server.active_transfers)} передач "
+                     f"(пауза {time.time() - state['saved']:.2f} с).")
+
+    def launch(self):
+        # После остановки цикла событий: порт автообнаружения и клиенты уже отпущены.
+        env = dict(os.environ, **{SNAPSHOT_ENV: str(self.snapshot_path.resolve())})
+        argv = [sys.executable, *sys.argv]
+        logging.info("=== Сервер передаёт работу новому процессу ===")
+        logging.shutdown()
+        if hasattr(socket.socket, "share"):
+            # Windows: exec не наследует сокеты, новый процесс получает их через socket.share.
+            env[LISTEN_SHARE_ENV] = "1"
+            child = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE)
+            for listener in self.listeners:
+                data = listener.share(child.pid)
+                child.stdin.write(SHARE_HEADER.pack(len(data)) + data)
+                listener.close()
+            child.stdin.close()
+            return
+        for listener in self.listeners:
+            os.set_inheritable(listener.fileno(), True)
+        env[LISTEN_FD_ENV] = ",".join(str(listener.fileno()) for listener in self.listeners)
+        os.execve(sys.executable, argv, env)